@@ -1,21 +1,76 @@
 import os
+import asyncio
+import time
 import datetime
+import isodate
 import json
 import logging
-import random
+import itertools
+import zlib
+import uuid
+import atexit
+import threading
+import contextlib
+import collections
+import heapq
+import concurrent.futures
 
+import azure.functions as func
 from azure.identity import DefaultAzureCredential
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
-from azure.eventhub import EventHubProducerClient
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.servicebus import AutoLockRenewer, ServiceBusClient, ServiceBusMessage
+from azure.servicebus.exceptions import (
+    MessageLockLostError,
+    ServiceBusAuthenticationError,
+    ServiceBusCommunicationError,
+    ServiceBusConnectionError,
+)
 from azure.eventhub import EventData
-from azure.cosmos import CosmosClient
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueServiceClient
+from azure.eventhub.exceptions import (
+    ClientClosedError,
+    ConnectError,
+    ConnectionLostError,
+)
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from azure.servicebus.aio import ServiceBusClient as ServiceBusClientAio
+from azure.eventhub.aio import EventHubProducerClient as EventHubProducerClientAio
+from azure.cosmos.aio import CosmosClient as CosmosClientAio
+from azure.storage.blob.aio import BlobServiceClient as BlobServiceClientAio
+from azure.storage.queue.aio import QueueServiceClient as QueueServiceClientAio
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+
+import event_codec
+import latency_stamps
+from log_pipeline import LazyJson, get_event_logger
+from stage_metrics import get_stage_metrics
+
+# Spans go to whichever provider the entry point set up, see tracing.py
+_tracer = trace.get_tracer(__name__)
+_metrics = get_stage_metrics()
+# Per event records go through here, sampled and rate limited, see log_pipeline.py
+_event_log = get_event_logger()
 
 
 class GlobalArgs:
     OWNER = "Mystique"
-    VERSION = "2024-01-04"
+    VERSION = "2024-04-17"
+    TRIGGER_RANDOM_FAILURES = os.getenv("TRIGGER_RANDOM_FAILURES", True)
+    WAIT_SECS_BETWEEN_MSGS = int(os.getenv("WAIT_SECS_BETWEEN_MSGS", 2))
+    MAX_MSGS_TO_PROCESS = int(os.getenv("MAX_MSGS_TO_PROCESS", 5))
+    MAX_BACKOFF_SECS = int(os.getenv("MAX_BACKOFF_SECS", 30))
+    # "serial" receives and settles one message at a time, "concurrent" uses
+    # SvcBusConcurrentReceiver
+    SVC_BUS_RECEIVER_MODE = os.getenv("SVC_BUS_RECEIVER_MODE", "serial")
+    SVC_BUS_PREFETCH = int(os.getenv("SVC_BUS_PREFETCH", 50))
+    SVC_BUS_RECV_BATCH = int(os.getenv("SVC_BUS_RECV_BATCH", 25))
+    SVC_BUS_RECV_WORKERS = int(os.getenv("SVC_BUS_RECV_WORKERS", 16))
+    SVC_BUS_RECV_MAX_WAIT_SECS = float(os.getenv("SVC_BUS_RECV_MAX_WAIT_SECS", 5))
+    # Locks of in-flight messages are renewed for at most this long
+    SVC_BUS_LOCK_RENEWAL_SECS = float(os.getenv("SVC_BUS_LOCK_RENEWAL_SECS", 300))
+    # Transient failures are held, with their locks renewed, and abandoned
+    # after this, doubled with every delivery and capped at MAX_BACKOFF_SECS
+    SVC_BUS_RETRY_BACKOFF_SECS = float(os.getenv("SVC_BUS_RETRY_BACKOFF_SECS", 1))
 
     EVENT_HUB_FQDN = os.getenv("EVENT_HUB_FQDN")
     EVENT_HUB_NAME = os.getenv("EVENT_HUB_NAME")
@@ -24,61 +79,608 @@ class GlobalArgs:
     BLOB_SVC_ACCOUNT_URL = os.getenv("BLOB_SVC_ACCOUNT_URL")
     BLOB_NAME = os.getenv("BLOB_NAME", "store-events-blob-002")
     BLOB_PREFIX = "store_events/raw"
+    # Poison messages of batch consumers are parked here, see write_poison_msgs
+    POISON_PREFIX = "store_events/poison"
+
+    # "event" writes one blob per event, "segment" appends NDJSON segments
+    BLOB_WRITE_MODE = os.getenv("BLOB_WRITE_MODE", "event")
+    BLOB_SEGMENT_LINGER_MS = int(os.getenv("BLOB_SEGMENT_LINGER_MS", 1000))
+    BLOB_SEGMENT_MAX_BYTES = int(os.getenv("BLOB_SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+    BLOB_SEGMENT_MAX_AGE_SECS = int(os.getenv("BLOB_SEGMENT_MAX_AGE_SECS", 300))
+    # A batch that fails to send is set aside for this long, doubled with every
+    # failed send and capped at MAX_BACKOFF_SECS, and dropped after this many tries
+    BATCH_RETRY_BACKOFF_SECS = float(os.getenv("BATCH_RETRY_BACKOFF_SECS", 1))
+    BATCH_MAX_SEND_ATTEMPTS = int(os.getenv("BATCH_MAX_SEND_ATTEMPTS", 3))
+
+    STORAGE_Q_ACCOUNT_URL = os.getenv("STORAGE_Q_ACCOUNT_URL")
+    Q_NAME = os.getenv("Q_NAME")
 
     COSMOS_DB_URL = os.getenv("COSMOS_DB_URL")
-    COSMOS_DB_NAME = os.getenv(
-        "COSMOS_DB_NAME", "open-telemetry-ne-db-account-002")
+    COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME", "open-telemetry-ne-db-account-002")
     COSMOS_DB_CONTAINER_NAME = os.getenv(
-        "COSMOS_DB_CONTAINER_NAME", "store-backend-container-002")
+        "COSMOS_DB_CONTAINER_NAME", "store-backend-container-002"
+    )
+    COSMOS_BULK_MAX_CONCURRENCY = int(os.getenv("COSMOS_BULK_MAX_CONCURRENCY", 32))
+    # 0 = only back off on 429s
+    COSMOS_BULK_TARGET_RU_PER_SEC = float(os.getenv("COSMOS_BULK_TARGET_RU_PER_SEC", 0))
 
     SVC_BUS_FQDN = os.getenv(
-        "SVC_BUS_FQDN", "warehouse-q-svc-bus-ns-002.servicebus.windows.net")
+        "SVC_BUS_FQDN", "warehouse-q-svc-bus-ns-002.servicebus.windows.net"
+    )
     SVC_BUS_Q_NAME = os.getenv("SVC_BUS_Q_NAME", "warehouse-q-svc-bus-q-002")
     SVC_BUS_TOPIC_NAME = os.getenv("SVC_BUS_TOPIC_NAME")
 
     EVENT_HUB_FQDN = os.getenv("EVENT_HUB_FQDN")
     EVENT_HUB_NAME = os.getenv("EVENT_HUB_NAME", "store-events-stream-003")
     EVENT_HUB_SALE_EVENTS_CONSUMER_GROUP_NAME = os.getenv(
-        "EVENT_HUB_SALE_EVENTS_CONSUMER_GROUP_NAME")
+        "EVENT_HUB_SALE_EVENTS_CONSUMER_GROUP_NAME"
+    )
+
+    # A Service Bus batch is sent when full, at SVC_BUS_BATCH_MAX_MSGS (0 = no cap)
+    # or SVC_BUS_BATCH_LINGER_MS after its first message, whichever comes first
+    SVC_BUS_BATCH_LINGER_MS = int(os.getenv("SVC_BUS_BATCH_LINGER_MS", 100))
+    SVC_BUS_BATCH_MAX_MSGS = int(os.getenv("SVC_BUS_BATCH_MAX_MSGS", 0))
+
+    # Events are routed to a partition by this body field (empty = round robin)
+    EVENT_HUB_PARTITION_KEY = os.getenv("EVENT_HUB_PARTITION_KEY", "store_id")
+    EVENT_HUB_BATCH_LINGER_MS = int(os.getenv("EVENT_HUB_BATCH_LINGER_MS", 100))
+    EVENT_HUB_BATCH_MAX_MSGS = int(os.getenv("EVENT_HUB_BATCH_MAX_MSGS", 0))
+
+    # Fan-out of one event to many sinks, see SinkDispatcher
+    SINK_POOL_WORKERS = int(os.getenv("SINK_POOL_WORKERS", 16))
+    SINK_TIMEOUT_SECS = float(os.getenv("SINK_TIMEOUT_SECS", 30))
+    SINK_CONFIG = os.getenv("SINK_CONFIG")
+    # Calls to one sink still running, timed out ones included, before new
+    # calls to it fail fast instead of queueing on the shared pool
+    SINK_MAX_IN_FLIGHT = int(os.getenv("SINK_MAX_IN_FLIGHT", 8))
+    # Sink timeout for a whole batch of consumed messages
+    BATCH_SINK_TIMEOUT_SECS = float(os.getenv("BATCH_SINK_TIMEOUT_SECS", 55))
+
+    # Renew cached tokens this many seconds before they expire
+    AZ_TOKEN_REFRESH_MARGIN_SECS = int(os.getenv("AZ_TOKEN_REFRESH_MARGIN_SECS", 300))
+    AZ_TOKEN_REFRESH_INTERVAL_SECS = int(
+        os.getenv("AZ_TOKEN_REFRESH_INTERVAL_SECS", 30)
+    )
+
+
+############################################
+#               CREDENTIALS                #
+############################################
+
+
+class CachedTokenCredential:
+    """
+    One credential per process with a per-scope token cache.
+
+    The wrapped `DefaultAzureCredential` walks its chain on the first fetch
+    only. Cached tokens are renewed by a background thread before they expire,
+    so callers on the hot path get a cached token without waiting on the
+    identity endpoint.
+    """
+
+    def __init__(
+        self,
+        credential,
+        refresh_margin_secs: int = 300,
+        refresh_interval_secs: int = 30,
+    ):
+        self._credential = credential
+        self._refresh_margin_secs = refresh_margin_secs
+        self._refresh_interval_secs = refresh_interval_secs
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._refresher = None
+        self._stats = {
+            "token_fetches": 0,
+            "cache_hits": 0,
+            "background_refreshes": 0,
+            "refresh_failures": 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _fetch(self, key, **kwargs):
+        scopes, tenant_id, enable_cae = key
+        if tenant_id:
+            kwargs["tenant_id"] = tenant_id
+        if enable_cae:
+            kwargs["enable_cae"] = enable_cae
+        token = self._credential.get_token(*scopes, **kwargs)
+        self._count("token_fetches")
+        return token
+
+    def get_cached_token(
+        self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs
+    ):
+        """Return a still valid cached token, or None. Never blocks on a fetch."""
+        if claims:
+            return None
+        token = self._tokens.get((scopes, tenant_id, enable_cae))
+        if token and token.expires_on > time.time():
+            self._count("cache_hits")
+            return token
+        return None
+
+    def get_token(
+        self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs
+    ):
+        key = (scopes, tenant_id, enable_cae)
+        if claims:
+            # Claims challenges (CAE) must always go to the identity endpoint
+            return self._fetch(key, claims=claims, **kwargs)
+
+        token = self.get_cached_token(
+            *scopes, tenant_id=tenant_id, enable_cae=enable_cae
+        )
+        if token:
+            return token
+
+        with self._fetch_lock:
+            # Another thread may have fetched it while we waited
+            token = self._tokens.get(key)
+            if token and token.expires_on > time.time():
+                self._count("cache_hits")
+                return token
+            token = self._fetch(key, **kwargs)
+            self._tokens[key] = token
+            self._start_refresher()
+        return token
+
+    def _start_refresher(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name="az-token-refresher", daemon=True
+            )
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self._refresh_interval_secs)
+            for key, token in list(self._tokens.items()):
+                if token.expires_on - time.time() > self._refresh_margin_secs:
+                    continue
+                try:
+                    self._tokens[key] = self._fetch(key)
+                    self._count("background_refreshes")
+                except Exception as e:
+                    self._count("refresh_failures")
+                    logging.warning(f"Token refresh for {key[0]} failed: {e}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, cached_scopes=len(self._tokens))
+
+    def close(self):
+        self._credential.close()
+
+
+_az_creds = None
+_az_creds_lock = threading.Lock()
 
 
 def _get_az_creds():
+    global _az_creds
+    if _az_creds is not None:
+        return _az_creds
     try:
-        azure_log_level = logging.getLogger("azure").setLevel(logging.ERROR)
-        _az_creds = DefaultAzureCredential(
-            logging_enable=False, logging=azure_log_level)
+        with _az_creds_lock:
+            if _az_creds is None:
+                azure_log_level = logging.getLogger("azure").setLevel(logging.ERROR)
+                _az_creds = CachedTokenCredential(
+                    DefaultAzureCredential(
+                        logging_enable=False, logging=azure_log_level
+                    ),
+                    refresh_margin_secs=GlobalArgs.AZ_TOKEN_REFRESH_MARGIN_SECS,
+                    refresh_interval_secs=GlobalArgs.AZ_TOKEN_REFRESH_INTERVAL_SECS,
+                )
         return _az_creds
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
 
 
-def write_to_blob(data: dict, blob_svc_attr: dict = None):
+def get_cred_stats() -> dict:
+    if _az_creds is None:
+        return {}
+    return _az_creds.get_stats()
+
+
+############################################
+#             CLIENT REGISTRY              #
+############################################
+
+# Errors after which a pooled client (and its AMQP/HTTP connection) is no longer
+# trusted. The client is closed and evicted so the next call rebuilds it.
+_FATAL_CONN_ERRS = (
+    ServiceBusConnectionError,
+    ServiceBusCommunicationError,
+    ServiceBusAuthenticationError,
+    ConnectError,
+    ConnectionLostError,
+    ClientClosedError,
+    ServiceRequestError,
+    ServiceResponseError,
+)
+
+
+class _PooledClient:
+    def __init__(self, client, closables):
+        self.client = client
+        self.closables = closables
+        # Serialises callers of clients that are not thread-safe (AMQP senders)
+        self.lock = threading.Lock()
+
+    def close(self):
+        for c in self.closables:
+            try:
+                c.close()
+            except Exception as e:
+                logging.warning(f"Ignoring error while closing {type(c).__name__}: {e}")
+
+
+class ClientRegistry:
+    """
+    Process wide pool of long lived sync helpers, keyed by kind and target,
+    e.g. the Cosmos bulk writers.
+
+    The Azure SDK clients themselves all live in `_aio_clients`; sync code
+    reaches them through `run_sync`, so a target has one client and one
+    connection whichever path writes to it. Entries are built once on first
+    use and shared across invocations and threads; `exclusive=True` leases
+    serialise callers of entries that are not thread-safe. A fatal
+    connection error evicts the entry and the next lease builds a fresh one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = {}
+
+    def _get_entry(self, key, factory):
+        entry = self._pool.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._pool.get(key)
+                if entry is None:
+                    client, closables = factory()
+                    entry = _PooledClient(client, closables)
+                    self._pool[key] = entry
+                    logging.debug(f"Created pooled client for {key}")
+        return entry
+
+    def get(self, key, factory):
+        return self._get_entry(key, factory).client
+
+    @contextlib.contextmanager
+    def lease(self, key, factory, exclusive: bool = False):
+        entry = self._get_entry(key, factory)
+        try:
+            if exclusive:
+                with entry.lock:
+                    yield entry.client
+            else:
+                yield entry.client
+        except _FATAL_CONN_ERRS as e:
+            logging.warning(f"Evicting pooled client for {key}: {type(e).__name__}")
+            self.evict(key, entry)
+            raise
+
+    def evict(self, key, entry=None):
+        with self._lock:
+            current = self._pool.get(key)
+            # Only evict the entry the caller saw; another thread may have rebuilt it
+            if current is None or (entry is not None and current is not entry):
+                return
+            del self._pool[key]
+        current.close()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._pool.values())
+            self._pool.clear()
+        for entry in entries:
+            entry.close()
+
+
+_clients = ClientRegistry()
+atexit.register(_clients.close_all)
+
+
+def close_all_clients():
+    _clients.close_all()
+
+
+############################################
+#          ASYNC CLIENT REGISTRY           #
+############################################
+
+
+class AsyncTokenCredential:
+    """
+    Async face of the process wide `CachedTokenCredential`, for the aio
+    clients. Cached tokens are returned inline; a cache miss runs the sync
+    credential on a worker thread so the event loop never blocks.
+    """
+
+    def __init__(self, credential):
+        self._credential = credential
+
+    async def get_token(self, *scopes, **kwargs):
+        token = self._credential.get_cached_token(*scopes, **kwargs)
+        if token is None:
+            token = await asyncio.to_thread(
+                self._credential.get_token, *scopes, **kwargs
+            )
+        return token
+
+    async def close(self):
+        # The wrapped credential is shared, it is closed with the process
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def _get_az_creds_aio():
+    return AsyncTokenCredential(_get_az_creds())
+
+
+class AsyncClientRegistry:
+    """
+    Pool of aio SDK clients. aio clients are bound to the event loop that
+    created them, so the pool is keyed by loop as well as by sink and target.
+    AMQP senders are leased with `exclusive=True` as they are not safe for
+    concurrent sends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = {}
+        self._create_locks = {}
+
+    def _create_lock(self, loop):
+        with self._lock:
+            if loop not in self._create_locks:
+                self._create_locks[loop] = asyncio.Lock()
+            return self._create_locks[loop]
+
+    async def _get_entry(self, key, factory):
+        pkey = (asyncio.get_running_loop(), key)
+        entry = self._pool.get(pkey)
+        if entry is None:
+            async with self._create_lock(pkey[0]):
+                entry = self._pool.get(pkey)
+                if entry is None:
+                    client, closables = factory()
+                    entry = _PooledClient(client, closables)
+                    entry.lock = asyncio.Lock()
+                    self._pool[pkey] = entry
+                    logging.debug(f"Created pooled aio client for {key}")
+        return entry
+
+    @contextlib.asynccontextmanager
+    async def lease(self, key, factory, exclusive: bool = False):
+        entry = await self._get_entry(key, factory)
+        try:
+            if exclusive:
+                async with entry.lock:
+                    yield entry.client
+            else:
+                yield entry.client
+        except _FATAL_CONN_ERRS as e:
+            logging.warning(f"Evicting pooled aio client for {key}: {type(e).__name__}")
+            await self.evict(key, entry)
+            raise
+
+    async def evict(self, key, entry=None):
+        pkey = (asyncio.get_running_loop(), key)
+        with self._lock:
+            current = self._pool.get(pkey)
+            if current is None or (entry is not None and current is not entry):
+                return
+            del self._pool[pkey]
+        await self._close_entry(current)
+
+    @staticmethod
+    async def _close_entry(entry):
+        for c in entry.closables:
+            try:
+                await c.close()
+            except Exception as e:
+                logging.warning(f"Ignoring error while closing {type(c).__name__}: {e}")
+
+    async def close_all(self):
+        """Close the clients that belong to the running loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entries = [e for (l, _), e in self._pool.items() if l is loop]
+            self._pool = {k: e for k, e in self._pool.items() if k[0] is not loop}
+            self._create_locks.pop(loop, None)
+        for entry in entries:
+            await self._close_entry(entry)
+
+
+_aio_clients = AsyncClientRegistry()
+
+# Event loop thread that backs the sync wrappers, so their aio clients outlive
+# a single call instead of dying with a per-call asyncio.run()
+_aio_loop = None
+_aio_loop_lock = threading.Lock()
+
+
+def _get_aio_loop():
+    global _aio_loop
+    if _aio_loop is None:
+        with _aio_loop_lock:
+            if _aio_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="az-aio-loop", daemon=True
+                ).start()
+                atexit.register(_stop_aio_loop, loop)
+                _aio_loop = loop
+    return _aio_loop
+
+
+def _stop_aio_loop(loop):
+    try:
+        asyncio.run_coroutine_threadsafe(_aio_clients.close_all(), loop).result(10)
+    except Exception as e:
+        logging.warning(f"Ignoring error while closing aio clients: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def run_sync(coro, timeout: float = None):
+    """Run `coro` on the shared aio loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_aio_loop()).result(timeout)
+
+
+def _close_at_exit(closable):
+    # atexit runs in reverse, so start the aio loop first: `closable` still
+    # sends through it when closed
+    _get_aio_loop()
+    atexit.register(closable.close)
+
+
+def _new_blob_svc_client_aio(account_url):
+    client = BlobServiceClientAio(account_url, credential=_get_az_creds_aio())
+    return client, [client]
+
+
+def _new_cosmos_container_aio(db_url, db_name, container_name):
+    cosmos_client = CosmosClientAio(url=db_url, credential=_get_az_creds_aio())
+    db_container = cosmos_client.get_database_client(db_name).get_container_client(
+        container_name
+    )
+    return db_container, [cosmos_client]
+
+
+def _new_svc_bus_q_sender_aio(svc_bus_fqdn, q_name):
+    client = ServiceBusClientAio(svc_bus_fqdn, credential=_get_az_creds_aio())
+    sender = client.get_queue_sender(q_name)
+    return sender, [sender, client]
+
+
+def _new_svc_bus_topic_sender_aio(svc_bus_fqdn, topic_name):
+    client = ServiceBusClientAio(svc_bus_fqdn, credential=_get_az_creds_aio())
+    sender = client.get_topic_sender(topic_name=topic_name)
+    return sender, [sender, client]
+
+
+def _new_event_hub_producer_aio(event_hub_fqdn, event_hub_name):
+    producer = EventHubProducerClientAio(
+        fully_qualified_namespace=event_hub_fqdn,
+        eventhub_name=event_hub_name,
+        credential=_get_az_creds_aio(),
+    )
+    return producer, [producer]
+
+
+def _new_storage_q_client_aio(account_url, q_name):
+    q_svc_client = QueueServiceClientAio(account_url, credential=_get_az_creds_aio())
+    return q_svc_client.get_queue_client(q_name), [q_svc_client]
+
+
+############################################
+#           PRODUCER UTILITIES             #
+############################################
+
+
+def _serialize(data) -> bytes:
+    with _tracer.start_as_current_span("serialize"), _metrics.time("serialize"):
+        payload = event_codec.dumps(data)
+    _metrics.add("bytes_serialized", len(payload))
+    return payload
+
+
+def _blob_partition_prefix(data: dict, blob_prefix: str = None) -> str:
+    blob_prefix = blob_prefix or GlobalArgs.BLOB_PREFIX
+    _dt = datetime.datetime.now().strftime("%Y_%m_%d")
+    if data.get("event_type"):
+        return f"{blob_prefix}/event_type={data['event_type']}/dt={_dt}"
+    return f"{blob_prefix}/dt={_dt}"
+
+
+def write_to_blob(
+    data: dict, blob_svc_attr: dict = None, payload: bytes = None, flush: bool = False
+):
+    return run_sync(write_to_blob_async(data, blob_svc_attr, payload, flush))
+
+
+def write_to_cosmosdb(data: dict, db_attr: dict = None, upsert: bool = False):
+    return run_sync(write_to_cosmosdb_async(data, db_attr, upsert))
+
+
+def write_to_svc_bus_q(data, msg_attr, q_attr: dict = None):
+    return run_sync(write_to_svc_bus_q_async(data, msg_attr, q_attr))
+
+
+def write_to_svc_bus_topic(data, msg_attr, topic_attr: dict = None):
+    return run_sync(write_to_svc_bus_topic_async(data, msg_attr, topic_attr))
+
+
+def write_to_event_hub(data, msg_attr, event_hub_attr: dict = None):
+    """
+    Queue `data` on the shared partition-aware producer. The event is sent
+    with its partition's batch when that batch fills up or lingers past
+    EVENT_HUB_BATCH_LINGER_MS; call `get_event_hub_producer().flush()` to
+    send right away.
+    """
+    try:
+        get_event_hub_producer().send(data, msg_attr)
+    except Exception as e:
+        logging.exception(f"ERROR:{str(e)}")
+        raise e
+
+
+def write_to_storage_q(data: dict, storage_q_attr: dict = None):
+    return run_sync(write_to_storage_q_async(data, storage_q_attr))
+
+
+############################################
+#        ASYNC PRODUCER UTILITIES          #
+############################################
+
+
+async def write_to_blob_async(
+    data: dict, blob_svc_attr: dict = None, payload: bytes = None, flush: bool = False
+):
+    """
+    `payload`, if given, is `data` already serialized as JSON, e.g. the body
+    of a received message; it is stored as is rather than dumped again.
+
+    In segment mode the event is only buffered unless `flush` is set; pass
+    it when the caller settles a message afterwards, see BlobSegmentWriter.
+    """
     try:
+        if GlobalArgs.BLOB_WRITE_MODE == "segment":
+            # Appending to the buffer may wait on a flush, keep that off the loop
+            await asyncio.to_thread(
+                get_blob_segment_writer().write, data, payload, flush
+            )
+            return
+
         blob_svc_attr = {
             "blob_svc_account_url": GlobalArgs.BLOB_SVC_ACCOUNT_URL,
             "blob_name": GlobalArgs.BLOB_NAME,
             "blob_prefix": GlobalArgs.BLOB_PREFIX,
-            "container_prefix": data.get("event_type")
         }
 
-        blob_svc_client = BlobServiceClient(
-            blob_svc_attr["blob_svc_account_url"], credential=_get_az_creds())
-
-        if blob_svc_attr.get('container_prefix'):
-            blob_name = f"{blob_svc_attr['blob_prefix']}/event_type={blob_svc_attr['container_prefix']}/dt={datetime.datetime.now().strftime('%Y_%m_%d')}/{datetime.datetime.now().strftime('%s%f')}.json"
-        else:
-            blob_name = f"{blob_svc_attr['blob_prefix']}/dt={datetime.datetime.now().strftime('%Y_%m_%d')}/{datetime.datetime.now().strftime('%s%f')}.json"
-
-        blob_client = blob_svc_client.get_blob_client(
-            container=blob_svc_attr["blob_name"], blob=blob_name)
+        blob_name = f"{_blob_partition_prefix(data, blob_svc_attr['blob_prefix'])}/{datetime.datetime.now().strftime('%s%f')}.json"
 
-        # if blob_client.exists():
-        #     blob_client.delete_blob()
-        #     logging.debug(
-        #         f"Blob {blob_name} already exists. Deleted the file.")
-
-        resp = blob_client.upload_blob(json.dumps(data).encode("UTF-8"))
+        _url = blob_svc_attr["blob_svc_account_url"]
+        async with _aio_clients.lease(
+            ("blob_svc", _url), lambda: _new_blob_svc_client_aio(_url)
+        ) as blob_svc_client:
+            blob_client = blob_svc_client.get_blob_client(
+                container=blob_svc_attr["blob_name"], blob=blob_name
+            )
+            resp = await blob_client.upload_blob(payload or _serialize(data))
 
         logging.info(f"Blob {blob_name} uploaded successfully")
         logging.debug(f"{resp}")
@@ -87,135 +689,1854 @@ def write_to_blob(data: dict, blob_svc_attr: dict = None):
         raise e
 
 
-def write_to_cosmosdb(data: dict, db_attr: dict = None):
+async def write_to_cosmosdb_async(
+    data: dict, db_attr: dict = None, upsert: bool = False
+):
+    """
+    `upsert` replaces a document with the same id instead of failing with a
+    409, so a redelivered message can be written again.
+    """
     try:
         db_attr = {
             "cosmos_db_url": GlobalArgs.COSMOS_DB_URL,
             "cosmos_db_name": GlobalArgs.COSMOS_DB_NAME,
             "cosmos_db_container_name": GlobalArgs.COSMOS_DB_CONTAINER_NAME,
         }
-        cosmos_client = CosmosClient(
-            url=db_attr["cosmos_db_url"], credential=_get_az_creds())
-        db_client = cosmos_client.get_database_client(
-            db_attr["cosmos_db_name"])
-        db_container = db_client.get_container_client(
-            db_attr["cosmos_db_container_name"])
-
-        db_attr = {
-            "cosmos_db_url": GlobalArgs.COSMOS_DB_URL,
-            "cosmos_db_name": GlobalArgs.COSMOS_DB_NAME,
-            "cosmos_db_container_name": GlobalArgs.COSMOS_DB_CONTAINER_NAME,
-        }
-
-        resp = db_container.create_item(body=data)
-        logging.info(
-            f"Document with id {data['id']} written to CosmosDB successfully")
+        _key = (
+            "cosmos_container",
+            db_attr["cosmos_db_url"],
+            db_attr["cosmos_db_name"],
+            db_attr["cosmos_db_container_name"],
+        )
+        async with _aio_clients.lease(
+            _key, lambda: _new_cosmos_container_aio(*_key[1:])
+        ) as db_container:
+            if upsert:
+                resp = await db_container.upsert_item(body=data)
+            else:
+                resp = await db_container.create_item(body=data)
+        logging.info(f"Document with id {data['id']} written to CosmosDB successfully")
         logging.debug(f"{resp}")
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
 
 
-def write_to_svc_bus_q(data, msg_attr, q_attr: dict = None):
+async def write_to_svc_bus_q_async(data, msg_attr, q_attr: dict = None):
     try:
         q_attr = {
             "svc_bus_fqdn": GlobalArgs.SVC_BUS_FQDN,
             "svc_bus_q_name": GlobalArgs.SVC_BUS_Q_NAME,
         }
-        with ServiceBusClient(q_attr["svc_bus_fqdn"], credential=_get_az_creds()) as client:
-            with client.get_queue_sender(q_attr["svc_bus_q_name"]) as sender:
-                # Sending a single message
-                msg_to_send = ServiceBusMessage(
-                    json.dumps(data),
-                    time_to_live=datetime.timedelta(days=1),
-                    application_properties=msg_attr
-                )
-
-                _r = sender.send_messages(msg_to_send)
-                logging.debug(f"Message sent: {json.dumps(_r)}")
+        # Sending a single message
+        msg_to_send = ServiceBusMessage(
+            _serialize(data),
+            time_to_live=datetime.timedelta(days=1),
+            application_properties=latency_stamps.stamped(msg_attr),
+        )
+        _key = ("svc_bus_q_sender", q_attr["svc_bus_fqdn"], q_attr["svc_bus_q_name"])
+        async with _aio_clients.lease(
+            _key, lambda: _new_svc_bus_q_sender_aio(*_key[1:]), exclusive=True
+        ) as sender:
+            _r = await sender.send_messages(msg_to_send)
+        logging.debug(f"Message sent: {json.dumps(_r)}")
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
 
 
-def write_to_svc_bus_topic(data, msg_attr, topic_attr: dict = None):
+async def write_to_svc_bus_topic_async(data, msg_attr, topic_attr: dict = None):
     try:
         topic_attr = {
             "svc_bus_fqdn": GlobalArgs.SVC_BUS_FQDN,
             "svc_bus_topic_name": GlobalArgs.SVC_BUS_TOPIC_NAME,
         }
-        with ServiceBusClient(topic_attr["svc_bus_fqdn"], credential=_get_az_creds()) as client:
-            with client.get_topic_sender(topic_name=topic_attr["svc_bus_topic_name"]) as sender:
-                # Sending a single message
-                msg_to_send = ServiceBusMessage(
-                    json.dumps(data),
-                    time_to_live=datetime.timedelta(days=1),
-                    application_properties=msg_attr
-                )
-
-                _r = sender.send_messages(msg_to_send)
-                logging.info(f"Event written to topic Successfully")
-                logging.debug(f"Message sent: {json.dumps(_r)}")
+        # Sending a single message
+        msg_to_send = ServiceBusMessage(
+            _serialize(data),
+            time_to_live=datetime.timedelta(days=1),
+            application_properties=latency_stamps.stamped(msg_attr),
+        )
+        _key = (
+            "svc_bus_topic_sender",
+            topic_attr["svc_bus_fqdn"],
+            topic_attr["svc_bus_topic_name"],
+        )
+        async with _aio_clients.lease(
+            _key, lambda: _new_svc_bus_topic_sender_aio(*_key[1:]), exclusive=True
+        ) as sender:
+            _r = await sender.send_messages(msg_to_send)
+        logging.info("Event written to topic Successfully")
+        logging.debug(f"Message sent: {json.dumps(_r)}")
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
 
 
-def write_to_event_hub(data, msg_attr, event_hub_attr: dict = None):
+async def write_to_event_hub_async(data, msg_attr, event_hub_attr: dict = None):
+    # Event Hub sends go through the shared partition batcher; adding to it may
+    # wait on a flush, so it runs off the loop
+    await asyncio.to_thread(write_to_event_hub, data, msg_attr, event_hub_attr)
+
+
+async def write_to_storage_q_async(data: dict, storage_q_attr: dict = None):
     try:
-        TOT_STREAM_PARTITIONS = 4
-        STREAM_PARTITION_ID = 0
-        event_hub_attr = {
-            "event_hub_fqdn": GlobalArgs.EVENT_HUB_FQDN,
-            "event_hub_name": GlobalArgs.EVENT_HUB_NAME,
+        storage_q_attr = {
+            "storage_q_account_url": GlobalArgs.STORAGE_Q_ACCOUNT_URL,
+            "q_name": GlobalArgs.Q_NAME,
         }
 
-        producer = EventHubProducerClient(
-            fully_qualified_namespace=event_hub_attr["event_hub_fqdn"],
-            eventhub_name=event_hub_attr["event_hub_name"],
-            credential=_get_az_creds()
-        )
-
-        # Partition allocation strategy: Even partitions for inventory, odd partitions for sales
-        inventory_partitions = [i for i in range(
-            TOT_STREAM_PARTITIONS) if i % 2 == 0]
-        sales_partitions = [i for i in range(
-            TOT_STREAM_PARTITIONS) if i % 2 != 0]
-
-        if msg_attr.get("event_type") == "sale_event":  # Send to sales partition
-            STREAM_PARTITION_ID = str(random.choice(sales_partitions))
-        elif msg_attr.get("event_type") == "inventory_event":  # Send to inventory partition
-            STREAM_PARTITION_ID = str(random.choice(inventory_partitions))
-
-        with producer:
-            event_data_batch = producer.create_batch(
-                partition_id=STREAM_PARTITION_ID)
-            data_str = json.dumps(data)
-            _evnt = EventData(data_str)
-            _evnt.properties = msg_attr
-            event_data_batch.add(_evnt)
-            producer.send_batch(event_data_batch)
-            logging.info(
-                f"Sent messages with payload: {data_str} to partition:{TOT_STREAM_PARTITIONS}")
+        _key = (
+            "storage_q",
+            storage_q_attr["storage_q_account_url"],
+            storage_q_attr["q_name"],
+        )
+        async with _aio_clients.lease(
+            _key, lambda: _new_storage_q_client_aio(*_key[1:])
+        ) as q_client:
+            resp = await q_client.send_message(
+                data, time_to_live=259200, visibility_timeout=60
+            )
+        logging.info(f"Message added to {storage_q_attr['q_name']} successfully")
+        return resp
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
 
 
-def write_to_storage_q(data: dict, storage_q_attr: dict = None):
-    try:
-        storage_q_attr = {
-            "storage_q_account_url": GlobalArgs.STORAGE_Q_ACCOUNT_URL,
-            "q_name": GlobalArgs.Q_NAME,
+############################################
+#             BATCHING SENDERS             #
+############################################
+
+
+class _PendingBatch:
+    """An open or failed batch for one key, and the outcome of its next send."""
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.opened_at = time.monotonic()
+        self.failed_sends = 0
+        self.last_err = None
+        self.sent = concurrent.futures.Future()
+
+
+class _LingerBatcher:
+    """
+    Base for senders that keep one open batch per key.
+
+    A batch is sent when the next item does not fit, when it reaches
+    `max_items`, or when it has been open longer than `linger_ms`. Subclasses
+    provide `_new_batch`, `_add_to_batch` and `_send_batch`.
+
+    Batches are taken off under the lock and sent outside it, one at a time
+    per key, so a slow send does not hold up `_add`. A batch that fails to
+    send is set aside for BATCH_RETRY_BACKOFF_SECS, doubled with every failed
+    send, and retried by the linger thread or a later flush, up to
+    `max_send_attempts` times; only then is it dropped, and counted in
+    `batches_dropped`. A retried batch can go out after newer ones for its
+    key. Errors raised by `flush` or a full batch reach the caller, those of
+    the linger thread are only logged.
+    """
+
+    def __init__(
+        self,
+        linger_ms: int,
+        max_items: int = 0,
+        name: str = "batcher",
+        max_send_attempts: int = None,
+    ):
+        self._linger_secs = linger_ms / 1000
+        self._max_items = max_items
+        self._name = name
+        self._max_send_attempts = (
+            max_send_attempts or GlobalArgs.BATCH_MAX_SEND_ATTEMPTS
+        )
+        self._lock = threading.RLock()
+        self._batches = {}
+        # (retry at, seq, key, pending batch), soonest first
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._sending = set()
+        self._send_locks = collections.defaultdict(threading.Lock)
+        self._flusher = None
+        self._closed = threading.Event()
+        self._stats = {
+            "batches_sent": 0,
+            "msgs_sent": 0,
+            "send_failures": 0,
+            "batches_dropped": 0,
+            "_fill_pct_sum": 0.0,
+        }
+
+    def _new_batch(self, key):
+        raise NotImplementedError
+
+    def _add_to_batch(self, batch, item):
+        """Add `item` to `batch`; raise `ValueError` if it does not fit."""
+        raise NotImplementedError
+
+    def _send_batch(self, key, batch):
+        raise NotImplementedError
+
+    @staticmethod
+    def _batch_len(batch) -> int:
+        return len(batch)
+
+    @staticmethod
+    def _batch_fill_pct(batch) -> float:
+        return 100 * batch.size_in_bytes / batch.max_size_in_bytes
+
+    def _start_flusher(self):
+        # Callers hold the lock
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._linger_loop, name=self._name, daemon=True
+            )
+            self._flusher.start()
+
+    def _add(self, key, item) -> _PendingBatch:
+        """Add `item` to the open batch for `key`, and return that batch."""
+        to_send = []
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError(f"{self._name} is closed")
+            if self._linger_secs > 0:
+                self._start_flusher()
+
+            pending = self._batches.get(key)
+            if pending is None:
+                pending = self._batches[key] = _PendingBatch(self._new_batch(key))
+            try:
+                self._add_to_batch(pending.batch, item)
+            except ValueError:
+                # Batch is full; ship it and retry on a fresh one
+                to_send.append(self._pop(key))
+                pending = self._batches[key] = _PendingBatch(self._new_batch(key))
+                self._add_to_batch(pending.batch, item)
+
+            if (
+                self._max_items and self._batch_len(pending.batch) >= self._max_items
+            ) or self._linger_secs <= 0:
+                to_send.append(self._pop(key))
+        for _pending in to_send:
+            self._send(key, _pending)
+        return pending
+
+    def _pop(self, key) -> _PendingBatch:
+        # Callers hold the lock; the batch counts as in flight until `_send` is done
+        pending = self._batches.pop(key)
+        self._sending.add(pending)
+        return pending
+
+    def _send(self, key, pending: _PendingBatch):
+        """Send a batch taken off `_batches` or `_retries`; raise if it fails."""
+        if not self._batch_len(pending.batch):
+            with self._lock:
+                self._sending.discard(pending)
+            pending.sent.set_result(None)
+            return
+        with self._lock:
+            send_lock = self._send_locks[key]
+        try:
+            with send_lock:
+                self._send_batch(key, pending.batch)
+        except Exception as e:
+            with self._lock:
+                self._sending.discard(pending)
+                self._stats["send_failures"] += 1
+                pending.failed_sends += 1
+                pending.last_err = e
+                sent, pending.sent = pending.sent, concurrent.futures.Future()
+                if pending.failed_sends < self._max_send_attempts:
+                    backoff_secs = min(
+                        GlobalArgs.BATCH_RETRY_BACKOFF_SECS
+                        * 2 ** (pending.failed_sends - 1),
+                        GlobalArgs.MAX_BACKOFF_SECS,
+                    )
+                    heapq.heappush(
+                        self._retries,
+                        (
+                            time.monotonic() + backoff_secs,
+                            next(self._retry_seq),
+                            key,
+                            pending,
+                        ),
+                    )
+                    self._start_flusher()
+                else:
+                    self._stats["batches_dropped"] += 1
+                    logging.error(
+                        f"{self._name} dropped a batch of {self._batch_len(pending.batch)} for {key} after {pending.failed_sends} failed sends: {e}"
+                    )
+            sent.set_exception(e)
+            raise
+        with self._lock:
+            self._sending.discard(pending)
+            self._stats["batches_sent"] += 1
+            self._stats["msgs_sent"] += self._batch_len(pending.batch)
+            self._stats["_fill_pct_sum"] += self._batch_fill_pct(pending.batch)
+        pending.sent.set_result(None)
+
+    def _send_pending(self, key, pending: _PendingBatch):
+        """
+        Make sure `pending`, as returned by `_add`, has been sent: send it if
+        it is still open, wait if another thread is sending it, raise if its
+        last send failed.
+        """
+        with self._lock:
+            if self._batches.get(key) is pending:
+                self._pop(key)
+            elif pending.last_err is not None and pending not in self._sending:
+                raise pending.last_err
+            else:
+                sent = pending.sent
+                pending = None
+        if pending is None:
+            sent.result()
+        else:
+            self._send(key, pending)
+
+    def _take(self, now: float = None, open_for: float = 0) -> list:
+        """
+        Take the batches open for at least `open_for` secs, and the failed
+        ones due a retry at `now`, all of them if `now` is None. Callers hold
+        the lock.
+        """
+        taken = []
+        while self._retries and (now is None or self._retries[0][0] <= now):
+            _, _, key, pending = heapq.heappop(self._retries)
+            self._sending.add(pending)
+            taken.append((key, pending))
+        _now = time.monotonic()
+        for key, pending in list(self._batches.items()):
+            if _now - pending.opened_at >= open_for:
+                taken.append((key, self._pop(key)))
+        return taken
+
+    def _linger_loop(self):
+        tick_secs = self._linger_secs / 2 if self._linger_secs > 0 else 0.1
+        while not self._closed.wait(tick_secs):
+            with self._lock:
+                due = self._take(time.monotonic(), open_for=self._linger_secs)
+            for key, pending in due:
+                try:
+                    self._send(key, pending)
+                except Exception as e:
+                    logging.error(f"{self._name} failed to flush {key}: {e}")
+
+    def _flush(self, now: float = None):
+        with self._lock:
+            in_flight = [pending.sent for pending in self._sending]
+            due = self._take(now)
+        first_err = None
+        for key, pending in due:
+            try:
+                self._send(key, pending)
+            except Exception as e:
+                first_err = first_err or e
+        # Sends the linger thread or other callers started before this flush
+        for sent in in_flight:
+            try:
+                sent.result()
+            except Exception as e:
+                first_err = first_err or e
+        if first_err is not None:
+            raise first_err
+
+    def flush(self):
+        """
+        Send every open batch, and the failed ones whose backoff is up. Waits
+        for sends already under way, and raises the first error.
+        """
+        self._flush(time.monotonic())
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            _s = dict(self._stats)
+        fill_pct_sum = _s.pop("_fill_pct_sum")
+        batches = _s["batches_sent"]
+        _s["avg_msgs_per_batch"] = round(_s["msgs_sent"] / batches, 2) if batches else 0
+        _s["avg_batch_fill_pct"] = round(fill_pct_sum / batches, 2) if batches else 0
+        _s["retries_pending"] = len(self._retries)
+        return _s
+
+    def close(self):
+        # Callers that need to see send errors call flush() themselves first.
+        # Failed batches get their last try now, backoff or not.
+        try:
+            self._flush()
+        except Exception as e:
+            logging.error(f"{self._name} dropped unsent batches on close: {e}")
+        finally:
+            self._closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SvcBusBatchSender(_LingerBatcher):
+    """
+    Collects messages for a Service Bus queue or topic into
+    `ServiceBusMessageBatch` objects and sends each batch in one round trip.
+    Application properties are kept per message. The AMQP sender is the
+    pooled aio one that `write_to_svc_bus_q_async` and
+    `write_to_svc_bus_topic_async` use, driven through `run_sync`.
+    """
+
+    def __init__(
+        self,
+        entity_type: str = "queue",
+        entity_name: str = None,
+        svc_bus_fqdn: str = None,
+        linger_ms: int = None,
+        max_msgs: int = None,
+    ):
+        if entity_type not in ("queue", "topic"):
+            raise ValueError(f"Unknown Service Bus entity type: {entity_type}")
+        super().__init__(
+            linger_ms=(
+                GlobalArgs.SVC_BUS_BATCH_LINGER_MS if linger_ms is None else linger_ms
+            ),
+            max_items=(
+                GlobalArgs.SVC_BUS_BATCH_MAX_MSGS if max_msgs is None else max_msgs
+            ),
+            name=f"svc-bus-{entity_type}-batcher",
+        )
+        svc_bus_fqdn = svc_bus_fqdn or GlobalArgs.SVC_BUS_FQDN
+        if entity_type == "queue":
+            entity_name = entity_name or GlobalArgs.SVC_BUS_Q_NAME
+            self._client_key = ("svc_bus_q_sender", svc_bus_fqdn, entity_name)
+            self._factory = lambda: _new_svc_bus_q_sender_aio(svc_bus_fqdn, entity_name)
+        else:
+            entity_name = entity_name or GlobalArgs.SVC_BUS_TOPIC_NAME
+            self._client_key = ("svc_bus_topic_sender", svc_bus_fqdn, entity_name)
+            self._factory = lambda: _new_svc_bus_topic_sender_aio(
+                svc_bus_fqdn, entity_name
+            )
+
+    async def _new_batch_async(self):
+        async with _aio_clients.lease(
+            self._client_key, self._factory, exclusive=True
+        ) as sender:
+            return await sender.create_message_batch()
+
+    async def _send_batch_async(self, batch):
+        async with _aio_clients.lease(
+            self._client_key, self._factory, exclusive=True
+        ) as sender:
+            await sender.send_messages(batch)
+
+    def _new_batch(self, key):
+        return run_sync(self._new_batch_async())
+
+    def _add_to_batch(self, batch, item):
+        batch.add_message(item)
+
+    def _send_batch(self, key, batch):
+        run_sync(self._send_batch_async(batch))
+        logging.debug(f"Sent batch of {len(batch)} messages to {self._client_key[2]}")
+
+    def send(self, data, msg_attr):
+        self._add(
+            None,
+            ServiceBusMessage(
+                _serialize(data),
+                time_to_live=datetime.timedelta(days=1),
+                application_properties=latency_stamps.stamped(msg_attr),
+            ),
+        )
+
+
+_svc_bus_batch_senders = {}
+_svc_bus_batch_senders_lock = threading.Lock()
+
+
+def get_svc_bus_batch_sender(entity_type: str = "queue") -> SvcBusBatchSender:
+    """
+    The process wide batch sender for the queue or the topic, so events of
+    concurrent requests share batches. Callers flush it, it is closed at exit.
+    """
+    sender = _svc_bus_batch_senders.get(entity_type)
+    if sender is None:
+        with _svc_bus_batch_senders_lock:
+            sender = _svc_bus_batch_senders.get(entity_type)
+            if sender is None:
+                sender = SvcBusBatchSender(entity_type)
+                _svc_bus_batch_senders[entity_type] = sender
+                _close_at_exit(sender)
+    return sender
+
+
+class EventHubBatchProducer(_LingerBatcher):
+    """
+    Long lived Event Hub producer that keeps one open `EventDataBatch` per
+    partition.
+
+    The partition count is read from the hub on first use. Events are routed
+    by a stable hash of `partition_key_field` (e.g. `store_id`), so all events
+    for a store land on one partition in order; events without the key are
+    spread round robin.
+    """
+
+    def __init__(
+        self,
+        event_hub_fqdn: str = None,
+        event_hub_name: str = None,
+        partition_key_field: str = None,
+        linger_ms: int = None,
+        max_msgs: int = None,
+    ):
+        super().__init__(
+            linger_ms=(
+                GlobalArgs.EVENT_HUB_BATCH_LINGER_MS if linger_ms is None else linger_ms
+            ),
+            max_items=(
+                GlobalArgs.EVENT_HUB_BATCH_MAX_MSGS if max_msgs is None else max_msgs
+            ),
+            name="event-hub-batcher",
+        )
+        event_hub_fqdn = event_hub_fqdn or GlobalArgs.EVENT_HUB_FQDN
+        event_hub_name = event_hub_name or GlobalArgs.EVENT_HUB_NAME
+        self._partition_key_field = (
+            GlobalArgs.EVENT_HUB_PARTITION_KEY
+            if partition_key_field is None
+            else partition_key_field
+        )
+        self._client_key = ("event_hub_producer", event_hub_fqdn, event_hub_name)
+        self._factory = lambda: _new_event_hub_producer_aio(
+            event_hub_fqdn, event_hub_name
+        )
+        self._partition_ids = None
+        self._round_robin = itertools.count()
+
+    async def _call_async(self, method: str, *args, **kwargs):
+        async with _aio_clients.lease(
+            self._client_key, self._factory, exclusive=True
+        ) as producer:
+            return await getattr(producer, method)(*args, **kwargs)
+
+    @property
+    def partition_ids(self) -> list:
+        if self._partition_ids is None:
+            self._partition_ids = run_sync(self._call_async("get_partition_ids"))
+            logging.info(f"Event Hub has {len(self._partition_ids)} partitions")
+        return self._partition_ids
+
+    def pick_partition(self, data: dict, msg_attr: dict = None) -> str:
+        _p_ids = self.partition_ids
+        _key = data.get(self._partition_key_field)
+        if _key is None and msg_attr:
+            _key = msg_attr.get(self._partition_key_field)
+        if _key is None:
+            return _p_ids[next(self._round_robin) % len(_p_ids)]
+        # crc32 is stable across processes, unlike hash()
+        return _p_ids[zlib.crc32(str(_key).encode("UTF-8")) % len(_p_ids)]
+
+    def _new_batch(self, key):
+        return run_sync(self._call_async("create_batch", partition_id=key))
+
+    def _add_to_batch(self, batch, item):
+        batch.add(item)
+
+    def _send_batch(self, key, batch):
+        run_sync(self._call_async("send_batch", batch))
+        logging.debug(f"Sent batch of {len(batch)} events to partition:{key}")
+
+    def send(self, data, msg_attr):
+        _evnt = EventData(_serialize(data))
+        _evnt.properties = msg_attr
+        self._add(self.pick_partition(data, msg_attr), _evnt)
+
+
+_event_hub_producer = None
+_event_hub_producer_lock = threading.Lock()
+
+
+def get_event_hub_producer() -> EventHubBatchProducer:
+    global _event_hub_producer
+    if _event_hub_producer is None:
+        with _event_hub_producer_lock:
+            if _event_hub_producer is None:
+                _event_hub_producer = EventHubBatchProducer()
+                _close_at_exit(_event_hub_producer)
+    return _event_hub_producer
+
+
+class _NdjsonBuffer:
+    """Newline delimited JSON lines waiting to be appended to one segment."""
+
+    def __init__(self, max_size_in_bytes: int):
+        self.max_size_in_bytes = max_size_in_bytes
+        self.buf = bytearray()
+        self.count = 0
+
+    @property
+    def size_in_bytes(self) -> int:
+        return len(self.buf)
+
+    def add(self, line: bytes):
+        if self.count and len(self.buf) + len(line) > self.max_size_in_bytes:
+            raise ValueError("NDJSON buffer has reached its size limit")
+        self.buf += line
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+
+class BlobSegmentWriter(_LingerBatcher):
+    """
+    Buffers events per `event_type=`/`dt=` partition and appends them as
+    NDJSON to append blobs, instead of one tiny blob per event.
+
+    A partition's buffer is appended as one block when it fills up or after
+    BLOB_SEGMENT_LINGER_MS. `write` returns once the event is buffered, so a
+    caller that settles messages afterwards passes `flush=True` (or uses
+    `write_batch`), which appends before returning and raises if it cannot.
+    A failed append is retried after a backoff, see `_LingerBatcher`; as
+    with redelivered messages, an event can then land twice. Appends for one
+    partition go out one at a time, so its segment state needs no lock.
+
+    A segment blob is rolled over to a new one once it grows past
+    BLOB_SEGMENT_MAX_BYTES, is older than BLOB_SEGMENT_MAX_AGE_SECS or runs
+    out of append blocks. Segments live under the same partition prefixes as
+    `write_to_blob`.
+    """
+
+    # Service limits for append blobs
+    MAX_APPEND_BLOCK_BYTES = 4 * 1024 * 1024
+    MAX_APPEND_BLOCKS = 50_000
+
+    def __init__(
+        self,
+        blob_svc_account_url: str = None,
+        container_name: str = None,
+        linger_ms: int = None,
+        segment_max_bytes: int = None,
+        segment_max_age_secs: int = None,
+    ):
+        super().__init__(
+            linger_ms=(
+                GlobalArgs.BLOB_SEGMENT_LINGER_MS if linger_ms is None else linger_ms
+            ),
+            name="blob-segment-writer",
+        )
+        self._url = blob_svc_account_url or GlobalArgs.BLOB_SVC_ACCOUNT_URL
+        self._container_name = container_name or GlobalArgs.BLOB_NAME
+        self._segment_max_bytes = segment_max_bytes or GlobalArgs.BLOB_SEGMENT_MAX_BYTES
+        self._segment_max_age_secs = (
+            segment_max_age_secs or GlobalArgs.BLOB_SEGMENT_MAX_AGE_SECS
+        )
+        self._segments = {}
+        self._stats["segments_opened"] = 0
+
+    async def _create_append_blob_async(self, blob_name):
+        async with _aio_clients.lease(
+            ("blob_svc", self._url), lambda: _new_blob_svc_client_aio(self._url)
+        ) as blob_svc_client:
+            blob_client = blob_svc_client.get_blob_client(
+                container=self._container_name, blob=blob_name
+            )
+            await blob_client.create_append_blob()
+        return blob_client
+
+    def _open_segment(self, partition_prefix):
+        blob_name = f"{partition_prefix}/{datetime.datetime.now().strftime('%s%f')}_{uuid.uuid4().hex[:8]}.ndjson"
+        blob_client = run_sync(self._create_append_blob_async(blob_name))
+        with self._lock:
+            self._stats["segments_opened"] += 1
+        logging.info(f"Opened blob segment {blob_name}")
+        return {
+            "blob_client": blob_client,
+            "bytes": 0,
+            "blocks": 0,
+            "opened_at": time.monotonic(),
+        }
+
+    def _segment_for(self, partition_prefix, incoming_bytes):
+        seg = self._segments.get(partition_prefix)
+        if (
+            seg is None
+            or seg["bytes"] + incoming_bytes > self._segment_max_bytes
+            or seg["blocks"] >= self.MAX_APPEND_BLOCKS
+            or time.monotonic() - seg["opened_at"] > self._segment_max_age_secs
+        ):
+            seg = self._segments[partition_prefix] = self._open_segment(
+                partition_prefix
+            )
+        return seg
+
+    def _new_batch(self, key):
+        return _NdjsonBuffer(self.MAX_APPEND_BLOCK_BYTES)
+
+    def _add_to_batch(self, batch, item):
+        batch.add(item)
+
+    def _send_batch(self, key, batch):
+        seg = self._segment_for(key, batch.size_in_bytes)
+        try:
+            run_sync(seg["blob_client"].append_block(bytes(batch.buf)))
+        except Exception:
+            # Start a fresh segment next time rather than appending to a blob in an unknown state
+            self._segments.pop(key, None)
+            raise
+        seg["bytes"] += batch.size_in_bytes
+        seg["blocks"] += 1
+        logging.debug(f"Appended {len(batch)} events to {seg['blob_client'].blob_name}")
+
+    def _write(self, data: dict, payload: bytes = None) -> tuple:
+        # A pre-serialized payload is reused unless it would break the NDJSON lines
+        if payload and b"\n" not in payload:
+            line = payload + b"\n"
+        else:
+            line = _serialize(data) + b"\n"
+        key = _blob_partition_prefix(data)
+        return key, self._add(key, line)
+
+    def write(self, data: dict, payload: bytes = None, flush: bool = False):
+        key, pending = self._write(data, payload)
+        if flush:
+            self._send_pending(key, pending)
+
+    def write_batch(self, docs: list):
+        """
+        Write `docs` and append them before returning, so a consumer can
+        settle its messages afterwards. Raises if any of their batches, sent
+        here or by the linger thread meanwhile, failed.
+        """
+        pending = {}
+        for data in docs:
+            key, _pending = self._write(data)
+            pending[id(_pending)] = (key, _pending)
+        first_err = None
+        for key, _pending in pending.values():
+            try:
+                self._send_pending(key, _pending)
+            except Exception as e:
+                first_err = first_err or e
+        if first_err is not None:
+            raise first_err
+
+
+_blob_segment_writer = None
+_blob_segment_writer_lock = threading.Lock()
+
+
+def get_blob_segment_writer() -> BlobSegmentWriter:
+    global _blob_segment_writer
+    if _blob_segment_writer is None:
+        with _blob_segment_writer_lock:
+            if _blob_segment_writer is None:
+                _blob_segment_writer = BlobSegmentWriter()
+                _close_at_exit(_blob_segment_writer)
+    return _blob_segment_writer
+
+
+############################################
+#           COSMOS BULK WRITER             #
+############################################
+
+
+class CosmosBulkWriter:
+    """
+    Upserts many documents concurrently through the pooled aio container
+    client, the one `write_to_cosmosdb_async` uses.
+
+    The number of upserts in flight adapts to the account: it grows by one
+    after every `concurrency` successful calls, and halves on a 429 or when
+    the RUs charged over the last second exceed `target_ru_per_sec`. It
+    halves at most once a second, as the calls already in flight still
+    report on the old level. A 429 is retried after the server's
+    `x-ms-retry-after-ms` hint.
+
+    Keep one writer per container, see `get_cosmos_bulk_writer`, so what it
+    learns carries over from one batch to the next.
+    """
+
+    RU_WINDOW_SECS = 1.0
+
+    def __init__(
+        self,
+        max_concurrency: int = None,
+        target_ru_per_sec: float = None,
+        max_retries: int = 5,
+        db_attr: dict = None,
+    ):
+        db_attr = db_attr or {
+            "cosmos_db_url": GlobalArgs.COSMOS_DB_URL,
+            "cosmos_db_name": GlobalArgs.COSMOS_DB_NAME,
+            "cosmos_db_container_name": GlobalArgs.COSMOS_DB_CONTAINER_NAME,
         }
+        self._client_key = (
+            "cosmos_container",
+            db_attr["cosmos_db_url"],
+            db_attr["cosmos_db_name"],
+            db_attr["cosmos_db_container_name"],
+        )
+        self._max_concurrency = (
+            max_concurrency or GlobalArgs.COSMOS_BULK_MAX_CONCURRENCY
+        )
+        self._target_ru_per_sec = (
+            GlobalArgs.COSMOS_BULK_TARGET_RU_PER_SEC
+            if target_ru_per_sec is None
+            else target_ru_per_sec
+        )
+        self._max_retries = max_retries
+        self._cond = threading.Condition()
+        self._concurrency = max(1, self._max_concurrency // 4)
+        self._in_flight = 0
+        self._successes_since_change = 0
+        self._last_backoff = float("-inf")
+        self._ru_window = collections.deque()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_concurrency, thread_name_prefix="cosmos-bulk"
+        )
+
+    def _acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self._concurrency):
+                self._cond.wait()
+            self._in_flight += 1
 
-        q_svc_client = QueueServiceClient(
-            storage_q_attr["storage_q_account_url"], credential=_get_az_creds())
-        q_client = q_svc_client.get_queue_client(storage_q_attr["q_name"])
-        resp = q_client.send_message(
-            data, time_to_live=259200, visibility_timeout=60)
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def _ru_per_sec(self, now) -> float:
+        while self._ru_window and now - self._ru_window[0][0] > self.RU_WINDOW_SECS:
+            self._ru_window.popleft()
+        return sum(ru for _, ru in self._ru_window)
+
+    def _on_success(self, request_charge: float, stats: dict):
+        now = time.monotonic()
+        with self._cond:
+            stats["docs_written"] += 1
+            stats["tot_ru"] += request_charge
+            self._ru_window.append((now, request_charge))
+            if (
+                self._target_ru_per_sec
+                and self._ru_per_sec(now) > self._target_ru_per_sec
+            ):
+                self._backoff(now)
+                return
+            self._successes_since_change += 1
+            if self._successes_since_change >= self._concurrency:
+                self._concurrency = min(self._concurrency + 1, self._max_concurrency)
+                self._successes_since_change = 0
+                self._cond.notify()
+
+    def _backoff(self, now: float):
+        if now - self._last_backoff < self.RU_WINDOW_SECS:
+            return
+        self._last_backoff = now
+        self._concurrency = max(1, self._concurrency // 2)
+        self._successes_since_change = 0
+
+    async def _upsert_async(self, doc, headers: dict):
+        async with _aio_clients.lease(
+            self._client_key, lambda: _new_cosmos_container_aio(*self._client_key[1:])
+        ) as db_container:
+            await db_container.upsert_item(
+                body=doc, response_hook=lambda h, _: headers.update(h)
+            )
+
+    def _upsert(self, doc, stats: dict):
+        _headers = {}
+        for attempt in range(self._max_retries + 1):
+            self._acquire()
+            try:
+                run_sync(self._upsert_async(doc, _headers))
+                self._on_success(float(_headers.get("x-ms-request-charge", 0)), stats)
+                return
+            except CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt == self._max_retries:
+                    raise
+                retry_after_ms = float(
+                    (e.headers or {}).get("x-ms-retry-after-ms", 100 * 2**attempt)
+                )
+                with self._cond:
+                    stats["throttled"] += 1
+                    self._backoff(time.monotonic())
+                _metrics.add("retries.cosmos")
+            finally:
+                self._release()
+            time.sleep(retry_after_ms / 1000)
+
+    def upsert_all(self, docs: list) -> dict:
+        _r = {"status": False, "doc_count": len(docs)}
+        # This call's counts; concurrent calls share the writer's limits
+        stats = {"docs_written": 0, "failed_docs": 0, "throttled": 0, "tot_ru": 0.0}
+        start_time = time.monotonic()
+        futures = [self._pool.submit(self._upsert, d, stats) for d in docs]
+        for f in concurrent.futures.as_completed(futures):
+            if f.exception():
+                stats["failed_docs"] += 1
+                logging.error(f"Cosmos upsert failed: {f.exception()}")
+        duration = time.monotonic() - start_time
+        _r.update(stats)
+        _r["tot_ru"] = round(stats["tot_ru"], 2)
+        _r["duration_secs"] = round(duration, 3)
+        _r["docs_per_sec"] = (
+            round(stats["docs_written"] / duration, 2) if duration else 0
+        )
+        _r["ru_per_sec"] = round(stats["tot_ru"] / duration, 2) if duration else 0
+        _r["final_concurrency"] = self._concurrency
+        _r["status"] = not stats["failed_docs"]
+        return _r
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class CosmosBulkWriteError(Exception):
+    """Some documents of a bulk upsert failed; `resp` has the writer's stats."""
+
+    def __init__(self, resp: dict):
+        self.resp = resp
+        super().__init__(
+            f"{resp['failed_docs']} of {resp['doc_count']} documents failed to upsert"
+        )
+
+
+def get_cosmos_bulk_writer(db_attr: dict = None) -> CosmosBulkWriter:
+    """The process wide bulk writer for a container, from the client registry."""
+    db_attr = db_attr or {
+        "cosmos_db_url": GlobalArgs.COSMOS_DB_URL,
+        "cosmos_db_name": GlobalArgs.COSMOS_DB_NAME,
+        "cosmos_db_container_name": GlobalArgs.COSMOS_DB_CONTAINER_NAME,
+    }
+    _key = (
+        "cosmos_bulk_writer",
+        db_attr["cosmos_db_url"],
+        db_attr["cosmos_db_name"],
+        db_attr["cosmos_db_container_name"],
+    )
+
+    def _new_writer():
+        writer = CosmosBulkWriter(db_attr=db_attr)
+        return writer, [writer]
+
+    return _clients.get(_key, _new_writer)
+
+
+def write_to_cosmosdb_bulk(docs: list, db_attr: dict = None) -> dict:
+    """
+    Upsert `docs`, raising `CosmosBulkWriteError` if any of them failed.
+    Upserts are idempotent, so the caller can simply retry the whole batch.
+    """
+    try:
+        resp = get_cosmos_bulk_writer(db_attr).upsert_all(docs)
         logging.info(
-            f"Message added to {storage_q_attr['q_name']} successfully")
+            f"Upserted {resp['docs_written']} of {resp['doc_count']} documents to CosmosDB, {resp['tot_ru']} RUs"
+        )
+        if resp["failed_docs"]:
+            raise CosmosBulkWriteError(resp)
+        return resp
+    except Exception as e:
+        logging.exception(f"ERROR:{str(e)}")
+        raise e
+
+
+############################################
+#           FAN-OUT DISPATCHER             #
+############################################
+
+
+class SinkSpec:
+    """
+    One sink for `SinkDispatcher`. `fn(data, msg_attr)` writes the event (or a
+    list of events, if the sink takes batches). Timeout, required flag and
+    in-flight cap can be overridden per sink name through the SINK_CONFIG
+    env var, e.g. `{"cosmos": {"timeout": 5, "required": false}}`.
+    """
+
+    def __init__(
+        self,
+        fn,
+        timeout: float = None,
+        required: bool = True,
+        max_in_flight: int = None,
+    ):
+        self.fn = fn
+        self.timeout = timeout or GlobalArgs.SINK_TIMEOUT_SECS
+        self.required = required
+        self.max_in_flight = max_in_flight or GlobalArgs.SINK_MAX_IN_FLIGHT
+
+
+class SinkDispatchError(Exception):
+    def __init__(self, results: dict):
+        self.results = results
+        failed = [
+            n for n, r in results.items() if r["required"] and r["status"] != "ok"
+        ]
+        super().__init__(f"Required sinks failed: {', '.join(failed)}")
+
+
+_sink_pool = None
+_sink_pool_lock = threading.Lock()
+# Running calls per sink name, across dispatchers; they all share the pool
+_sink_in_flight = collections.Counter()
+_sink_in_flight_lock = threading.Lock()
+
+
+def _get_sink_pool():
+    global _sink_pool
+    if _sink_pool is None:
+        with _sink_pool_lock:
+            if _sink_pool is None:
+                _sink_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=GlobalArgs.SINK_POOL_WORKERS,
+                    thread_name_prefix="sink",
+                )
+    return _sink_pool
+
+
+class SinkDispatcher:
+    """
+    Sends each event to all configured sinks at the same time on a shared
+    thread pool, so the end to end latency is that of the slowest sink rather
+    than the sum of all of them.
+
+    `dispatch` returns per-sink results and raises `SinkDispatchError` when a
+    required sink fails or times out. Optional sinks only show up in the
+    results.
+
+    A timed out call is cancelled if it has not started yet. One that has
+    started cannot be stopped and keeps its pool thread until it returns;
+    once a sink has `max_in_flight` such calls, new ones to it fail fast as
+    `overloaded`, so a hung sink cannot take over the shared pool.
+
+    SINK_CONFIG, or `config`, is applied on the first dispatch. Invalid
+    overrides are logged and the sink defaults are used.
+    """
+
+    def __init__(self, sinks: dict, config: dict = None):
+        self._specs = sinks
+        self._config = config
+        self._sinks = None
+        self._lock = threading.Lock()
+        self._stats = {
+            n: {"ok": 0, "error": 0, "timeout": 0, "overloaded": 0} for n in sinks
+        }
+
+    @staticmethod
+    def _load_config() -> dict:
+        try:
+            _c = json.loads(GlobalArgs.SINK_CONFIG) if GlobalArgs.SINK_CONFIG else {}
+            if not isinstance(_c, dict):
+                raise ValueError("SINK_CONFIG must be a JSON object")
+            return _c
+        except ValueError as e:
+            logging.error(f"Ignoring invalid SINK_CONFIG, using defaults: {e}")
+            return {}
+
+    def _resolve(self) -> dict:
+        if self._sinks is None:
+            with self._lock:
+                if self._sinks is None:
+                    self._sinks = self._apply_config(
+                        self._load_config() if self._config is None else self._config
+                    )
+        return self._sinks
+
+    def _apply_config(self, overrides: dict) -> dict:
+        sinks = {}
+        for name, spec in self._specs.items():
+            try:
+                _o = overrides.get(name) or {}
+                sinks[name] = SinkSpec(
+                    spec.fn,
+                    timeout=float(_o.get("timeout", spec.timeout)),
+                    required=bool(_o.get("required", spec.required)),
+                    max_in_flight=int(_o.get("max_in_flight", spec.max_in_flight)),
+                )
+            except (AttributeError, TypeError, ValueError) as e:
+                logging.error(f"Ignoring invalid SINK_CONFIG for {name}: {e}")
+                sinks[name] = spec
+        return sinks
+
+    @staticmethod
+    def _timed(name, fn, data, msg_attr, ctx):
+        # Pool threads do not inherit the caller's context, the span's parent
+        token = otel_context.attach(ctx)
+        try:
+            with _tracer.start_as_current_span(f"sink.{name}"):
+                start_time = time.perf_counter()
+                try:
+                    fn(data, msg_attr)
+                finally:
+                    duration = time.perf_counter() - start_time
+                    _metrics.record(f"sink.{name}", duration)
+                return round(duration * 1000, 3)
+        finally:
+            otel_context.detach(token)
+
+    def _submit(self, pool, name, spec, data, msg_attr, ctx):
+        """Submit a call to `name`, or return None if it has too many running."""
+        with _sink_in_flight_lock:
+            if _sink_in_flight[name] >= spec.max_in_flight:
+                return None
+            _sink_in_flight[name] += 1
+
+        def _done(_):
+            with _sink_in_flight_lock:
+                _sink_in_flight[name] -= 1
+
+        f = pool.submit(self._timed, name, spec.fn, data, msg_attr, ctx)
+        f.add_done_callback(_done)
+        return f
+
+    def dispatch(self, data, msg_attr: dict = None) -> dict:
+        sinks = self._resolve()
+        pool = _get_sink_pool()
+        start_time = time.monotonic()
+        ctx = otel_context.get_current()
+        futures = {
+            name: self._submit(pool, name, spec, data, msg_attr, ctx)
+            for name, spec in sinks.items()
+        }
+        results = {}
+        for name, f in futures.items():
+            spec = sinks[name]
+            _res = {"required": spec.required}
+            if f is None:
+                _res["status"] = "overloaded"
+                _res["err"] = f"{spec.max_in_flight} calls still running"
+                results[name] = _res
+                continue
+            try:
+                remaining = spec.timeout - (time.monotonic() - start_time)
+                _res["duration_ms"] = f.result(timeout=max(remaining, 0))
+                _res["status"] = "ok"
+            except concurrent.futures.TimeoutError:
+                # Only frees the pool slot if the call has not started
+                f.cancel()
+                _res["status"] = "timeout"
+                _res["err"] = f"No response within {spec.timeout}s"
+            except Exception as e:
+                _res["status"] = "error"
+                _res["err"] = f"{type(e).__name__}: {str(e)}"
+            results[name] = _res
+
+        with self._lock:
+            for name, _res in results.items():
+                self._stats[name][_res["status"]] += 1
+                if _res["status"] != "ok":
+                    self._stats[name]["last_err"] = _res["err"]
+                    _metrics.add(f"errors.sink.{name}")
+
+        if any(r["required"] and r["status"] != "ok" for r in results.values()):
+            raise SinkDispatchError(results)
+        return results
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {n: dict(s) for n, s in self._stats.items()}
+
+
+############################################
+#           CONSUMER UTILITIES             #
+############################################
+
+# Consumers persist each message to blob and cosmos in parallel. The second
+# argument is the event's original JSON, when the caller still has it. Either
+# sink may have gone through when the other fails and the message comes back,
+# so cosmos upserts.
+_consumer_sinks = SinkDispatcher(
+    {
+        # Messages are settled after dispatch, so segments are appended first
+        "blob": SinkSpec(lambda d, raw: write_to_blob(d, payload=raw, flush=True)),
+        "cosmos": SinkSpec(lambda d, _: write_to_cosmosdb(d, upsert=True)),
+    }
+)
+
+
+async def _write_blobs_async(docs: list):
+    _r = await asyncio.gather(
+        *(write_to_blob_async(d) for d in docs), return_exceptions=True
+    )
+    errs = [e for e in _r if isinstance(e, Exception)]
+    if errs:
+        raise RuntimeError(
+            f"{len(errs)} of {len(docs)} blob writes failed, first: {errs[0]}"
+        ) from errs[0]
+
+
+def write_to_blob_batch(docs: list):
+    """
+    Write a batch the way BLOB_WRITE_MODE says, like `write_to_blob` does:
+    appended to NDJSON segments, one block per partition, or one blob per
+    event, uploaded concurrently. Returns once all of it is written, so the
+    caller can settle its messages.
+    """
+    try:
+        if GlobalArgs.BLOB_WRITE_MODE == "segment":
+            get_blob_segment_writer().write_batch(docs)
+        else:
+            run_sync(_write_blobs_async(docs))
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
+
+
+async def _write_poison_msgs_async(poison: list):
+    _url = GlobalArgs.BLOB_SVC_ACCOUNT_URL
+    _dt = datetime.datetime.now().strftime("%Y_%m_%d")
+    async with _aio_clients.lease(
+        ("blob_svc", _url), lambda: _new_blob_svc_client_aio(_url)
+    ) as blob_svc_client:
+        for p in poison:
+            blob_client = blob_svc_client.get_blob_client(
+                container=GlobalArgs.BLOB_NAME,
+                blob=f"{GlobalArgs.POISON_PREFIX}/dt={_dt}/{p['message_id']}.json",
+            )
+            await blob_client.upload_blob(
+                _serialize(
+                    {
+                        "message_id": p["message_id"],
+                        "err": p["err"],
+                        "body": p["body"].decode("UTF-8", errors="replace"),
+                    }
+                ),
+                overwrite=True,
+            )
+
+
+def write_poison_msgs(poison: list):
+    """
+    Park poison messages, `{"message_id", "err", "body"}`, as one blob each
+    under POISON_PREFIX. A batch trigger settles the whole batch at once, so
+    single messages cannot be dead-lettered from it; this keeps them from
+    being completed with the batch and lost. Blobs are named by message id,
+    so a redelivered batch overwrites rather than duplicates them.
+    """
+    if not poison:
+        return
+    try:
+        run_sync(_write_poison_msgs_async(poison))
+        logging.warning(f"Parked {len(poison)} poison messages")
+    except Exception as e:
+        logging.exception(f"ERROR:{str(e)}")
+        raise e
+
+
+def _write_cosmos_batch(docs: list, out: dict):
+    try:
+        out["cosmos"] = write_to_cosmosdb_bulk(docs)
+    except CosmosBulkWriteError as e:
+        # Keep the stats of a partial failure in the response too
+        out["cosmos"] = e.resp
+        raise
+
+
+# Batch consumers hand the whole list of parsed events to each sink. The
+# second argument collects per-sink details, e.g. the cosmos bulk stats.
+_consumer_batch_sinks = SinkDispatcher(
+    {
+        "blob": SinkSpec(
+            lambda docs, _: write_to_blob_batch(docs),
+            timeout=GlobalArgs.BATCH_SINK_TIMEOUT_SECS,
+        ),
+        "cosmos": SinkSpec(
+            _write_cosmos_batch,
+            timeout=GlobalArgs.BATCH_SINK_TIMEOUT_SECS,
+        ),
+    }
+)
+
+
+def _svc_bus_msg_to_event(msg) -> dict:
+    """
+    The received message, with its properties, as it is persisted. Raises
+    `EventDecodeError` for poison messages, the ones no retry can fix.
+    """
+    received_at_us = latency_stamps.utc_now_us()
+    recv_event = {}
+    recv_event["id"] = msg.message_id
+    _raw = b"".join(msg.body)
+    _metrics.add("bytes_received", len(_raw))
+    # With random failures on, events without a store_id are poison pills
+    with _metrics.time("parse"):
+        recv_event["body"] = event_codec.decode_event(
+            _raw, validate=bool(GlobalArgs.TRIGGER_RANDOM_FAILURES)
+        )
+    recv_event["content_type"] = msg.content_type
+    recv_event["delivery_count"] = msg.delivery_count
+    recv_event["partition_key"] = msg.partition_key
+    recv_event["reply_to"] = msg.reply_to
+    recv_event["reply_to_session_id"] = msg.reply_to_session_id
+    recv_event["session_id"] = msg.session_id
+    recv_event["time_to_live"] = isodate.duration_isoformat(msg.time_to_live)
+    recv_event["to"] = msg.to
+    # Latency stamps are ints, everything else the producer sets is a string
+    recv_event["user_properties"] = {
+        key.decode(): value.decode() if isinstance(value, bytes) else value
+        for key, value in (msg.application_properties or {}).items()
+    }
+    recv_event["event_type"] = recv_event["user_properties"].get("event_type")
+
+    try:
+        produced_at_us = latency_stamps.to_utc_us(recv_event["body"]["ts"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise event_codec.EventDecodeError(f"Event has no valid ts: {e}")
+    recv_event["processing_time"] = round((received_at_us - produced_at_us) / 1e6, 6)
+    recv_event["latency_stamps"] = latency_stamps.msg_stamps(
+        recv_event["user_properties"],
+        msg.enqueued_time_utc,
+        received_at_us,
+        ts=produced_at_us,
+    )
+    return recv_event
+
+
+def _classify_msg(err: Exception = None) -> str:
+    """
+    "valid" when processing went through, "poison" when the message itself is
+    bad and is dead-lettered, "transient" for anything a retry may fix.
+    """
+    if err is None:
+        return "valid"
+    if isinstance(err, event_codec.EventDecodeError):
+        return "poison"
+    return "transient"
+
+
+def _count_msg_class(msg_class: str):
+    _metrics.add(
+        {"valid": "events_consumed", "poison": "poison_msgs"}.get(msg_class, "retries")
+    )
+
+
+def _retry_backoff_secs(msg) -> float:
+    _retries = max((msg.delivery_count or 1) - 1, 0)
+    return min(
+        GlobalArgs.SVC_BUS_RETRY_BACKOFF_SECS * 2**_retries,
+        GlobalArgs.MAX_BACKOFF_SECS,
+    )
+
+
+def _dead_letter(receiver, msg, err: Exception):
+    logging.warning(f"Dead-lettering poison message {msg.message_id}: {err}")
+    receiver.dead_letter_message(
+        msg, reason="PoisonMessage", error_description=str(err)
+    )
+
+
+def _abandon_due(receiver, retries: list, now: float = None):
+    """Abandon the held `(abandon_at, seq, msg)` retries that are due, or all."""
+    while retries and (now is None or retries[0][0] <= now):
+        _, _, msg = heapq.heappop(retries)
+        try:
+            with _metrics.time("settle"):
+                receiver.abandon_message(msg)
+        except MessageLockLostError as e:
+            # Too late to settle, the message will be delivered again
+            _metrics.add("lock_lost")
+            logging.warning(f"Lock lost on message {msg.message_id}: {e}")
+
+
+def read_from_svc_bus_q(max_msgs=GlobalArgs.MAX_MSGS_TO_PROCESS):
+    if GlobalArgs.SVC_BUS_RECEIVER_MODE == "concurrent":
+        return SvcBusConcurrentReceiver().run(max_msgs)
+
+    _r = {
+        "status": False,
+        "event_process_duration": 0,
+        "max_msg_count": max_msgs,
+        "exit_msg": "",
+    }
+    backoff_time = 1
+    # maximum backoff time in seconds
+    max_backoff_secs = GlobalArgs.MAX_BACKOFF_SECS
+    success_msg_count = 0
+    retrieved_msg_count = 0
+    msg_classes = {"valid": 0, "poison": 0, "transient": 0}
+    # (abandon_at, seq, msg) of transient failures waiting out their backoff
+    retries = []
+    retry_seq = itertools.count()
+
+    # Start timing the event generation
+    event_process_start_time = time.time()
+    metrics_cp = _metrics.checkpoint()
+
+    with ServiceBusClient(
+        GlobalArgs.SVC_BUS_FQDN, credential=_get_az_creds()
+    ) as client, AutoLockRenewer(
+        max_lock_renewal_duration=GlobalArgs.SVC_BUS_LOCK_RENEWAL_SECS
+    ) as renewer:
+        with client.get_queue_receiver(GlobalArgs.SVC_BUS_Q_NAME) as receiver:
+
+            while success_msg_count < max_msgs:
+                try:
+                    _abandon_due(receiver, retries, time.monotonic())
+                    # Only wait briefly while a held retry may come due
+                    with _metrics.time("receive"):
+                        recv_msgs = receiver.receive_messages(
+                            max_message_count=1, max_wait_time=1 if retries else 5
+                        )
+                    if not recv_msgs and retries:
+                        continue
+                    if not recv_msgs:
+                        if backoff_time >= max_backoff_secs:
+                            logging.info(
+                                f"Current backoff time:{backoff_time} exceeds max backoff timereached. Exiting."
+                            )
+                            _r["exit_msg"] = (
+                                f"Current backoff time:{backoff_time} exceeds max backoff timereached. Exiting."
+                            )
+                            break  # Exit the loop if max backoff is reached
+                        logging.info(
+                            "No messages received. Current backoff time: %s seconds. Time to reset: %s seconds.",
+                            backoff_time,
+                            max_backoff_secs - backoff_time,
+                        )
+                        time.sleep(backoff_time)
+                        # exponential backoff with maximum
+                        backoff_time = min(backoff_time * 2, max_backoff_secs)
+                    else:
+                        backoff_time = 1  # reset backoff time on successful receive
+                        retrieved_msg_count += 1
+
+                    for msg in recv_msgs:
+                        try:
+                            recv_event = _svc_bus_msg_to_event(msg)
+
+                            _event_log.info(
+                                "Received: %s of %s messages: %s",
+                                success_msg_count,
+                                max_msgs,
+                                LazyJson(recv_event),
+                            )
+
+                            # Write to blob and Cosmos DB
+                            _consumer_sinks.dispatch(recv_event)
+                            latency_stamps.record_hops(recv_event["latency_stamps"])
+                            err = None
+                        except Exception as e:
+                            err = e
+
+                        msg_class = _classify_msg(err)
+                        msg_classes[msg_class] += 1
+                        _count_msg_class(msg_class)
+                        if msg_class == "transient":
+                            # Held, not slept on: the loop goes on receiving
+                            # while the renewer keeps the lock
+                            _delay = _retry_backoff_secs(msg)
+                            logging.warning(
+                                f"Message {msg.message_id} failed, abandoning it in {_delay}s: {err}"
+                            )
+                            renewer.register(receiver, msg)
+                            heapq.heappush(
+                                retries,
+                                (time.monotonic() + _delay, next(retry_seq), msg),
+                            )
+                            continue
+                        with _metrics.time("settle"):
+                            if msg_class == "valid":
+                                receiver.complete_message(msg)
+                                success_msg_count += 1
+                            else:
+                                # Settled for good, it never comes back to stall the loop
+                                _dead_letter(receiver, msg, err)
+                except Exception as e:
+                    logging.error(f"Error receiving message: {e}")
+            # The run is over, retries go back to the queue without waiting
+            _abandon_due(receiver, retries)
+    event_process_end_time = time.time()  # Stop timing the event generation
+    event_process_duration = (
+        event_process_end_time - event_process_start_time
+    )  # Calculate the duration
+    _r["status"] = True
+    _r["event_process_duration"] = round(event_process_duration)
+    _r["retrieved_msg_count"] = retrieved_msg_count
+    _r["success_msg_count"] = success_msg_count
+    _r["msg_classes"] = msg_classes
+    _r["metrics"] = _metrics.snapshot(since=metrics_cp)
+    _r["cred_stats"] = get_cred_stats()
+    logging.info(
+        "Received: %s of %s messages. Max msg count or Max backoff %s reached, exiting",
+        success_msg_count,
+        max_msgs,
+        backoff_time,
+    )
+    return _r
+
+
+def _process_svc_bus_msg(msg):
+    recv_event = _svc_bus_msg_to_event(msg)
+    # Write to blob and Cosmos DB
+    _consumer_sinks.dispatch(recv_event)
+    latency_stamps.record_hops(recv_event["latency_stamps"])
+
+
+class SvcBusConcurrentReceiver:
+    """
+    Drains a queue with a prefetching receiver and a bounded worker pool.
+
+    Messages are received up to `recv_batch` at a time, with `prefetch` more
+    buffered by the SDK, and processed on `workers` threads. Each message's
+    lock is renewed until it is settled. Settling stays on the receiving
+    thread, as the receiver is not thread safe, and goes in receive order:
+    processed messages are completed and poison messages dead-lettered.
+    Messages that failed transiently are held, with their locks renewed,
+    and abandoned once their retry backoff is up, so they do not hold up
+    the ones behind them.
+    """
+
+    def __init__(
+        self,
+        process_fn=None,
+        q_name: str = None,
+        svc_bus_fqdn: str = None,
+        prefetch: int = None,
+        recv_batch: int = None,
+        workers: int = None,
+        max_wait_secs: float = None,
+        max_lock_renewal_secs: float = None,
+    ):
+        self.process_fn = process_fn or _process_svc_bus_msg
+        self.q_name = q_name or GlobalArgs.SVC_BUS_Q_NAME
+        self.svc_bus_fqdn = svc_bus_fqdn or GlobalArgs.SVC_BUS_FQDN
+        self.prefetch = GlobalArgs.SVC_BUS_PREFETCH if prefetch is None else prefetch
+        self.recv_batch = recv_batch or GlobalArgs.SVC_BUS_RECV_BATCH
+        self.workers = workers or GlobalArgs.SVC_BUS_RECV_WORKERS
+        self.max_wait_secs = max_wait_secs or GlobalArgs.SVC_BUS_RECV_MAX_WAIT_SECS
+        self.max_lock_renewal_secs = (
+            max_lock_renewal_secs or GlobalArgs.SVC_BUS_LOCK_RENEWAL_SECS
+        )
+        # Received but not yet settled, the rest waits in the prefetch buffer
+        self.max_in_flight = self.workers * 2
+        self._lock = threading.Lock()
+        # A redelivered message has the same id but a higher delivery count
+        self._lock_lost = set()
+        self._stats = {
+            "received": 0,
+            "completed": 0,
+            "dead_lettered": 0,
+            "abandoned": 0,
+        }
+        self._msg_classes = {"valid": 0, "poison": 0, "transient": 0}
+        # (abandon_at, seq, msg) of transient failures waiting out their backoff
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._max_in_flight_seen = 0
+
+    def _on_lock_lost(self, msg, err=None):
+        with self._lock:
+            self._lock_lost.add((msg.message_id, msg.delivery_count))
+        _metrics.add("lock_lost")
+        logging.warning(f"Lock lost on message {msg.message_id}: {err}")
+
+    def _settle(self, receiver, msg, future):
+        err = future.exception()
+        msg_class = _classify_msg(err)
+        self._msg_classes[msg_class] += 1
+        _count_msg_class(msg_class)
+        if msg_class == "transient":
+            _delay = _retry_backoff_secs(msg)
+            logging.warning(
+                f"Message {msg.message_id} failed, abandoning it in {_delay}s: {err}"
+            )
+            heapq.heappush(
+                self._retries,
+                (time.monotonic() + _delay, next(self._retry_seq), msg),
+            )
+            return
+        self._settle_as(receiver, msg, msg_class, err)
+
+    def _settle_as(self, receiver, msg, msg_class: str, err: Exception = None):
+        try:
+            with _metrics.time("settle"):
+                self._settle_msg(receiver, msg, msg_class, err)
+        except MessageLockLostError as e:
+            # Too late to settle, the message will be delivered again
+            self._on_lock_lost(msg, e)
+            return
+        _outcome = {"valid": "completed", "poison": "dead_lettered"}
+        self._stats[_outcome.get(msg_class, "abandoned")] += 1
+
+    @staticmethod
+    def _settle_msg(receiver, msg, msg_class: str, err: Exception = None):
+        if msg_class == "valid":
+            receiver.complete_message(msg)
+        elif msg_class == "poison":
+            _dead_letter(receiver, msg, err)
+        else:
+            receiver.abandon_message(msg)
+
+    def _abandon_due(self, receiver, now: float = None):
+        while self._retries and (now is None or self._retries[0][0] <= now):
+            _, _, msg = heapq.heappop(self._retries)
+            self._settle_as(receiver, msg, "transient")
+
+    def get_stats(self, elapsed: float) -> dict:
+        with self._lock:
+            lock_lost = len(self._lock_lost)
+        return {
+            **self._stats,
+            "msg_classes": dict(self._msg_classes),
+            "lock_lost": lock_lost,
+            "msgs_per_sec": (
+                round(self._stats["completed"] / elapsed, 2) if elapsed else None
+            ),
+            "max_in_flight": self._max_in_flight_seen,
+            "prefetch": self.prefetch,
+            "recv_batch": self.recv_batch,
+            "workers": self.workers,
+        }
+
+    def run(self, max_msgs: int = None) -> dict:
+        max_msgs = max_msgs or GlobalArgs.MAX_MSGS_TO_PROCESS
+        _r = {
+            "status": False,
+            "receiver_mode": "concurrent",
+            "event_process_duration": 0,
+            "max_msg_count": max_msgs,
+            "exit_msg": "",
+        }
+        backoff_time = 1
+        max_backoff_secs = GlobalArgs.MAX_BACKOFF_SECS
+        in_flight = collections.deque()
+        start_time = time.monotonic()
+        metrics_cp = _metrics.checkpoint()
+
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="svc-bus-recv"
+        )
+        renewer = AutoLockRenewer(
+            max_lock_renewal_duration=self.max_lock_renewal_secs,
+            on_lock_renew_failure=self._on_lock_lost,
+        )
+        try:
+            with ServiceBusClient(
+                self.svc_bus_fqdn, credential=_get_az_creds()
+            ) as client, client.get_queue_receiver(
+                self.q_name, prefetch_count=self.prefetch
+            ) as receiver:
+                while True:
+                    # Settle whatever is done, in receive order
+                    while in_flight and in_flight[0][1].done():
+                        self._settle(receiver, *in_flight.popleft())
+                    self._abandon_due(receiver, time.monotonic())
+                    # Held retries keep their locks, so they count as in flight
+                    unsettled = len(in_flight) + len(self._retries)
+
+                    received = self._stats["received"]
+                    if received >= max_msgs:
+                        break
+                    room = min(
+                        self.recv_batch,
+                        self.max_in_flight - unsettled,
+                        max_msgs - received,
+                    )
+                    if room <= 0 and in_flight:
+                        concurrent.futures.wait([in_flight[0][1]], timeout=1)
+                        continue
+                    if room <= 0:
+                        time.sleep(
+                            min(max(self._retries[0][0] - time.monotonic(), 0), 1)
+                        )
+                        continue
+
+                    # Only wait briefly while there is something left to settle
+                    with _metrics.time("receive"):
+                        recv_msgs = receiver.receive_messages(
+                            max_message_count=room,
+                            max_wait_time=1 if unsettled else self.max_wait_secs,
+                        )
+                    if not recv_msgs:
+                        if unsettled:
+                            continue
+                        if backoff_time >= max_backoff_secs:
+                            _r["exit_msg"] = (
+                                f"Current backoff time:{backoff_time} exceeds max backoff time. Exiting."
+                            )
+                            logging.info(_r["exit_msg"])
+                            break
+                        logging.info(
+                            f"No messages received. Current backoff time: {backoff_time} seconds."
+                        )
+                        time.sleep(backoff_time)
+                        backoff_time = min(backoff_time * 2, max_backoff_secs)
+                        continue
+
+                    backoff_time = 1
+                    for msg in recv_msgs:
+                        renewer.register(receiver, msg)
+                        in_flight.append((msg, pool.submit(self.process_fn, msg)))
+                    self._stats["received"] += len(recv_msgs)
+                    self._max_in_flight_seen = max(
+                        self._max_in_flight_seen, unsettled + len(recv_msgs)
+                    )
+
+                # Settle the rest before the receiver closes
+                while in_flight:
+                    msg, future = in_flight.popleft()
+                    concurrent.futures.wait([future])
+                    self._settle(receiver, msg, future)
+                # The run is over, retries go back to the queue without waiting
+                self._abandon_due(receiver)
+            _r["status"] = True
+        except Exception as e:
+            # Unsettled messages are redelivered once their locks expire
+            logging.exception(f"ERROR:{str(e)}")
+            _r["err_msg"] = f"ERROR: {type(e).__name__}: {str(e)}"
+        finally:
+            renewer.close()
+            pool.shutdown(wait=True)
+
+        elapsed = time.monotonic() - start_time
+        _r["event_process_duration"] = round(elapsed, 3)
+        _r["retrieved_msg_count"] = self._stats["received"]
+        _r["success_msg_count"] = self._stats["completed"]
+        _r["msg_classes"] = dict(self._msg_classes)
+        _r["receiver"] = self.get_stats(elapsed)
+        _r["metrics"] = _metrics.snapshot(since=metrics_cp)
+        _r["cred_stats"] = get_cred_stats()
+        logging.info(f"{json.dumps(_r['receiver'])}")
+        return _r
+
+
+class ParsedQMsg:
+    """
+    A Functions Service Bus message, decoded and parsed once. Logging and
+    every sink share `body`; `raw` is the original JSON for sinks that can
+    store it as is instead of serializing `body` again. With `validate`,
+    poison pills raise `EventDecodeError` while being parsed.
+    """
+
+    __slots__ = ("msg", "raw", "body", "received_at_us")
+
+    def __init__(self, msg: func.ServiceBusMessage, validate: bool = True):
+        self.received_at_us = latency_stamps.utc_now_us()
+        self.msg = msg
+        self.raw = msg.get_body()
+        _metrics.add("bytes_received", len(self.raw))
+        with _metrics.time("parse"):
+            self.body = event_codec.decode_event(self.raw, validate=validate)
+
+    def processing_time(self) -> float:
+        """Seconds from the event's `ts` to its receipt, to the microsecond."""
+        produced_at_us = latency_stamps.to_utc_us(self.body["ts"])
+        return round((self.received_at_us - produced_at_us) / 1e6, 6)
+
+    def stamps(self) -> dict:
+        return latency_stamps.msg_stamps(
+            self.msg.user_properties,
+            self.msg.enqueued_time_utc,
+            self.received_at_us,
+            ts=self.body.get("ts"),
+        )
+
+    def metadata(self) -> dict:
+        msg = self.msg
+        return {
+            "message_id": msg.message_id,
+            "body": self.body,
+            "content_type": msg.content_type,
+            "delivery_count": msg.delivery_count,
+            "expiration_time": (
+                msg.expiration_time.isoformat() if msg.expiration_time else None
+            ),
+            "label": msg.label,
+            "partition_key": msg.partition_key,
+            "reply_to": msg.reply_to,
+            "reply_to_session_id": msg.reply_to_session_id,
+            "scheduled_enqueue_time": (
+                msg.scheduled_enqueue_time.isoformat()
+                if msg.scheduled_enqueue_time
+                else None
+            ),
+            "session_id": msg.session_id,
+            "time_to_live": msg.time_to_live,
+            "to": msg.to,
+            "user_properties": msg.user_properties,
+            "event_type": msg.user_properties.get("event_type"),
+        }
+
+
+def process_q_msg(msg: func.ServiceBusMessage) -> str:
+    _a_resp = {
+        "status": False,
+        "miztiik_event_processed": False,
+        "last_processed_on": None,
+    }
+
+    try:
+        # With random failures on, poison pills fail right in the parse
+        with _tracer.start_as_current_span("parse"):
+            parsed = ParsedQMsg(msg, validate=bool(GlobalArgs.TRIGGER_RANDOM_FAILURES))
+
+        # Calculate processing time
+        processing_time = parsed.processing_time()
+
+        # Pretty printing the whole message is only worth it when someone reads it
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            _m = parsed.metadata()
+            _m["processing_time"] = processing_time
+            logging.debug(
+                "recv_msg:\n %s", json.dumps(_m, indent=4, sort_keys=True, default=str)
+            )
+
+        # write to blob and cosmosdb
+        _a_resp["sink_results"] = _consumer_sinks.dispatch(parsed.body, parsed.raw)
+        _a_resp["hops"] = latency_stamps.record_hops(parsed.stamps())
+
+        _a_resp["status"] = True
+        _a_resp["miztiik_event_processed"] = True
+        _a_resp["last_processed_on"] = datetime.datetime.now().isoformat()
+        _a_resp["processing_time"] = processing_time
+        _metrics.add("events_consumed")
+
+    except Exception as e:
+        _metrics.add("errors.consume")
+        logging.exception(f"ERROR:{str(e)}")
+
+    _event_log.info("%s", LazyJson(_a_resp))
+
+
+def process_event_hub_evnts(event: func.EventHubEvent) -> str:
+    _a_resp = {
+        "status": False,
+        "miztiik_event_processed": False,
+        "last_processed_on": None,
+    }
+
+    try:
+        recv_body = event_codec.loads(event.get_body())
+        recv_body["event_type"] = event.metadata["Properties"].get("event_type")
+
+        # Formatted only if the sampler keeps the record
+        _event_log.info(
+            "recv_event: %s",
+            LazyJson(
+                {
+                    "recv_body": recv_body,
+                    "enqueued_time_utc": str(event.enqueued_time),
+                    "seq_no": event.sequence_number,
+                    "offset": event.offset,
+                    "event_property": event.metadata["Properties"],
+                    "metadata": event.metadata,
+                    "event_type": event.metadata["Properties"].get("event_type"),
+                    "event_from_partition": event.metadata["PartitionContext"].get(
+                        "PartitionId"
+                    ),
+                }
+            ),
+        )
+
+        # write to blob and cosmosdb
+        _a_resp["sink_results"] = _consumer_sinks.dispatch(recv_body)
+
+        _a_resp["status"] = True
+        _a_resp["miztiik_event_processed"] = True
+        _a_resp["last_processed_on"] = datetime.datetime.now().isoformat()
+
+    except Exception as e:
+        logging.exception(f"ERROR:{str(e)}")
+
+    _event_log.info("%s", LazyJson(_a_resp))
@@ -1,31 +1,30 @@
-from flask import Flask, request, jsonify, render_template, make_response
+from flask import Flask, request, jsonify, render_template, make_response, abort
 
-from store_events_producer import evnt_producer
+from store_events_producer import evnt_producer_async
 
-from az_utils import (
-    _get_az_creds,
-    write_to_blob,
-    write_to_cosmosdb,
-    write_to_svc_bus_q,
-    write_to_svc_bus_topic,
-    write_to_event_hub,
-    read_from_svc_bus_q,
-)
+from az_utils import read_from_svc_bus_q, run_sync
 
 
 from datetime import datetime
-import socket
-import os
+from host_identity import get_host_identity
+from log_pipeline import configure_logging
+from profiling import ProfilerBusy, RequestProfile, profiling_enabled, sample_window
 import json
 
 app = Flask(__name__)
 app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
 
+# Resolve the host identity at startup, not on the first request
+get_host_identity()
+# Per worker, gunicorn imports the app after forking
+configure_logging()
+
 
 @app.route("/")
 def index():
-    hostname = socket.gethostname()
-    ip_address = socket.gethostbyname(hostname)
+    _host = get_host_identity()
+    hostname = _host.hostname
+    ip_address = _host.ip
     current_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     _resp = make_response(
         render_template(
@@ -41,7 +40,15 @@ def index():
 @app.route("/event-producer", methods=["GET"])
 def event_producer():
     resp_data = dict()
-    events = evnt_producer(event_cnt=3)
+    # Runs on the shared aio loop, so the aio clients live across requests
+    # ?profile=1 attaches cProfile stats, only when ENABLE_PROFILING is set
+    if profiling_enabled() and request.args.get("profile"):
+        with RequestProfile() as prof:
+            # cProfile goes on the loop's thread, where the producer runs
+            events = run_sync(prof.profiled(evnt_producer_async(event_cnt=3)))
+        resp_data["profile"] = prof.stats
+    else:
+        events = run_sync(evnt_producer_async(event_cnt=3))
     # resp_data["IDENTITY_ENDPOINT"] = os.getenv('IDENTITY_ENDPOINT')
     # resp_data["IDENTITY_HEADER"] = os.getenv('IDENTITY_HEADER')
 
@@ -52,16 +59,50 @@ def event_producer():
 @app.route("/event-consumer", methods=["GET"])
 def event_consumer():
     resp_data = dict()
-    resp_data = read_from_svc_bus_q()
+    if profiling_enabled() and request.args.get("profile"):
+        with RequestProfile() as prof:
+            resp_data = read_from_svc_bus_q()
+        resp_data["profile"] = prof.stats
+    else:
+        resp_data = read_from_svc_bus_q()
     return jsonify(resp_data)
 
 
+_PROFILE_TARGETS = {
+    "event-producer": lambda: run_sync(evnt_producer_async(event_cnt=3)),
+    "event-consumer": read_from_svc_bus_q,
+}
+
+
+@app.route("/profile/<target>", methods=["GET"])
+def profile(target):
+    """
+    Sample an endpoint's work for `secs` and return the folded stacks,
+    ready for flamegraph.pl or speedscope. 404 unless ENABLE_PROFILING is set.
+    """
+    if not profiling_enabled() or target not in _PROFILE_TARGETS:
+        abort(404)
+    try:
+        prof = sample_window(
+            _PROFILE_TARGETS[target],
+            request.args.get("secs", 10, type=float),
+            request.args.get("interval_ms", type=float),
+        )
+    except ProfilerBusy as e:
+        return str(e), 409
+    app.logger.info(json.dumps({"profile": target, **prof.get_stats()}))
+    _resp = make_response(prof.collapsed())
+    _resp.mimetype = "text/plain"
+    _resp.headers["Content-Disposition"] = f"attachment; filename={target}.folded"
+    return _resp
+
+
 @app.after_request
 def add_custom_headers(response):
     response.headers["remote_addr"] = request.remote_addr
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["X-Response-Tag"] = (
-        f"{socket.gethostname()} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        f"{get_host_identity().hostname} at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
     response.headers["X-Miztiik-Automation"] = "True"
     response.headers["X-Brand-Tag"] = "Empowering Innovations & Equitable Growth"
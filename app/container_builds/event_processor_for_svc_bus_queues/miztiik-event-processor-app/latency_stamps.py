@@ -0,0 +1,135 @@
+import os
+import time
+import datetime
+import threading
+
+from stage_metrics import get_stage_metrics
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-22"
+    # How often the monotonic clock is re-anchored to the (NTP disciplined) wall clock
+    CLOCK_RESYNC_SECS = float(os.getenv("CLOCK_RESYNC_SECS", 60))
+
+
+# Application properties carrying the stamps, as UTC epoch microseconds
+PRODUCED_AT = "produced_at_us"
+SENT_AT = "sent_at_us"
+
+# Every stamp a message can pick up on its way, in order
+STAMPS = ("produced", "sent", "enqueued", "received", "committed")
+
+_metrics = get_stage_metrics()
+
+
+class _UtcClock:
+    """
+    UTC microseconds, read off the monotonic clock. The offset to the wall
+    clock is taken every CLOCK_RESYNC_SECS, so stamps follow NTP without
+    jumping when the wall clock is stepped, and they never go backwards.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_us = 0
+        self._resync()
+
+    def _resync(self):
+        self._synced_at_ns = time.perf_counter_ns()
+        self._offset_ns = time.time_ns() - self._synced_at_ns
+
+    def now_us(self) -> int:
+        now_ns = time.perf_counter_ns()
+        with self._lock:
+            if now_ns - self._synced_at_ns > GlobalArgs.CLOCK_RESYNC_SECS * 1e9:
+                self._resync()
+            self._last_us = max((now_ns + self._offset_ns) // 1000, self._last_us)
+            return self._last_us
+
+
+_clock = _UtcClock()
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def utc_now_us() -> int:
+    return _clock.now_us()
+
+
+def utc_isoformat(us: int = None) -> str:
+    """ISO 8601 with microseconds and an explicit +00:00 offset."""
+    us = utc_now_us() if us is None else us
+    # Integer arithmetic, a float timestamp can be a microsecond off
+    return (_EPOCH + datetime.timedelta(microseconds=us)).isoformat(
+        timespec="microseconds"
+    )
+
+
+def to_utc_us(value) -> int:
+    """
+    UTC epoch microseconds from a stamp, a datetime or an ISO string. Naive
+    values, e.g. `ts` from older producers or broker times, are taken as UTC.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, (bytes, str)):
+        if isinstance(value, bytes):
+            value = value.decode()
+        if value.isdigit():
+            return int(value)
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return (value - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def stamped(msg_attr: dict, key: str = SENT_AT) -> dict:
+    """A copy of `msg_attr` with `key` set to now; sinks share the original."""
+    return {**(msg_attr or {}), key: utc_now_us()}
+
+
+def msg_stamps(
+    props: dict, enqueued_time=None, received_at_us: int = None, ts=None
+) -> dict:
+    """
+    The stamps a received message carries, plus the broker's and ours. The
+    event's `ts` stands in for `produced_at_us` on messages without it.
+    """
+    _p = props or {}
+    return {
+        "produced": to_utc_us(_p.get(PRODUCED_AT) or ts),
+        "sent": to_utc_us(_p.get(SENT_AT)),
+        "enqueued": to_utc_us(enqueued_time),
+        "received": received_at_us or utc_now_us(),
+    }
+
+
+def hop_latencies(stamps: dict, committed_at_us: int = None) -> dict:
+    """
+    Seconds between consecutive stamps, e.g. `produced_to_sent`, plus
+    `end_to_end`. A stamp that is missing is skipped over, so an older
+    producer without `sent_at_us` gives `produced_to_enqueued` instead.
+    """
+    _s = {**stamps, "committed": committed_at_us or utc_now_us()}
+    present = [(name, _s[name]) for name in STAMPS if _s.get(name) is not None]
+    hops = {
+        f"{a}_to_{b}": (b_us - a_us) / 1e6
+        for (a, a_us), (b, b_us) in zip(present, present[1:])
+    }
+    if len(present) > 1:
+        hops["end_to_end"] = (present[-1][1] - present[0][1]) / 1e6
+    return hops
+
+
+def record_hops(stamps: dict, committed_at_us: int = None) -> dict:
+    """
+    Record each hop into the `hop.<name>` histogram. Hops between hosts use
+    two clocks; one that comes out negative is skew, it is recorded as 0 and
+    counted under `clock_skew.<name>`.
+    """
+    hops = hop_latencies(stamps, committed_at_us)
+    for name, secs in hops.items():
+        if secs < 0:
+            _metrics.add(f"clock_skew.{name}")
+        _metrics.record(f"hop.{name}", secs)
+    return hops
@@ -0,0 +1,154 @@
+import json
+import math
+import datetime
+
+import numpy as np
+
+
+class AliasTable:
+    """Vose alias table, O(1) draws per sample from a fixed discrete distribution."""
+
+    def __init__(self, weights):
+        w = np.asarray(weights, dtype=np.float64)
+        if w.ndim != 1 or not len(w) or (w < 0).any() or w.sum() <= 0:
+            raise ValueError("Alias table needs a non empty list of weights >= 0")
+        n = len(w)
+        scaled = w * n / w.sum()
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Whatever is left over is 1.0 up to rounding
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        col = rng.integers(0, len(self.prob), size=n)
+        keep = rng.random(n) < self.prob[col]
+        return np.where(keep, col, self.alias[col])
+
+
+def _zipf_weights(n: int, s: float) -> np.ndarray:
+    return 1.0 / np.arange(1, n + 1, dtype=np.float64) ** s
+
+
+class _IntRange:
+    """Uniform or Zipf skewed ints in [min, max], hot keys scattered over the range."""
+
+    def __init__(self, spec: dict, lo: int, hi: int, name: str):
+        self.lo = int(spec.get("min", lo))
+        self.hi = int(spec.get("max", hi))
+        if self.hi < self.lo:
+            raise ValueError(f"{name}: max is below min")
+        zipf_s = spec.get("zipf_s")
+        self.table = self.rank_to_value = None
+        if zipf_s:
+            size = self.hi - self.lo + 1
+            self.table = AliasTable(_zipf_weights(size, float(zipf_s)))
+            # Fixed shuffle, so the hottest keys are not simply the lowest ones
+            perm_rng = np.random.default_rng(spec.get("shuffle_seed", 0))
+            self.rank_to_value = self.lo + perm_rng.permutation(size)
+
+    def sample(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        if self.table is None:
+            return rng.integers(self.lo, self.hi + 1, size=n)
+        return self.rank_to_value[self.table.sample(rng, n)]
+
+
+class WorkloadProfile:
+    """
+    Declarative event distributions, compiled once into alias tables so each
+    field costs O(1) per sample. Fields missing from the spec keep the
+    generator's built in `defaults`; `vocabs` maps each categorical field to
+    its list of values.
+
+    Example spec:
+        {
+            "name": "hot_skus",
+            "event_mix": {"sale_event": 0.9, "inventory_event": 0.1},
+            "poison_rate": 0.02,
+            "return_rate": 0.5,
+            "store_id": {"min": 1, "max": 50, "zipf_s": 1.1},
+            "sku": {"zipf_s": 1.2},
+            "cust_id": {"min": 100, "max": 99999},
+            "weights": {"category": {"Mobiles": 5, "Laptops": 3}},
+            "payload_bytes": {"min": 512, "max": 4096},
+            "seasonality": {"hourly": [0.2, 0.1, ..., 1.5]},
+            "bursts": {"every_secs": 300, "duration_secs": 20, "multiplier": 5}
+        }
+    """
+
+    def __init__(self, spec: dict, vocabs: dict, defaults: dict):
+        self.name = spec.get("name", "custom")
+        self.spec = spec
+        self.vocabs = vocabs
+
+        mix = spec.get("event_mix", defaults["event_mix"])
+        self.event_mix = self._table("event_mix", vocabs["event_type"], mix)
+        self.poison_rate = float(spec.get("poison_rate", defaults["poison_rate"]))
+        self.return_rate = float(spec.get("return_rate", 0.5))
+
+        self.ints = {
+            name: _IntRange(spec.get(name, {}), lo, hi, name)
+            for name, (lo, hi) in defaults["int_ranges"].items()
+        }
+        # Categorical fields without weights stay uniform over their vocab
+        self.weights = {}
+        for field, w in spec.get("weights", {}).items():
+            if field not in vocabs:
+                raise ValueError(f"weights: unknown field {field}")
+            self.weights[field] = self._table(field, vocabs[field], w)
+
+        payload = spec.get("payload_bytes", {})
+        self.payload_bytes = (int(payload.get("min", 0)), int(payload.get("max", 0)))
+
+        hourly = spec.get("seasonality", {}).get("hourly")
+        self.hourly = None
+        if hourly:
+            if len(hourly) != 24:
+                raise ValueError("seasonality.hourly needs 24 weights")
+            # Normalized to a mean of 1, so the target rate stays the daily average
+            self.hourly = np.asarray(hourly, dtype=np.float64) * 24 / sum(hourly)
+        self.bursts = spec.get("bursts")
+
+    @staticmethod
+    def _table(field: str, vocab: list, weights: dict) -> AliasTable:
+        unknown = set(weights) - set(vocab)
+        if unknown:
+            raise ValueError(f"{field}: unknown values {sorted(unknown)}")
+        return AliasTable([float(weights.get(v, 0)) for v in vocab])
+
+    @classmethod
+    def from_file(cls, path: str, vocabs: dict, defaults: dict):
+        with open(path, "r") as f:
+            return cls(json.load(f), vocabs, defaults)
+
+    def sample_choice(self, field: str, rng, n: int) -> np.ndarray:
+        """Indices into the field's vocab."""
+        table = self.weights.get(field)
+        if table is None:
+            return rng.integers(0, len(self.vocabs[field]), size=n)
+        return table.sample(rng, n)
+
+    def sample_payload_bytes(self, rng, n: int) -> np.ndarray:
+        lo, hi = self.payload_bytes
+        if hi <= 0:
+            return np.zeros(n, dtype=np.int32)
+        return rng.integers(lo, hi + 1, size=n, dtype=np.int32)
+
+    def rate_multiplier(self, elapsed: float) -> float:
+        """Seasonality and burst storm factor for `RateScheduler(shape=...)`."""
+        m = 1.0
+        if self.hourly is not None:
+            m *= self.hourly[datetime.datetime.now().hour]
+        b = self.bursts
+        if b and math.fmod(elapsed, b["every_secs"]) < b["duration_secs"]:
+            m *= float(b["multiplier"])
+        return m
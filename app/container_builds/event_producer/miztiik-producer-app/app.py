@@ -1,17 +1,21 @@
 from flask import Flask, jsonify, render_template
 
-from event_producer import evnt_producer
+from event_producer import GlobalArgs, evnt_producer, sharded_evnt_producer
 import json
 from datetime import datetime
-import socket
+from host_identity import get_host_identity
 
 app = Flask(__name__)
 
+# Resolve the host identity at startup, not on the first request
+get_host_identity()
+
 
 @app.route('/')
 def index():
-    hostname = socket.gethostname()
-    ip_address = socket.gethostbyname(hostname)
+    _host = get_host_identity()
+    hostname = _host.hostname
+    ip_address = _host.ip
     current_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return render_template('index.html', hostname=hostname, ip_address=ip_address, current_date=current_date)
 
@@ -19,7 +23,10 @@ def index():
 @app.route('/event-producer', methods=['GET'])
 def event_producer():
     events = None
-    events = evnt_producer()
+    if GlobalArgs.PRODUCER_WORKERS == 1:
+        events = evnt_producer()
+    else:
+        events = sharded_evnt_producer()
     return jsonify(events)
 
 # Remove the following code block:
@@ -0,0 +1,172 @@
+import os
+import json
+import logging
+from typing import TypedDict
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-16"
+    # auto | orjson | msgspec | stdlib; auto picks the fastest one installed
+    JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+
+
+############################################
+#                 SCHEMA                   #
+############################################
+
+
+class _StoreEventRequired(TypedDict):
+    store_id: int
+    ts: str
+
+
+class StoreEvent(_StoreEventRequired, total=False):
+    """
+    A store event as `generate_event` emits it. Only `store_id` and `ts` are
+    required, poison pills are the events without a `store_id`.
+    """
+
+    id: str
+    event_type: str
+    store_fqdn: str
+    store_ip: str
+    cust_id: int
+    category: str
+    sku: int
+    price: float
+    qty: int
+    currency: str
+    discount: int
+    gift_wrap: bool
+    variant: str
+    priority_shipping: bool
+    is_promoted: bool
+    payment_method: str
+    contact_me: str
+    is_return: bool
+    # Only on poison pills and on events of profiles with larger payloads
+    bad_msg: bool
+    padding: str
+
+
+_REQUIRED_TYPES = {
+    name: StoreEvent.__annotations__[name] for name in StoreEvent.__required_keys__
+}
+
+
+class EventDecodeError(ValueError):
+    """The payload is not JSON, or not a valid `StoreEvent`."""
+
+
+############################################
+#                BACKENDS                  #
+############################################
+
+
+def _stdlib_backend():
+    # Compact and UTF-8, so the bytes match the fast backends
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=str)
+
+    def dumps(obj) -> bytes:
+        return _encoder.encode(obj).encode("UTF-8")
+
+    return dumps, json.loads, (ValueError, TypeError)
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=str)
+
+    return dumps, orjson.loads, (orjson.JSONDecodeError, TypeError)
+
+
+def _msgspec_backend():
+    import msgspec
+
+    _encoder = msgspec.json.Encoder(enc_hook=str)
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+        return _decoder.decode(data)
+
+    return _encoder.encode, loads, (msgspec.DecodeError, TypeError)
+
+
+_BACKENDS = {
+    "orjson": _orjson_backend,
+    "msgspec": _msgspec_backend,
+    "stdlib": _stdlib_backend,
+}
+
+
+def _load_backend(name: str):
+    if name != "auto":
+        return name, _BACKENDS[name]()
+    for name, backend in _BACKENDS.items():
+        try:
+            return name, backend()
+        except ImportError:
+            continue
+
+
+BACKEND, (_dumps, _loads, _decode_errors) = _load_backend(GlobalArgs.JSON_CODEC)
+logging.debug(f"JSON codec backend: {BACKEND}")
+
+
+############################################
+#                  CODEC                   #
+############################################
+
+
+def dumps(obj) -> bytes:
+    """Compact UTF-8 JSON; values JSON has no type for are written as `str()`."""
+    return _dumps(obj)
+
+
+def loads(data):
+    """Parse JSON from bytes or str."""
+    try:
+        return _loads(data)
+    except _decode_errors as e:
+        raise EventDecodeError(f"Body is not JSON: {e}")
+
+
+def validate_event(evnt) -> StoreEvent:
+    """Check the required fields, raising `EventDecodeError` for poison pills."""
+    if not isinstance(evnt, dict):
+        raise EventDecodeError("Body is not a JSON object")
+    if evnt.get("bad_msg"):
+        raise EventDecodeError("Event is flagged as bad_msg")
+    for name, _type in _REQUIRED_TYPES.items():
+        value = evnt.get(name)
+        if value is None:
+            raise EventDecodeError(f"Event has no {name}")
+        # bool is an int in python, so it is ruled out explicitly
+        if not isinstance(value, _type) or isinstance(value, bool):
+            raise EventDecodeError(f"Event {name} is not {_type.__name__}")
+    return evnt
+
+
+def decode_event(data, validate: bool = True) -> StoreEvent:
+    """
+    Parse one event. The required fields are checked on the parsed dict
+    straight away, so poison pills fail here instead of in a second pass.
+    Fields outside the schema are kept as they are.
+    """
+    evnt = loads(data)
+    if validate:
+        validate_event(evnt)
+    return evnt
+
+
+def encode_event(evnt: StoreEvent) -> bytes:
+    return _dumps(evnt)
+
+
+def encode_ndjson(evnts) -> bytes:
+    return b"".join(_dumps(evnt) + b"\n" for evnt in evnts)
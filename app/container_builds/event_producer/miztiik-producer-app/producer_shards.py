@@ -0,0 +1,104 @@
+import os
+import time
+import random
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from rate_scheduler import RateScheduler
+
+
+# Per-shard fields passed on to the merged response
+_SHARD_SUMMARY_KEYS = (
+    "shard_id",
+    "seq_range",
+    "seed",
+    "tot_msgs",
+    "event_gen_duration",
+    "rate",
+    "status",
+    "err_msg",
+)
+
+
+def get_pacer(default_eps: float = 0, share: float = 1.0) -> RateScheduler:
+    """
+    Pacer for one producer loop: TARGET_EVENTS_PER_SEC, else `default_eps`,
+    scaled by `share`, the loop's part of the events when sharded, so that
+    the shards together keep to the target rate.
+    """
+    pacer = RateScheduler.from_env(
+        default_eps=default_eps,
+        shape=None if share == 1 else (lambda elapsed: share),
+    )
+    pacer.burst = max(1, int(pacer.burst * share))
+    return pacer
+
+
+def plan_shards(workers: int, event_cnt: int, base_seed=None) -> list:
+    """
+    Split `event_cnt` events into at most `workers` contiguous shards. Shard N
+    is seeded with `base_seed` + N, random when unset, and gets its part of
+    the events as `rate_share`.
+    """
+    workers = max(1, min(workers, event_cnt))
+    if base_seed is None:
+        base_seed = random.SystemRandom().randrange(2**32)
+    else:
+        base_seed = int(base_seed)
+
+    shards = []
+    start = 0
+    for shard_id in range(workers):
+        cnt = event_cnt // workers + (1 if shard_id < event_cnt % workers else 0)
+        shards.append(
+            {
+                "shard_id": shard_id,
+                "start": start,
+                "event_cnt": cnt,
+                "seed": base_seed + shard_id,
+                "rate_share": cnt / event_cnt,
+            }
+        )
+        start += cnt
+    return shards
+
+
+def run_shards(shard_worker, workers: int, event_cnt: int, base_seed=None) -> dict:
+    """
+    Run `shard_worker(shard)` for each of `plan_shards(...)` in its own
+    process, one producer loop per core, and merge their counters into the
+    `evnt_producer` response shape. `shard_worker` must be a module level
+    function, so the worker processes can import it.
+    """
+    workers = workers or os.cpu_count()
+    shards = plan_shards(workers, event_cnt, base_seed)
+
+    resp = {"status": False, "tot_msgs": 0, "event_sample": None}
+    event_gen_start_time = time.time()
+    try:
+        # spawn, so workers do not inherit the parent's threads and sockets
+        with ProcessPoolExecutor(
+            max_workers=len(shards), mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            results = list(pool.map(shard_worker, shards))
+
+        for shard, r in zip(shards, results):
+            r["shard_id"] = shard["shard_id"]
+            r["seq_range"] = [shard["start"], shard["start"] + shard["event_cnt"]]
+            r["seed"] = shard["seed"]
+        for k in ("tot_msgs", "bad_msgs", "sale_evnts", "inventory_evnts", "tot_sales"):
+            resp[k] = sum(r.get(k, 0) for r in results)
+        resp["event_sample"] = next(
+            (r.get("event_sample") for r in results if r.get("event_sample")), None
+        )
+        resp["event_gen_duration"] = time.time() - event_gen_start_time
+        resp["status"] = all(r.get("status") for r in results)
+        resp["shards"] = [
+            {k: r.get(k) for k in _SHARD_SUMMARY_KEYS if k in r} for r in results
+        ]
+    except Exception as e:
+        logging.exception(f"ERROR: {type(e).__name__}: {str(e)}")
+        resp["err_msg"] = f"ERROR: {type(e).__name__}: {str(e)}"
+
+    return resp
@@ -1,14 +1,18 @@
 from flask import Flask, render_template
 from datetime import datetime
-import socket
+from host_identity import get_host_identity
 
 app = Flask(__name__)
 
+# Resolve the host identity at startup, not on the first request
+get_host_identity()
+
 
 @app.route('/')
 def index():
-    hostname = socket.gethostname()
-    ip_address = socket.gethostbyname(hostname)
+    _host = get_host_identity()
+    hostname = _host.hostname
+    ip_address = _host.ip
     current_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return render_template('index.html', hostname=hostname, ip_address=ip_address, current_date=current_date)
 
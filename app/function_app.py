@@ -3,41 +3,31 @@ import os
 import logging
 import json
 import datetime
+from typing import List
 
-from store_events_producer import evnt_producer
-from store_events_consumer import process_q_msg
-from az_utils import _get_az_creds, write_to_blob, write_to_cosmosdb, write_to_svc_bus_q, write_to_svc_bus_topic, write_to_event_hub
-
-
-from opentelemetry import trace
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
+from store_events_producer import evnt_producer_async
+from store_events_consumer import process_q_msgs
+from az_utils import read_from_svc_bus_q, run_sync
+from log_pipeline import configure_logging
+from profiling import ProfilerBusy, RequestProfile, profiling_enabled, sample_window
+from tracing import get_meter_provider, get_tracer
 
 
 app = func.FunctionApp()
 
+# Provider, sampler and exporter are set up once per worker process
+tracer = get_tracer(__name__)
+# Stage latencies and counters, exported on their own interval
+get_meter_provider()
+# LOG_MODE=queued moves log formatting and writes off the invocation threads
+configure_logging()
+
 
 class GlobalArgs:
     OWNER = "Mystique"
     VERSION = "2024-01-04"
 
 
-def configure_tracer(svc_name):
-    trace.set_tracer_provider(TracerProvider(
-        resource=Resource.create({"service.name": svc_name})))
-    tracer = trace.get_tracer(__name__)
-
-    # This is the exporter that sends data to Application Insights
-    span_exporter = AzureMonitorTraceExporter(
-        connection_string=os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
-    )
-    span_processor = BatchSpanProcessor(span_exporter)
-    trace.get_tracer_provider().add_span_processor(span_processor)
-    return tracer
-
-
 @app.function_name(name="greeter")
 # Run midnight everyday
 # @app.schedule(schedule="0 0 * * * *", arg_name="timer", run_on_startup=True)
@@ -77,7 +67,7 @@ def http_greeter(req: func.HttpRequest) -> func.HttpResponse:
 
 @app.function_name(name="store_events_producer")
 @app.route(route="miztiik_automation/store_events_producer", methods=["GET", "POST"], auth_level=func.AuthLevel.ANONYMOUS)
-def store_events_producer(req: func.HttpRequest, context) -> func.HttpResponse:
+async def store_events_producer(req: func.HttpRequest, context) -> func.HttpResponse:
     recv_cnt = 0
     _d = {
         "miztiik_event_processed": False,
@@ -94,15 +84,19 @@ def store_events_producer(req: func.HttpRequest, context) -> func.HttpResponse:
         except ValueError:
             pass
 
-        # Setting up tracing
-        producer_tracer = configure_tracer(context.function_name)
-
-        with producer_tracer.start_as_current_span(f"miztiik-event-producer-trace") as span:
+        with tracer.start_as_current_span("miztiik-event-producer-trace") as span:
+            span.set_attribute("faas.name", context.function_name)
             span.set_attribute("event_count", _d["event_count"])
             ###############################################################
             #                       Generate Events                       #
             ###############################################################
-            resp = evnt_producer(_d["event_count"])
+            # ?profile=1 attaches cProfile stats, only when ENABLE_PROFILING is set
+            if profiling_enabled() and req.params.get("profile"):
+                with RequestProfile() as prof:
+                    resp = await evnt_producer_async(_d["event_count"])
+                _d["profile"] = prof.stats
+            else:
+                resp = await evnt_producer_async(_d["event_count"])
             _d["resp"] = resp
 
         if resp.get("status"):
@@ -121,28 +115,60 @@ def store_events_producer(req: func.HttpRequest, context) -> func.HttpResponse:
     )
 
 
+@app.function_name(name="store_events_profiler")
+@app.route(route="miztiik_automation/profile", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def store_events_profiler(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Sample the producer or the queue consumer for `secs` and return the
+    folded stacks, ready for flamegraph.pl or speedscope.
+    """
+    if not profiling_enabled():
+        return func.HttpResponse("Profiling is disabled", status_code=404)
+    _targets = {
+        "producer": lambda: run_sync(evnt_producer_async(int(req.params.get("count", 3)))),
+        "consumer": read_from_svc_bus_q,
+    }
+    target = req.params.get("target", "producer")
+    if target not in _targets:
+        return func.HttpResponse(f"target must be one of {', '.join(_targets)}", status_code=400)
+    try:
+        prof = sample_window(
+            _targets[target],
+            float(req.params.get("secs", 10)),
+            float(req.params.get("interval_ms", 0)) or None
+        )
+    except ProfilerBusy as e:
+        return func.HttpResponse(str(e), status_code=409)
+    except Exception as e:
+        logging.exception(f"ERROR:{str(e)}")
+        return func.HttpResponse(f"ERROR:{str(e)}", status_code=500)
+    logging.info(f"{json.dumps({'profile': target, **prof.get_stats()})}")
+    return func.HttpResponse(
+        prof.collapsed(),
+        mimetype="text/plain",
+        headers={"Content-Disposition": f"attachment; filename={target}.folded"}
+    )
+
+
 @app.function_name(name="store_events_consumer")
 @app.service_bus_topic_trigger(
     arg_name="msg",
     topic_name=os.getenv("SVC_BUS_TOPIC_NAME"),
     connection="SVC_BUS_CONNECTION",
-    subscription_name=os.getenv("SALES_EVENTS_SUBSCRIPTION_NAME")
+    subscription_name=os.getenv("SALES_EVENTS_SUBSCRIPTION_NAME"),
+    # Up to host.json batchOptions.maxMessageCount messages per invocation
+    cardinality=func.Cardinality.MANY
 )
-def store_events_consumer(msg: func.ServiceBusMessage, context) -> str:
-    __resp = {
-        "status": False
-    }
+def store_events_consumer(msg: List[func.ServiceBusMessage], context) -> str:
     try:
-        # Setting up tracing
-        consumer_tracer = configure_tracer(context.function_name)
-        with consumer_tracer.start_as_current_span(f"miztiik-event-consumer-trace") as span:
+        with tracer.start_as_current_span("miztiik-event-consumer-trace") as span:
+            span.set_attribute("faas.name", context.function_name)
+            span.set_attribute("msg_count", len(msg))
             ###############################################################
             #                       Process Events                        #
             ###############################################################
-            __resp = process_q_msg(msg)
-            logging.info(f"{json.dumps(__resp)}")
+            # process_q_msgs logs its own response
+            process_q_msgs(msg)
     except Exception as e:
         logging.exception(f"ERROR:{str(e)}")
         raise e
-
-    logging.info(json.dumps(__resp, indent=4))
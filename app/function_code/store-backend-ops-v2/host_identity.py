@@ -0,0 +1,102 @@
+import os
+import socket
+import logging
+import threading
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-12"
+    # Full re-resolve of FQDN and IP, even when nothing looks changed
+    HOST_IDENTITY_REFRESH_SECS = int(os.getenv("HOST_IDENTITY_REFRESH_SECS", 300))
+    # Cheap, DNS free check for hostname or outbound address changes
+    HOST_IDENTITY_CHECK_SECS = int(os.getenv("HOST_IDENTITY_CHECK_SECS", 15))
+
+
+def _outbound_ip():
+    # Connecting a UDP socket sends nothing, it only picks the route's source address
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+    except OSError:
+        return None
+
+
+class HostIdentity:
+    """
+    Resolves the host's FQDN and IP once, then keeps them fresh from a daemon
+    thread. Readers only ever see the cached values, so event generation and
+    page rendering never wait on the resolver.
+    """
+
+    def __init__(self, refresh_secs: int = None, check_secs: int = None):
+        self.refresh_secs = refresh_secs or GlobalArgs.HOST_IDENTITY_REFRESH_SECS
+        self.check_secs = check_secs or GlobalArgs.HOST_IDENTITY_CHECK_SECS
+        self._stop = threading.Event()
+        self._thread = None
+        self._fingerprint = (socket.gethostname(), _outbound_ip())
+        # Swapped as a whole, so readers never see a mixed hostname/fqdn/ip
+        self._identity = self._resolve(self._fingerprint)
+        self.refreshes = 0
+
+    def _resolve(self, fingerprint):
+        hostname, outbound_ip = fingerprint
+        fqdn, ip = hostname, outbound_ip or "127.0.0.1"
+        try:
+            fqdn = socket.getfqdn()
+            ip = socket.gethostbyname(hostname)
+        except OSError as e:
+            logging.warning(f"Host identity lookup failed, using {fqdn}/{ip}: {e}")
+        return {"hostname": hostname, "fqdn": fqdn, "ip": ip}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="host-identity", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        since_refresh = 0
+        while not self._stop.wait(self.check_secs):
+            since_refresh += self.check_secs
+            fingerprint = (socket.gethostname(), _outbound_ip())
+            if fingerprint == self._fingerprint and since_refresh < self.refresh_secs:
+                continue
+            if fingerprint != self._fingerprint:
+                logging.info("Network change detected, re-resolving host identity")
+            self._identity = self._resolve(fingerprint)
+            self._fingerprint = fingerprint
+            self.refreshes += 1
+            since_refresh = 0
+
+    @property
+    def hostname(self) -> str:
+        return self._identity["hostname"]
+
+    @property
+    def fqdn(self) -> str:
+        return self._identity["fqdn"]
+
+    @property
+    def ip(self) -> str:
+        return self._identity["ip"]
+
+
+_host_identity = None
+_host_identity_lock = threading.Lock()
+
+
+def get_host_identity() -> HostIdentity:
+    """Process wide HostIdentity, resolved and started on first use."""
+    global _host_identity
+    if _host_identity is None:
+        with _host_identity_lock:
+            if _host_identity is None:
+                _host_identity = HostIdentity().start()
+    return _host_identity
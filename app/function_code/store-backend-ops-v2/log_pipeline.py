@@ -0,0 +1,224 @@
+import os
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+
+import event_codec
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-24"
+    # sync: handlers run on the logging thread, what the Functions host expects
+    # queued: records are formatted and written on a background thread
+    LOG_MODE = os.getenv("LOG_MODE", "sync").lower()
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+    # Per event records: the fraction kept, then at most this many a second (0 is no cap)
+    EVENT_LOG_SAMPLE_RATE = float(os.getenv("EVENT_LOG_SAMPLE_RATE", 1.0))
+    EVENT_LOG_MAX_PER_SEC = float(os.getenv("EVENT_LOG_MAX_PER_SEC", 50))
+    EVENT_LOG_SUMMARY_SECS = float(os.getenv("EVENT_LOG_SUMMARY_SECS", 60))
+
+
+EVENT_LOGGER = "store_events.events"
+
+_log = logging.getLogger(__name__)
+
+
+class LazyJson:
+    """
+    Log argument that is turned into compact JSON only when a handler emits
+    the record, so sampled out or disabled records cost no serialization.
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return event_codec.dumps(self.obj).decode("UTF-8")
+
+
+class EventLogSampler:
+    """
+    Keeps a `sample_rate` fraction of records, capped at `max_per_sec` with a
+    token bucket. What was left out is reported in a summary line at most
+    every `summary_secs`, and once more at exit.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = None,
+        max_per_sec: float = None,
+        summary_secs: float = None,
+    ):
+        self.sample_rate = (
+            GlobalArgs.EVENT_LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+        )
+        self.max_per_sec = (
+            GlobalArgs.EVENT_LOG_MAX_PER_SEC if max_per_sec is None else max_per_sec
+        )
+        self.summary_secs = summary_secs or GlobalArgs.EVENT_LOG_SUMMARY_SECS
+        self._lock = threading.Lock()
+        # Not the module level `random`, producers seed that for their events
+        self._rng = random.Random()
+        self._tokens = self.max_per_sec
+        self._refilled_at = self._window_start = time.monotonic()
+        self._kept = 0
+        self._dropped = 0
+
+    def keep(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            keep = self.sample_rate >= 1 or self._rng.random() < self.sample_rate
+            if keep and self.max_per_sec:
+                self._tokens = min(
+                    self.max_per_sec,
+                    self._tokens + (now - self._refilled_at) * self.max_per_sec,
+                )
+                self._refilled_at = now
+                keep = self._tokens >= 1
+                if keep:
+                    self._tokens -= 1
+            if keep:
+                self._kept += 1
+            else:
+                self._dropped += 1
+            summary = (
+                self._take_summary(now)
+                if now - self._window_start >= self.summary_secs
+                else None
+            )
+        if summary:
+            _log.info("%s", LazyJson(summary))
+        return keep
+
+    def _take_summary(self, now: float) -> dict:
+        summary = None
+        if self._dropped:
+            summary = {
+                "event_log_summary": {
+                    "kept": self._kept,
+                    "dropped": self._dropped,
+                    "window_secs": round(now - self._window_start, 3),
+                }
+            }
+        self._kept = self._dropped = 0
+        self._window_start = now
+        return summary
+
+    def flush(self):
+        with self._lock:
+            summary = self._take_summary(time.monotonic())
+        if summary:
+            _log.info("%s", LazyJson(summary))
+
+
+class EventLogger(logging.LoggerAdapter):
+    """
+    Asks the sampler before a record is even created, so the records it
+    leaves out cost a lock and a clock read instead of a `LogRecord`.
+    """
+
+    def __init__(self, logger: logging.Logger, sampler: EventLogSampler):
+        super().__init__(logger, None)
+        self.sampler = sampler
+
+    def isEnabledFor(self, level) -> bool:
+        return self.logger.isEnabledFor(level) and self.sampler.keep()
+
+    def process(self, msg, kwargs):
+        return msg, kwargs
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are; the message is merged with its
+    args and formatted by the listener's handlers, off the calling thread.
+    Args are formatted late, so they must not be mutated after the call.
+    When the queue is full the record is dropped instead of blocking.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_event_logger = None
+_event_sampler = None
+_queue_handler = None
+_listener = None
+_config_lock = threading.Lock()
+
+
+def get_event_logger() -> EventLogger:
+    """Logger for per event records, sampled and rate limited by `EventLogSampler`."""
+    global _event_logger, _event_sampler
+    if _event_logger is None:
+        with _config_lock:
+            if _event_logger is None:
+                _event_sampler = EventLogSampler()
+                atexit.register(_event_sampler.flush)
+                _event_logger = EventLogger(
+                    logging.getLogger(EVENT_LOGGER), _event_sampler
+                )
+    return _event_logger
+
+
+def configure_logging(mode: str = None):
+    """
+    In `queued` mode, move the root logger's handlers (a stderr handler if
+    there are none) behind a `DeferredQueueHandler` and run them on a
+    `QueueListener` thread. Safe to call more than once.
+    """
+    global _queue_handler, _listener
+    get_event_logger()
+    if (mode or GlobalArgs.LOG_MODE) != "queued" or _listener is not None:
+        return
+    with _config_lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger()
+        handlers = root.handlers[:] or [logging.StreamHandler()]
+        for h in root.handlers[:]:
+            root.removeHandler(h)
+        _queue_handler = DeferredQueueHandler(queue.Queue(GlobalArgs.LOG_QUEUE_SIZE))
+        root.addHandler(_queue_handler)
+        _listener = logging.handlers.QueueListener(
+            _queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_stop_listener)
+
+
+def _stop_listener():
+    if _event_sampler is not None:
+        _event_sampler.flush()
+    if _queue_handler.dropped:
+        _dropped, _queue_handler.dropped = _queue_handler.dropped, 0
+        _log.warning(f"Log queue was full, {_dropped} records dropped")
+    # Drains the queue before returning
+    _listener.stop()
+
+
+def flush_logging():
+    """Write out everything queued so far. Worker processes skip atexit, call this."""
+    if _listener is None:
+        if _event_sampler is not None:
+            _event_sampler.flush()
+        return
+    _stop_listener()
+    _listener.start()
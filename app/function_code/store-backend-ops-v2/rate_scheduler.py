@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+import threading
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-10"
+    # 0 = unpaced, produce as fast as the sinks allow
+    TARGET_EVENTS_PER_SEC = os.getenv("TARGET_EVENTS_PER_SEC")
+    # Events the producer may catch up on after falling behind, defaults to 1s worth
+    RATE_BURST = os.getenv("RATE_BURST")
+    # constant | ramp | step
+    RATE_PROFILE = os.getenv("RATE_PROFILE", "constant")
+    RATE_RAMP_SECS = float(os.getenv("RATE_RAMP_SECS", 60))
+    # Step profile as "<secs>:<eps>,...", e.g. "30:50,60:100"
+    RATE_STEPS = os.getenv("RATE_STEPS", "")
+
+
+def _parse_steps(steps: str) -> list:
+    _steps = []
+    for step in filter(None, steps.split(",")):
+        at_secs, eps = step.split(":")
+        _steps.append((float(at_secs), float(eps)))
+    return sorted(_steps)
+
+
+class RateScheduler:
+    """
+    Token bucket pacing for producers.
+
+    Tokens accrue at the profile's rate for the elapsed run time, up to
+    `burst` (one second's worth by default). Each event takes one token; the
+    caller only sleeps when the bucket is empty, i.e. when it is ahead of
+    schedule. Time spent in sink I/O counts towards the schedule instead of
+    adding to it, so the achieved rate tracks the target even when sink
+    latency varies.
+
+    Profiles:
+    - constant: `target_eps` throughout
+    - ramp: linear from 1 eps up to `target_eps` over `ramp_secs`
+    - step: `target_eps` until the first `(at_secs, eps)` step, then each step's eps
+
+    `shape(elapsed)`, if given, multiplies the profile's rate, e.g. for
+    seasonality or burst storms.
+    """
+
+    def __init__(
+        self,
+        target_eps: float,
+        burst: int = None,
+        profile: str = "constant",
+        ramp_secs: float = 60,
+        steps: list = None,
+        shape=None,
+    ):
+        if profile not in ("constant", "ramp", "step"):
+            raise ValueError(f"Unknown rate profile: {profile}")
+        self.target_eps = target_eps
+        self.burst = max(1, int(burst if burst is not None else target_eps))
+        self.profile = profile
+        self.ramp_secs = ramp_secs
+        self.steps = steps or []
+        self.shape = shape
+        self._lock = threading.Lock()
+        self._start = None
+        self._last = None
+        self._tokens = 0.0
+        self._scheduled = 0.0
+        self._events = 0
+        self._slept_secs = 0.0
+
+    @classmethod
+    def from_env(cls, default_eps: float = 0, shape=None):
+        target_eps = GlobalArgs.TARGET_EVENTS_PER_SEC
+        return cls(
+            target_eps=float(target_eps) if target_eps else default_eps,
+            burst=int(GlobalArgs.RATE_BURST) if GlobalArgs.RATE_BURST else None,
+            profile=GlobalArgs.RATE_PROFILE,
+            ramp_secs=GlobalArgs.RATE_RAMP_SECS,
+            steps=_parse_steps(GlobalArgs.RATE_STEPS),
+            shape=shape,
+        )
+
+    def rate_at(self, elapsed: float) -> float:
+        eps = self._profile_rate_at(elapsed)
+        if self.shape:
+            eps *= self.shape(elapsed)
+        return eps
+
+    def _profile_rate_at(self, elapsed: float) -> float:
+        if self.profile == "ramp" and elapsed < self.ramp_secs:
+            return max(1.0, self.target_eps * elapsed / self.ramp_secs)
+        if self.profile == "step":
+            eps = self.target_eps
+            for at_secs, step_eps in self.steps:
+                if elapsed < at_secs:
+                    break
+                eps = step_eps
+            return eps
+        return self.target_eps
+
+    def reserve(self) -> float:
+        """Take a token and return how long to sleep before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._events += 1
+            if self.target_eps <= 0:
+                return 0.0
+            if self._start is None:
+                # The first event goes right away, the rest follow the schedule
+                self._start = self._last = now
+                return 0.0
+
+            mid = (self._last + now) / 2 - self._start
+            earned = self.rate_at(mid) * (now - self._last)
+            self._scheduled += earned
+            self._tokens = min(self._tokens + earned, float(self.burst))
+            self._last = now
+
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            # In debt: wait until the missing fraction of a token has accrued
+            delay = -self._tokens / max(self.rate_at(now - self._start), 1e-9)
+            self._slept_secs += delay
+            return delay
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            elapsed = (time.monotonic() - self._start) if self._start else 0
+            _s = {
+                "profile": self.profile,
+                "events": self._events,
+                "elapsed_secs": round(elapsed, 3),
+                "slept_secs": round(self._slept_secs, 3),
+            }
+            if self.target_eps <= 0:
+                _s["target_eps"] = None
+                _s["achieved_eps"] = (
+                    round(self._events / elapsed, 2) if elapsed else None
+                )
+                return _s
+            # Target averaged over the run, so ramp and step profiles compare fairly
+            _s["target_eps"] = (
+                round((self._scheduled + 1) / elapsed, 2)
+                if elapsed
+                else self.target_eps
+            )
+            _s["achieved_eps"] = round(self._events / elapsed, 2) if elapsed else None
+            if _s["achieved_eps"] and _s["target_eps"]:
+                _s["achieved_pct"] = round(
+                    100 * _s["achieved_eps"] / _s["target_eps"], 1
+                )
+            return _s
@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+import contextlib
+import collections
+
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-20"
+    # Latencies above this are counted in the top bucket
+    STAGE_METRICS_MAX_SECS = float(os.getenv("STAGE_METRICS_MAX_SECS", 3600))
+
+
+_QUANTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99}
+
+
+class LatencyHistogram:
+    """
+    HDR style histogram of microsecond latencies.
+
+    Values below 2**SUB_BITS get a bucket each; above that, every power of
+    two is split into 2**(SUB_BITS - 1) equal buckets, so a quantile is off
+    by at most 1/32 of its value. Recording is a few integer operations, the
+    bucket array is fixed in size and never grows.
+    """
+
+    SUB_BITS = 6
+
+    def __init__(self, max_secs: float = None):
+        self._sub = 1 << self.SUB_BITS
+        self._half = self._sub >> 1
+        self._max_us = int((max_secs or GlobalArgs.STAGE_METRICS_MAX_SECS) * 1e6)
+        self.counts = [0] * (self._index(self._max_us) + 1)
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+        self._lock = threading.Lock()
+
+    def _index(self, us: int) -> int:
+        if us < self._sub:
+            return us
+        shift = us.bit_length() - self.SUB_BITS
+        return self._sub + (shift - 1) * self._half + (us >> shift) - self._half
+
+    def _upper_us(self, idx: int) -> int:
+        if idx < self._sub:
+            return idx
+        shift, sub = divmod(idx - self._sub, self._half)
+        shift += 1
+        return ((sub + self._half + 1) << shift) - 1
+
+    def record(self, secs: float):
+        us = int(secs * 1e6) if secs > 0 else 0
+        idx = self._index(min(us, self._max_us))
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.total_us += us
+            if us > self.max_us:
+                self.max_us = us
+
+    def copy(self) -> "LatencyHistogram":
+        _h = LatencyHistogram.__new__(LatencyHistogram)
+        _h.__dict__.update(self.__dict__)
+        with self._lock:
+            _h.counts = list(self.counts)
+            _h.count, _h.total_us = self.count, self.total_us
+        _h._lock = threading.Lock()
+        return _h
+
+    def snapshot(self, since: "LatencyHistogram" = None) -> dict:
+        """Count, mean, max and quantiles in ms, of what was recorded after `since`."""
+        with self._lock:
+            counts = list(self.counts)
+            count, total_us, max_us = self.count, self.total_us, self.max_us
+        if since is not None:
+            counts = [a - b for a, b in zip(counts, since.counts)]
+            count -= since.count
+            total_us -= since.total_us
+        _s = {"count": count}
+        if not count:
+            return _s
+        _s["mean_ms"] = round(total_us / count / 1000, 3)
+        targets = sorted((q * count, name) for name, q in _QUANTILES.items())
+        seen = 0
+        for idx, c in enumerate(counts):
+            seen += c
+            while targets and seen >= targets[0][0]:
+                _upper_us = min(self._upper_us(idx), max_us)
+                _s[targets.pop(0)[1] + "_ms"] = round(_upper_us / 1000, 3)
+            if not targets:
+                break
+        # The max is process wide, it is not windowed
+        _s["max_ms"] = round(max_us / 1000, 3)
+        return _s
+
+
+class StageMetrics:
+    """
+    Latency histograms per pipeline stage (generate, serialize, sink.<name>,
+    receive, settle, parse...) and plain counters (events, bytes, errors,
+    retries). Cheap enough to leave on: recording never allocates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = collections.Counter()
+
+    def histogram(self, stage: str) -> LatencyHistogram:
+        _h = self._stages.get(stage)
+        if _h is None:
+            with self._lock:
+                _h = self._stages.setdefault(stage, LatencyHistogram())
+        return _h
+
+    def record(self, stage: str, secs: float):
+        self.histogram(stage).record(secs)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(stage).record(time.perf_counter() - start_time)
+
+    def add(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def checkpoint(self) -> dict:
+        """What has been recorded so far, to pass as `since` to `snapshot`."""
+        with self._lock:
+            stages = dict(self._stages)
+            counters = dict(self._counters)
+        return {
+            "stages": {s: h.copy() for s, h in stages.items()},
+            "counters": counters,
+        }
+
+    def snapshot(self, since: dict = None) -> dict:
+        with self._lock:
+            stages = dict(self._stages)
+            counters = dict(self._counters)
+        _since = since or {"stages": {}, "counters": {}}
+        _stages = {
+            s: h.snapshot(_since["stages"].get(s)) for s, h in sorted(stages.items())
+        }
+        _counters = {
+            c: v - _since["counters"].get(c, 0) for c, v in sorted(counters.items())
+        }
+        # Only what moved since the checkpoint
+        return {
+            "stages": {s: v for s, v in _stages.items() if v["count"]},
+            "counters": {c: v for c, v in _counters.items() if v},
+        }
+
+    # OpenTelemetry pulls these on its own export interval
+    def _observe_latency(self, options):
+        _since, self._last_export = self._last_export, self.checkpoint()
+        for stage, s in self.snapshot(_since)["stages"].items():
+            for q in _QUANTILES:
+                if f"{q}_ms" in s:
+                    yield Observation(s[f"{q}_ms"], {"stage": stage, "quantile": q})
+
+    def _observe_counters(self, options):
+        for counter, v in self.snapshot()["counters"].items():
+            yield Observation(v, {"counter": counter})
+
+    def register_otel(self):
+        """
+        Export through whichever MeterProvider the entry point set up, see
+        tracing.py. Latency quantiles cover the time since the last export.
+        """
+        self._last_export = self.checkpoint()
+        meter = metrics.get_meter(__name__)
+        meter.create_observable_gauge(
+            "store_events.stage_latency",
+            callbacks=[self._observe_latency],
+            unit="ms",
+            description="Pipeline stage latency quantiles",
+        )
+        meter.create_observable_counter(
+            "store_events.pipeline",
+            callbacks=[self._observe_counters],
+            description="Events, bytes, errors and retries",
+        )
+
+
+_stage_metrics = None
+_stage_metrics_lock = threading.Lock()
+
+
+def get_stage_metrics() -> StageMetrics:
+    global _stage_metrics
+    if _stage_metrics is None:
+        with _stage_metrics_lock:
+            if _stage_metrics is None:
+                _m = StageMetrics()
+                _m.register_otel()
+                _stage_metrics = _m
+    return _stage_metrics
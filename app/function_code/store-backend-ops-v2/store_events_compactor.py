@@ -0,0 +1,359 @@
+import os
+import json
+import shutil
+import logging
+import datetime
+import argparse
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-02"
+    BLOB_SVC_ACCOUNT_URL = os.getenv("BLOB_SVC_ACCOUNT_URL")
+    BLOB_NAME = os.getenv("BLOB_NAME", "store-events-blob-002")
+    RAW_PREFIX = "store_events/raw"
+    CURATED_PREFIX = "store_events/curated"
+    ROWS_PER_FILE = int(os.getenv("COMPACTION_ROWS_PER_FILE", 1_000_000))
+    # Rows held in memory at a time, each is written out as one row group
+    ROW_GROUP_ROWS = int(os.getenv("COMPACTION_ROW_GROUP_ROWS", 100_000))
+    SUCCESS_MARKER = "_SUCCESS"
+
+
+# Columns with a handful of distinct values are stored dictionary encoded
+_DICT_STR = pa.dictionary(pa.int8(), pa.string())
+
+STORE_EVENTS_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("event_type", _DICT_STR),
+        ("store_id", pa.int32()),
+        ("store_fqdn", pa.string()),
+        ("store_ip", pa.string()),
+        ("cust_id", pa.int32()),
+        ("category", _DICT_STR),
+        ("sku", pa.int32()),
+        ("price", pa.float64()),
+        ("qty", pa.int16()),
+        ("currency", _DICT_STR),
+        ("discount", pa.int16()),
+        ("gift_wrap", pa.bool_()),
+        ("variant", _DICT_STR),
+        ("priority_shipping", pa.bool_()),
+        ("is_promoted", pa.bool_()),
+        ("payment_method", _DICT_STR),
+        ("device_type", _DICT_STR),
+        ("browser", _DICT_STR),
+        ("os", _DICT_STR),
+        ("ts", pa.timestamp("us")),
+        ("contact_me", pa.string()),
+        ("is_return", pa.bool_()),
+        ("bad_msg", pa.bool_()),
+    ]
+)
+
+
+############################################
+#              STORAGE BACKENDS            #
+############################################
+
+
+class LocalFsStore:
+    """Blob-like key/value store over a local directory, for tests and dry runs."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def list(self, prefix: str) -> list:
+        base = self._path(prefix)
+        names = []
+        for dirpath, _, files in os.walk(base):
+            for f in files:
+                rel = os.path.relpath(os.path.join(dirpath, f), self.root)
+                names.append(rel.replace(os.sep, "/"))
+        return sorted(n for n in names if n.startswith(prefix))
+
+    def read(self, name: str) -> bytes:
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def write(self, name: str, data: bytes):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a crash never leaves a half written file behind
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def write_stream(self, name: str, stream):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+        os.replace(tmp_path, path)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def delete(self, name: str):
+        os.remove(self._path(name))
+
+
+class BlobStore:
+    """Store backed by a blob container; point it at Azurite with a connection string."""
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+
+    @classmethod
+    def from_env(cls, connection_string: str = None):
+        from azure.storage.blob import BlobServiceClient
+
+        if connection_string:
+            blob_svc_client = BlobServiceClient.from_connection_string(
+                connection_string
+            )
+        else:
+            from az_utils import _get_az_creds
+
+            blob_svc_client = BlobServiceClient(
+                GlobalArgs.BLOB_SVC_ACCOUNT_URL, credential=_get_az_creds()
+            )
+        return cls(blob_svc_client.get_container_client(GlobalArgs.BLOB_NAME))
+
+    def list(self, prefix: str) -> list:
+        return sorted(
+            b.name for b in self.container_client.list_blobs(name_starts_with=prefix)
+        )
+
+    def read(self, name: str) -> bytes:
+        return self.container_client.download_blob(name).readall()
+
+    def write(self, name: str, data: bytes):
+        self.container_client.upload_blob(name, data, overwrite=True)
+
+    def write_stream(self, name: str, stream):
+        # The SDK uploads a stream in blocks, it is never read whole
+        self.container_client.upload_blob(name, stream, overwrite=True)
+
+    def exists(self, name: str) -> bool:
+        return self.container_client.get_blob_client(name).exists()
+
+    def delete(self, name: str):
+        self.container_client.delete_blob(name)
+
+
+############################################
+#               COMPACTION                 #
+############################################
+
+
+def _iter_records(raw: bytes):
+    """Yield events from a `.json` blob (one event) or `.ndjson` segment."""
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        # Queue readers persist the received envelope, the event is under "body"
+        if isinstance(rec.get("body"), dict) and "sku" not in rec:
+            rec = rec["body"]
+        yield rec
+
+
+def _to_table(records: list) -> pa.Table:
+    arrays = []
+    for field in STORE_EVENTS_SCHEMA:
+        values = [r.get(field.name) for r in records]
+        if field.name == "ts":
+            values = [datetime.datetime.fromisoformat(v) if v else None for v in values]
+        if pa.types.is_dictionary(field.type):
+            arr = pa.array(values, type=pa.string()).dictionary_encode()
+            arrays.append(arr.cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=STORE_EVENTS_SCHEMA)
+
+
+def _iter_row_groups(store, names: list, rows: int):
+    """Records of `names` in lists of at most `rows`, reading one blob at a time."""
+    records = []
+    for name in names:
+        for rec in _iter_records(store.read(name)):
+            records.append(rec)
+            if len(records) >= rows:
+                yield records
+                records = []
+    if records:
+        yield records
+
+
+class _ParquetParts:
+    """
+    Writes row groups to `part-NNNNN.parquet` files of at most `rows_per_file`
+    rows. A part is spooled to a local temp file and uploaded when it is
+    closed, so only the row group being written is held in memory.
+    """
+
+    def __init__(self, store, out_prefix: str, rows_per_file: int):
+        self.store = store
+        self.out_prefix = out_prefix
+        self.rows_per_file = rows_per_file
+        self.files = []
+        self.rows = 0
+        self._tmp = None
+        self._writer = None
+        self._file_rows = 0
+
+    def _open(self):
+        self._tmp = tempfile.TemporaryFile()
+        self._writer = pq.ParquetWriter(
+            self._tmp, STORE_EVENTS_SCHEMA, compression="zstd", use_dictionary=True
+        )
+        self._file_rows = 0
+
+    def _close_part(self):
+        self._writer.close()
+        part_name = f"{self.out_prefix}/part-{len(self.files):05d}.parquet"
+        self._tmp.seek(0)
+        self.store.write_stream(part_name, self._tmp)
+        self._tmp.close()
+        self._tmp = self._writer = None
+        self.files.append(part_name)
+
+    def write(self, records: list):
+        while records:
+            if self._writer is None:
+                self._open()
+            _take = self.rows_per_file - self._file_rows
+            chunk, records = records[:_take], records[_take:]
+            self._writer.write_table(_to_table(chunk))
+            self._file_rows += len(chunk)
+            self.rows += len(chunk)
+            if self._file_rows >= self.rows_per_file:
+                self._close_part()
+
+    def close(self):
+        # An empty partition still gets one file, carrying the schema
+        if self._writer is None and not self.files:
+            self._open()
+        if self._writer is not None:
+            self._close_part()
+
+
+def _group_by_event_type(names: list, dt: str) -> dict:
+    """Group raw blob names of one `dt=` partition by their `event_type=` dir."""
+    groups = {}
+    for name in names:
+        if f"/dt={dt}/" not in name or not name.endswith((".json", ".ndjson")):
+            continue
+        event_type = None
+        for part in name.split("/"):
+            if part.startswith("event_type="):
+                event_type = part.split("=", 1)[1]
+        groups.setdefault(event_type, []).append(name)
+    return groups
+
+
+def compact_partition(
+    store,
+    dt: str,
+    force: bool = False,
+    rows_per_file: int = None,
+    row_group_rows: int = None,
+) -> dict:
+    """
+    Compact every `event_type=` directory of the raw `dt=` partition into
+    Parquet under the curated prefix.
+
+    Output file names depend only on the input, and each output partition gets
+    a `_SUCCESS` marker once all its files are written. Re-running skips marked
+    partitions and redoes the rest from scratch, so a crashed run resumes by
+    simply running again.
+
+    Input blobs are read one at a time and written out every
+    `row_group_rows` rows, so memory does not grow with the partition.
+    """
+    rows_per_file = rows_per_file or GlobalArgs.ROWS_PER_FILE
+    row_group_rows = min(row_group_rows or GlobalArgs.ROW_GROUP_ROWS, rows_per_file)
+    _r = {"dt": dt, "partitions": {}}
+
+    groups = _group_by_event_type(store.list(f"{GlobalArgs.RAW_PREFIX}/"), dt)
+    for event_type, names in sorted(groups.items(), key=lambda g: g[0] or ""):
+        if event_type:
+            out_prefix = f"{GlobalArgs.CURATED_PREFIX}/event_type={event_type}/dt={dt}"
+        else:
+            out_prefix = f"{GlobalArgs.CURATED_PREFIX}/dt={dt}"
+        marker = f"{out_prefix}/{GlobalArgs.SUCCESS_MARKER}"
+
+        if store.exists(marker) and not force:
+            logging.info(f"Skipping {out_prefix}, already compacted")
+            _r["partitions"][out_prefix] = json.loads(store.read(marker))
+            continue
+
+        # Clear leftovers of an interrupted run before writing
+        for stale in store.list(f"{out_prefix}/"):
+            store.delete(stale)
+
+        parts = _ParquetParts(store, out_prefix, rows_per_file)
+        for records in _iter_row_groups(store, names, row_group_rows):
+            parts.write(records)
+        parts.close()
+
+        manifest = {
+            "input_blobs": len(names),
+            "rows": parts.rows,
+            "files": parts.files,
+            "compacted_on": datetime.datetime.now().isoformat(),
+        }
+        store.write(marker, json.dumps(manifest).encode("UTF-8"))
+        logging.info(
+            f"Compacted {parts.rows} rows from {len(names)} blobs into {out_prefix}"
+        )
+        _r["partitions"][out_prefix] = manifest
+
+    _r["status"] = True
+    return _r
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compact a raw store_events dt= partition into Parquet"
+    )
+    parser.add_argument(
+        "--dt",
+        default=(datetime.datetime.now() - datetime.timedelta(days=1)).strftime(
+            "%Y_%m_%d"
+        ),
+        help="Partition date as YYYY_MM_DD, defaults to yesterday",
+    )
+    parser.add_argument(
+        "--local-root", help="Compact a local directory instead of blob"
+    )
+    parser.add_argument(
+        "--connection-string",
+        default=os.getenv("BLOB_CONNECTION_STRING"),
+        help="Blob connection string, e.g. for Azurite",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Redo compacted partitions"
+    )
+    args = parser.parse_args()
+
+    if args.local_root:
+        store = LocalFsStore(args.local_root)
+    else:
+        store = BlobStore.from_env(args.connection_string)
+    print(json.dumps(compact_partition(store, args.dt, force=args.force), indent=4))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,16 +1,25 @@
-import json
 import logging
 import datetime
+from typing import List
 
 import azure.functions as func
+from opentelemetry import trace
+
 from az_utils import (
-    write_to_blob,
-    write_to_cosmosdb,
-    write_to_svc_bus_q,
-    write_to_svc_bus_topic,
-    write_to_event_hub,
+    _consumer_batch_sinks,
+    write_poison_msgs,
 )
 
+# One implementation of the single message handlers, in az_utils
+from az_utils import process_q_msg  # noqa: F401
+from event_codec import EventDecodeError, decode_event
+from latency_stamps import msg_stamps, record_hops, to_utc_us, utc_now_us
+from log_pipeline import LazyJson
+from stage_metrics import get_stage_metrics
+
+_tracer = trace.get_tracer(__name__)
+_metrics = get_stage_metrics()
+
 
 class GlobalArgs:
     OWNER = "Mystique"
@@ -25,72 +34,92 @@ def evnt_consumer():
     return True
 
 
-def process_q_msg(msg: func.ServiceBusMessage) -> str:
+def process_q_msgs(msgs: List[func.ServiceBusMessage]) -> dict:
+    """
+    Batch flavour of `process_q_msg`. Each body is parsed once; poison
+    messages are set aside one by one and parked in blob, see
+    `write_poison_msgs`, and the rest are written to blob and cosmos as a
+    whole batch. Only a failure to write fails the invocation, so the batch
+    is redelivered.
+    """
     _a_resp = {
         "status": False,
         "miztiik_event_processed": False,
+        "msg_count": len(msgs),
+        "poison_msgs": [],
         "last_processed_on": None,
     }
 
-    try:
-
-        msg_body = msg.get_body().decode("utf-8")
-
-        parsed_msg = json.loads(msg_body)
-        start_time = datetime.datetime.fromisoformat(parsed_msg["ts"])
-        processing_time = int((datetime.datetime.now() - start_time).total_seconds())
-
-        enriched_msg = json.dumps(
-            {
-                "message_id": msg.message_id,
-                "body": msg.get_body().decode("utf-8"),
-                "content_type": msg.content_type,
-                "delivery_count": msg.delivery_count,
-                "expiration_time": (
-                    msg.expiration_time.isoformat() if msg.expiration_time else None
-                ),
-                "label": msg.label,
-                "partition_key": msg.partition_key,
-                "reply_to": msg.reply_to,
-                "reply_to_session_id": msg.reply_to_session_id,
-                "scheduled_enqueue_time": (
-                    msg.scheduled_enqueue_time.isoformat()
-                    if msg.scheduled_enqueue_time
-                    else None
-                ),
-                "session_id": msg.session_id,
-                "time_to_live": msg.time_to_live,
-                "to": msg.to,
-                "user_properties": msg.user_properties,
-                "event_type": msg.user_properties.get("event_type"),
-                "processing_time": processing_time,
-            },
-            indent=4,
-            sort_keys=True,
-            default=str,
+    docs = []
+    poison = []
+    stamps = []
+    processing_times = []
+    received_at_us = utc_now_us()
+    metrics_cp = _metrics.checkpoint()
+    with _tracer.start_as_current_span("parse") as span:
+        for msg in msgs:
+            _body = msg.get_body()
+            _metrics.add("bytes_received", len(_body))
+            try:
+                # Poison pills fail the schema check while being parsed
+                with _metrics.time("parse"):
+                    parsed_msg = decode_event(_body)
+            except EventDecodeError as e:
+                _metrics.add("poison_msgs")
+                logging.warning(f"Poison message {msg.message_id}: {str(e)}")
+                _a_resp["poison_msgs"].append(
+                    {"message_id": msg.message_id, "err": str(e)}
+                )
+                poison.append({**_a_resp["poison_msgs"][-1], "body": _body})
+                continue
+            try:
+                produced_at_us = to_utc_us(parsed_msg["ts"])
+                processing_times.append((received_at_us - produced_at_us) / 1e6)
+                stamps.append(
+                    msg_stamps(
+                        msg.user_properties,
+                        msg.enqueued_time_utc,
+                        received_at_us,
+                        ts=produced_at_us,
+                    )
+                )
+            except ValueError:
+                pass
+            docs.append(parsed_msg)
+        span.set_attribute("poison_count", len(_a_resp["poison_msgs"]))
+
+    _a_resp["event_count"] = len(docs)
+    if processing_times:
+        _a_resp["avg_processing_time"] = round(
+            sum(processing_times) / len(processing_times), 6
         )
 
-        logging.info(f"{parsed_msg}")
-        logging.info(f"recv_msg:\n {enriched_msg}")
-
-        # write to blob
-        write_to_blob(json.loads(msg_body))
-
-        # write to cosmosdb
-        write_to_cosmosdb(json.loads(msg_body))
-
+    try:
+        if docs:
+            _sink_details = {}
+            _a_resp["sink_results"] = _consumer_batch_sinks.dispatch(
+                docs, _sink_details
+            )
+            _a_resp.update(_sink_details)
+        write_poison_msgs(poison)
+
+        _metrics.add("events_consumed", len(docs))
+        # The whole batch is committed at once
+        committed_at_us = utc_now_us()
+        for _s in stamps:
+            record_hops(_s, committed_at_us)
         _a_resp["status"] = True
         _a_resp["miztiik_event_processed"] = True
         _a_resp["last_processed_on"] = datetime.datetime.now().isoformat()
-
-        _a_resp["processing_time"] = processing_time
-
-        logging.info(f"{json.dumps(_a_resp, indent=4, sort_keys=True, default=str)}")
-
     except Exception as e:
+        _metrics.add("errors.consume")
         logging.exception(f"ERROR:{str(e)}")
+        raise e
+    finally:
+        _a_resp["metrics"] = _metrics.snapshot(since=metrics_cp)
 
-    logging.info(json.dumps(_a_resp, indent=4, sort_keys=True, default=str))
+    logging.info("%s", LazyJson(_a_resp))
+    return _a_resp
 
 
 if __name__ == "__main__":
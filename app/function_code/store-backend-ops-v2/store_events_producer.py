@@ -1,19 +1,32 @@
 import json
+import asyncio
 import logging
-import datetime
 import time
 import os
 import random
 import uuid
-import socket
+import argparse
 
+import numpy as np
+from opentelemetry import trace
+
+from host_identity import get_host_identity
 from az_utils import (
-    write_to_blob,
-    write_to_cosmosdb,
-    write_to_svc_bus_q,
-    write_to_svc_bus_topic,
-    write_to_event_hub,
+    get_cred_stats,
+    get_svc_bus_batch_sender,
+    SinkDispatcher,
+    SinkSpec,
 )
+from rate_scheduler import RateScheduler
+from event_codec import encode_event, encode_ndjson
+from latency_stamps import PRODUCED_AT, utc_isoformat, utc_now_us
+from log_pipeline import LazyJson, get_event_logger
+from stage_metrics import get_stage_metrics
+from workload_profiles import WorkloadProfile
+
+_tracer = trace.get_tracer(__name__)
+_metrics = get_stage_metrics()
+_event_log = get_event_logger()
 
 
 class GlobalArgs:
@@ -22,12 +35,71 @@ class GlobalArgs:
     TRIGGER_RANDOM_FAILURES = os.getenv("TRIGGER_RANDOM_FAILURES", True)
     WAIT_SECS_BETWEEN_MSGS = int(os.getenv("WAIT_SECS_BETWEEN_MSGS", 2))
     TOT_MSGS_TO_PRODUCE = int(os.getenv("TOT_MSGS_TO_PRODUCE", 15))
+    MAX_IN_FLIGHT_SENDS = int(os.getenv("MAX_IN_FLIGHT_SENDS", 256))
+    # Same seed and shard, same events; random when unset
+    EVENT_SEED = os.getenv("EVENT_SEED")
+    EVENT_SHARD = int(os.getenv("EVENT_SHARD", 0))
+    # Replay this .npy corpus instead of generating events
+    EVENT_CORPUS = os.getenv("EVENT_CORPUS")
+    # JSON workload profile, see `WorkloadProfile`; built in distributions when unset
+    WORKLOAD_PROFILE = os.getenv("WORKLOAD_PROFILE")
+
+
+def _get_pacer():
+    # TARGET_EVENTS_PER_SEC wins, else keep the old WAIT_SECS_BETWEEN_MSGS cadence
+    default_eps = 0
+    if GlobalArgs.WAIT_SECS_BETWEEN_MSGS > 0:
+        default_eps = 1 / GlobalArgs.WAIT_SECS_BETWEEN_MSGS
+    # Seasonality and burst storms of the workload profile shape the rate
+    return RateScheduler.from_env(
+        default_eps=default_eps, shape=get_workload_profile().rate_multiplier
+    )
+
+
+# Vocabularies shared by the single and bulk generators
+_CATEGORIES = [
+    "Books",
+    "Games",
+    "Mobiles",
+    "Groceries",
+    "Shoes",
+    "Stationaries",
+    "Laptops",
+    "Tablets",
+    "Notebooks",
+    "Camera",
+    "Printers",
+    "Monitors",
+    "Speakers",
+    "Projectors",
+    "Cables",
+    "Furniture",
+]
+_OS = ["Android", "iOS", "Windows", "MacOS", "Linux"]
+_BROWSERS = ["chrome", "firefox", "safari", "edge", "ie"]
+_DEVICE_TYPES = ["mobile", "tablet", "desktop"]
+_VARIANTS = ["black", "red"]
+_EVNT_TYPES = ["sale_event", "inventory_event"]
+_CURRENCIES = ["USD", "INR", "EUR", "GBP", "AUD", "CAD", "SGD", "JPY", "CNY", "HKD"]
+_PAYMENTS = [
+    "credit_card",
+    "debit_card",
+    "cash",
+    "wallet",
+    "upi",
+    "net_banking",
+    "cod",
+    "gift_card",
+]
+_BAD_MSG_WEIGHTS = [0.2, 0.9]
+# Filler for profiles with larger payloads, sliced per event
+_PADDING = "0123456789abcdef" * 4096
 
 
 def _rand_coin_flip():
     r = False
     if GlobalArgs.TRIGGER_RANDOM_FAILURES:
-        r = random.choices([True, False], weights=[0.2, 0.9], k=1)[0]
+        r = random.choices([True, False], weights=_BAD_MSG_WEIGHTS, k=1)[0]
     return r
 
 
@@ -36,51 +108,18 @@ def _gen_uuid():
 
 
 def generate_event():
+    _host = get_host_identity()
 
     # Following Patterns are implemented
     # If event_type is inventory_event, then is_return is True for 50% of the events
     # 10% of total events are poison pill events, bad_msg attribute is True and store_id is removed
     # Event attributes are set with priority_shipping, is_return, and event type
 
-    _categories = [
-        "Books",
-        "Games",
-        "Mobiles",
-        "Groceries",
-        "Shoes",
-        "Stationaries",
-        "Laptops",
-        "Tablets",
-        "Notebooks",
-        "Camera",
-        "Printers",
-        "Monitors",
-        "Speakers",
-        "Projectors",
-        "Cables",
-        "Furniture",
-    ]
-    _os = ["Android", "iOS", "Windows", "MacOS", "Linux"]
-    _browser = ["chrome", "firefox", "safari", "edge", "ie"]
-    _device_types = ["mobile", "tablet", "desktop"]
-    _variants = ["black", "red"]
-    _evnt_types = ["sale_event", "inventory_event"]
-    _currencies = ["USD", "INR", "EUR", "GBP", "AUD", "CAD", "SGD", "JPY", "CNY", "HKD"]
-    _payments = [
-        "credit_card",
-        "debit_card",
-        "cash",
-        "wallet",
-        "upi",
-        "net_banking",
-        "cod",
-        "gift_card",
-    ]
-
+    produced_at_us = utc_now_us()
     _qty = random.randint(1, 99)
     _s = round(random.random() * 100, 2)
 
-    _evnt_type = random.choices(_evnt_types, weights=[0.8, 0.2], k=1)[0]
+    _evnt_type = random.choices(_EVNT_TYPES, weights=[0.8, 0.2], k=1)[0]
     _u = _gen_uuid()
     p_s = random.choices([True, False], weights=[0.3, 0.7], k=1)[0]
     _promo = random.choices([True, False], weights=[0.13, 0.87], k=1)[0]
@@ -93,24 +132,24 @@ def generate_event():
         "id": _u,
         "event_type": _evnt_type,
         "store_id": random.randint(1, 10),
-        "store_fqdn": str(socket.getfqdn()),
-        "store_ip": str(socket.gethostbyname(socket.gethostname())),
+        "store_fqdn": _host.fqdn,
+        "store_ip": _host.ip,
         "cust_id": random.randint(100, 999),
-        "device_type": random.choice(_device_types),
-        "browser": random.choice(_browser),
-        "os": random.choice(_os),
-        "category": random.choice(_categories),
+        "device_type": random.choice(_DEVICE_TYPES),
+        "browser": random.choice(_BROWSERS),
+        "os": random.choice(_OS),
+        "category": random.choice(_CATEGORIES),
         "sku": random.randint(18981, 189281),
         "price": _s,
         "qty": _qty,
-        "currency": random.choice(_currencies),
+        "currency": random.choice(_CURRENCIES),
         "discount": random.randint(0, 75),
         "gift_wrap": random.choices([True, False], weights=[0.3, 0.7], k=1)[0],
-        "variant": random.choice(_variants),
+        "variant": random.choice(_VARIANTS),
         "priority_shipping": p_s,
         "is_promoted": _promo,
-        "payment_method": random.choice(_payments),
-        "ts": datetime.datetime.now().isoformat(),
+        "payment_method": random.choice(_PAYMENTS),
+        "ts": utc_isoformat(produced_at_us),
         "contact_me": "github.com/miztiik",
         "is_return": is_return,
     }
@@ -123,14 +162,354 @@ def generate_event():
         "event_type": _evnt_type,
         "priority_shipping": str(p_s),
         "is_return": str(is_return),
+        PRODUCED_AT: produced_at_us,
     }
 
     return evnt_body, _attr
 
 
+class EventBatch:
+    """
+    Column arrays for N events drawn by `generate_events`.
+
+    Rows are only turned into dicts, or JSON bytes, when iterated. `ts` is
+    stamped as each row is materialized, so paced producers still get the
+    send time rather than the batch creation time.
+    """
+
+    def __init__(self, columns: dict, n: int, store_fqdn: str, store_ip: str):
+        self.columns = columns
+        self.n = n
+        self.store_fqdn = store_fqdn
+        self.store_ip = store_ip
+
+    def __len__(self):
+        return self.n
+
+    def head(self, n: int) -> "EventBatch":
+        """The first `n` events, as views on the same column arrays."""
+        return EventBatch(
+            {name: col[:n] for name, col in self.columns.items()},
+            min(n, self.n),
+            self.store_fqdn,
+            self.store_ip,
+        )
+
+    def _decode(self) -> dict:
+        # Bulk convert every column to python objects once, not per row
+        c = self.columns
+        hexed = c["id"].tobytes().hex()
+        ids = []
+        for o in range(0, len(hexed), 32):
+            h = hexed[o : o + 32]
+            ids.append(f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}")
+        _d = {"id": ids}
+        for name, vocab in (
+            ("event_type", _EVNT_TYPES),
+            ("device_type", _DEVICE_TYPES),
+            ("browser", _BROWSERS),
+            ("os", _OS),
+            ("category", _CATEGORIES),
+            ("currency", _CURRENCIES),
+            ("variant", _VARIANTS),
+            ("payment_method", _PAYMENTS),
+        ):
+            _d[name] = [vocab[i] for i in c[name].tolist()]
+        for name in c:
+            if name not in _d:
+                _d[name] = c[name].tolist()
+        return _d
+
+    def iter_events(self):
+        """Yield `(evnt_body, evnt_attr)` tuples, like `generate_event`."""
+        d = self._decode()
+        for i in range(self.n):
+            produced_at_us = utc_now_us()
+            evnt_body = {
+                "id": d["id"][i],
+                "event_type": d["event_type"][i],
+                "store_id": d["store_id"][i],
+                "store_fqdn": self.store_fqdn,
+                "store_ip": self.store_ip,
+                "cust_id": d["cust_id"][i],
+                "device_type": d["device_type"][i],
+                "browser": d["browser"][i],
+                "os": d["os"][i],
+                "category": d["category"][i],
+                "sku": d["sku"][i],
+                "price": d["price"][i],
+                "qty": d["qty"][i],
+                "currency": d["currency"][i],
+                "discount": d["discount"][i],
+                "gift_wrap": d["gift_wrap"][i],
+                "variant": d["variant"][i],
+                "priority_shipping": d["priority_shipping"][i],
+                "is_promoted": d["is_promoted"][i],
+                "payment_method": d["payment_method"][i],
+                "ts": utc_isoformat(produced_at_us),
+                "contact_me": "github.com/miztiik",
+                "is_return": d["is_return"][i],
+            }
+            if d["payload_bytes"][i]:
+                evnt_body["padding"] = _PADDING[: d["payload_bytes"][i]]
+            if d["bad_msg"][i]:
+                evnt_body.pop("store_id", None)
+                evnt_body["bad_msg"] = True
+
+            _attr = {
+                "event_type": evnt_body["event_type"],
+                "priority_shipping": str(evnt_body["priority_shipping"]),
+                "is_return": str(evnt_body["is_return"]),
+                PRODUCED_AT: produced_at_us,
+            }
+            yield evnt_body, _attr
+
+    def to_dicts(self) -> list:
+        return [evnt_body for evnt_body, _ in self.iter_events()]
+
+    def iter_bytes(self):
+        """Yield each event as UTF-8 JSON bytes."""
+        for evnt_body, _ in self.iter_events():
+            yield encode_event(evnt_body)
+
+    def to_ndjson(self) -> bytes:
+        return encode_ndjson(evnt_body for evnt_body, _ in self.iter_events())
+
+
+_VOCABS = {
+    "event_type": _EVNT_TYPES,
+    "device_type": _DEVICE_TYPES,
+    "browser": _BROWSERS,
+    "os": _OS,
+    "category": _CATEGORIES,
+    "currency": _CURRENCIES,
+    "variant": _VARIANTS,
+    "payment_method": _PAYMENTS,
+}
+
+# What a workload profile falls back to, same as `generate_event`
+_PROFILE_DEFAULTS = {
+    "event_mix": {"sale_event": 0.8, "inventory_event": 0.2},
+    "poison_rate": _BAD_MSG_WEIGHTS[0] / sum(_BAD_MSG_WEIGHTS),
+    "int_ranges": {
+        "store_id": (1, 10),
+        "cust_id": (100, 999),
+        "sku": (18981, 189281),
+    },
+}
+
+_workload_profile = None
+
+
+def get_workload_profile() -> WorkloadProfile:
+    """The WORKLOAD_PROFILE file compiled once, or the built in distributions."""
+    global _workload_profile
+    if _workload_profile is None:
+        if GlobalArgs.WORKLOAD_PROFILE:
+            _workload_profile = WorkloadProfile.from_file(
+                GlobalArgs.WORKLOAD_PROFILE, _VOCABS, _PROFILE_DEFAULTS
+            )
+        else:
+            _workload_profile = WorkloadProfile({}, _VOCABS, _PROFILE_DEFAULTS)
+    return _workload_profile
+
+
+def generate_events(
+    n: int, rng: np.random.Generator = None, profile: WorkloadProfile = None
+) -> EventBatch:
+    """
+    Draw N events at once. Without a WORKLOAD_PROFILE the distributions match
+    `generate_event`: 80/20 sale/inventory, 30% priority shipping, 50% returns
+    among inventory events and the `_BAD_MSG_WEIGHTS` share of poison pills.
+    """
+    rng = rng or np.random.default_rng()
+    profile = profile or get_workload_profile()
+    _host = get_host_identity()
+
+    def _flip(p):
+        return rng.random(n) < p
+
+    # Random v4 uuids: 16 random bytes with the version and variant bits set
+    ids = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    ids[:, 6] = (ids[:, 6] & 0x0F) | 0x40
+    ids[:, 8] = (ids[:, 8] & 0x3F) | 0x80
+
+    evnt_type = profile.event_mix.sample(rng, n)
+    is_inventory = evnt_type == _EVNT_TYPES.index("inventory_event")
+
+    bad_msg = np.zeros(n, dtype=bool)
+    if GlobalArgs.TRIGGER_RANDOM_FAILURES:
+        bad_msg = _flip(profile.poison_rate)
+
+    columns = {
+        "id": ids,
+        "event_type": evnt_type,
+        "store_id": profile.ints["store_id"].sample(rng, n),
+        "cust_id": profile.ints["cust_id"].sample(rng, n),
+        "device_type": profile.sample_choice("device_type", rng, n),
+        "browser": profile.sample_choice("browser", rng, n),
+        "os": profile.sample_choice("os", rng, n),
+        "category": profile.sample_choice("category", rng, n),
+        "sku": profile.ints["sku"].sample(rng, n),
+        "price": np.round(rng.random(n) * 100, 2),
+        "qty": rng.integers(1, 100, size=n),
+        "currency": profile.sample_choice("currency", rng, n),
+        "discount": rng.integers(0, 76, size=n),
+        "gift_wrap": _flip(0.3),
+        "variant": profile.sample_choice("variant", rng, n),
+        "priority_shipping": _flip(0.3),
+        "is_promoted": _flip(0.13),
+        "payment_method": profile.sample_choice("payment_method", rng, n),
+        "is_return": is_inventory & _flip(profile.return_rate),
+        "bad_msg": bad_msg,
+        "payload_bytes": profile.sample_payload_bytes(rng, n),
+    }
+    return EventBatch(
+        columns,
+        n,
+        store_fqdn=_host.fqdn,
+        store_ip=_host.ip,
+    )
+
+
+############################################
+#        SEEDED WORKLOADS & CORPORA        #
+############################################
+
+# Seeded runs are drawn in chunks of 1, 2, 4, ... events up to this size, so a
+# short run does not draw a full chunk. Changing it changes the sequence.
+_SEED_CHUNK = 10_000
+
+# Fixed width corpus record, about 55 bytes per event
+_CORPUS_DTYPE = np.dtype(
+    [
+        ("id", np.uint8, (16,)),
+        ("event_type", np.int8),
+        ("store_id", np.int32),
+        ("cust_id", np.int32),
+        ("device_type", np.int8),
+        ("browser", np.int8),
+        ("os", np.int8),
+        ("category", np.int8),
+        ("sku", np.int32),
+        ("price", np.float64),
+        ("qty", np.int8),
+        ("currency", np.int8),
+        ("discount", np.int8),
+        ("gift_wrap", np.bool_),
+        ("variant", np.int8),
+        ("priority_shipping", np.bool_),
+        ("is_promoted", np.bool_),
+        ("payment_method", np.int8),
+        ("is_return", np.bool_),
+        ("bad_msg", np.bool_),
+        ("payload_bytes", np.int32),
+    ]
+)
+
+
+def iter_seeded_batches(seed: int, shard: int = 0, n: int = None):
+    """
+    Yield `EventBatch`es for `n` events from the `(seed, shard)` stream. The
+    same seed and shard always give the same events, only `ts` (stamped at
+    send time) and the host fields differ between runs.
+
+    Chunk sizes double up to `_SEED_CHUNK` whatever `n` is, and every chunk
+    is drawn whole and the last one cut to size, so the first `k` events of
+    the stream are the same whatever `n` is. Below `_SEED_CHUNK`, at most
+    about `2 * n` events are drawn.
+    """
+    rng = np.random.default_rng([seed, shard])
+    start, size = 0, 1
+    while start < n:
+        with _tracer.start_as_current_span("generate_events") as span:
+            span.set_attribute("event_count", min(size, n - start))
+            with _metrics.time("generate"):
+                batch = generate_events(size, rng=rng)
+        yield batch.head(n - start)
+        start += size
+        size = min(2 * size, _SEED_CHUNK)
+
+
+def write_corpus(path: str, n: int, seed: int, shard: int = 0) -> dict:
+    """Write `n` seeded events to a `.npy` corpus that `iter_corpus` can replay."""
+    records = np.lib.format.open_memmap(
+        path, mode="w+", dtype=_CORPUS_DTYPE, shape=(n,)
+    )
+    start = 0
+    for batch in iter_seeded_batches(seed, shard, n):
+        chunk = records[start : start + len(batch)]
+        for name in _CORPUS_DTYPE.names:
+            chunk[name] = batch.columns[name]
+        start += len(batch)
+    records.flush()
+    del records
+    return {"path": path, "events": n, "seed": seed, "shard": shard}
+
+
+def iter_corpus(path: str, limit: int = None):
+    """
+    Replay `(evnt_body, evnt_attr)` tuples from a corpus. The file is memory
+    mapped and decoded a chunk at a time, so nothing is generated or loaded
+    up front.
+    """
+    records = np.load(path, mmap_mode="r")
+    n = len(records) if limit is None else min(limit, len(records))
+    _host = get_host_identity()
+    for start in range(0, n, _SEED_CHUNK):
+        chunk = records[start : min(start + _SEED_CHUNK, n)]
+        batch = EventBatch(
+            {name: chunk[name] for name in _CORPUS_DTYPE.names},
+            len(chunk),
+            store_fqdn=_host.fqdn,
+            store_ip=_host.ip,
+        )
+        yield from batch.iter_events()
+
+
+def _event_source(event_cnt: int):
+    """
+    Corpus replay, seeded or random events, in that order of preference.
+    Returns the events and a description for the response; random runs
+    report the seed they drew, so they can be repeated.
+    """
+    if GlobalArgs.EVENT_CORPUS:
+        return iter_corpus(GlobalArgs.EVENT_CORPUS, limit=event_cnt), {
+            "corpus": GlobalArgs.EVENT_CORPUS
+        }
+    seed = GlobalArgs.EVENT_SEED
+    if seed is None:
+        seed = random.SystemRandom().randrange(2**32)
+    _src = {"seed": int(seed), "shard": GlobalArgs.EVENT_SHARD}
+    batches = iter_seeded_batches(_src["seed"], _src["shard"], event_cnt)
+    return (evnt for batch in batches for evnt in batch.iter_events()), _src
+
+
+def _new_producer_sinks():
+    """
+    The sinks every produced event is dispatched to, and the process wide
+    Service Bus batch senders behind them, which the caller flushes.
+    """
+    q_sender = get_svc_bus_batch_sender("queue")
+    topic_sender = get_svc_bus_batch_sender("topic")
+    sinks = SinkDispatcher(
+        {
+            # "blob": SinkSpec(lambda d, _: write_to_blob(d)),
+            # "svc_bus_q": SinkSpec(q_sender.send),
+            "svc_bus_topic": SinkSpec(topic_sender.send),
+            # "event_hub": SinkSpec(write_to_event_hub),
+            # "cosmos": SinkSpec(lambda d, _: write_to_cosmosdb(d)),
+        }
+    )
+    return sinks, {"queue": q_sender, "topic": topic_sender}
+
+
 def evnt_producer(event_cnt: int):
     resp = {"status": False, "tot_msgs": 0}
 
+    pacer = _get_pacer()
+    sinks, senders = _new_producer_sinks()
+
     try:
         t_msgs = 0
         p_cnt = 0
@@ -140,12 +519,14 @@ def evnt_producer(event_cnt: int):
 
         # Start timing the event generation
         event_gen_start_time = time.time()
+        metrics_cp = _metrics.checkpoint()
 
         if not event_cnt:
             event_cnt = GlobalArgs.TOT_MSGS_TO_PRODUCE
 
-        while t_msgs < event_cnt:
-            evnt_body, evnt_attr = generate_event()
+        # Rows are drawn a chunk at a time and materialized as they are sent
+        evnts, resp["event_source"] = _event_source(event_cnt)
+        for evnt_body, evnt_attr in evnts:
             t_msgs += 1
             t_sales += evnt_body["price"] * evnt_body["qty"]
 
@@ -157,42 +538,164 @@ def evnt_producer(event_cnt: int):
             elif evnt_attr["event_type"] == "inventory_event":
                 inventory_evnts += 1
 
-            time.sleep(GlobalArgs.WAIT_SECS_BETWEEN_MSGS)
-            logging.info(f"{json.dumps(evnt_body)}")
+            pacer.wait()
+            _event_log.info("%s", LazyJson(evnt_body))
 
-            # write to blob
-            # write_to_blob(evnt_body)
+            # Write to all sinks in parallel
+            sinks.dispatch(evnt_body, evnt_attr)
 
-            # Write To Service Bus Queue
-            # write_to_svc_bus_q(evnt_body, evnt_attr)
+        # Send whatever is still lingering in the Service Bus batches
+        for sender in senders.values():
+            sender.flush()
 
-            # Write To Service Bus Topic
-            write_to_svc_bus_topic(evnt_body, evnt_attr)
+        event_gen_end_time = time.time()  # Stop timing the event generation
+        event_gen_duration = round(event_gen_end_time - event_gen_start_time, 3)
+        _metrics.add("events_produced", t_msgs)
 
-            # Write To Event Hub
-            # write_to_event_hub(evnt_body, evnt_attr)
+        resp["event_gen_duration"] = event_gen_duration
+        resp["tot_msgs"] = t_msgs
+        resp["bad_msgs"] = p_cnt
+        resp["sale_evnts"] = s_evnts
+        resp["inventory_evnts"] = inventory_evnts
+        resp["tot_sales"] = round(t_sales, 4)
+        resp["status"] = True
+        resp["sample_event"] = evnt_body
+        resp["cred_stats"] = get_cred_stats()
+        resp["rate"] = pacer.get_stats()
+        resp["metrics"] = _metrics.snapshot(since=metrics_cp)
+        resp["sink_results"] = sinks.get_stats()
+        # Totals of the shared senders, since the process started
+        resp["svc_bus_batches"] = {k: s.get_stats() for k, s in senders.items()}
 
-            # write to cosmosdb
-            # write_to_cosmosdb(evnt_body)
+    except Exception as e:
+        logging.error(f"ERROR: {type(e).__name__}: {str(e)}")
+        resp["err_msg"] = f"ERROR: {type(e).__name__}: {str(e)}"
+
+    return resp
+
+
+async def evnt_producer_async(event_cnt: int):
+    """
+    Async flavour of `evnt_producer`, with the same sinks and Service Bus
+    batch senders. Dispatches are scheduled as tasks instead of being
+    awaited in line, so up to MAX_IN_FLIGHT_SENDS events are in flight while
+    the next ones are generated.
+    """
+    resp = {"status": False, "tot_msgs": 0}
+    in_flight = asyncio.Semaphore(GlobalArgs.MAX_IN_FLIGHT_SENDS)
+    pacer = _get_pacer()
+    sinks, senders = _new_producer_sinks()
+    pending = set()
+    failed = []
+
+    def _on_done(task):
+        pending.discard(task)
+        # Retrieving the exception here also keeps asyncio from logging it as lost
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task.exception())
+
+    async def _send(evnt_body, evnt_attr):
+        try:
+            # The dispatcher waits on the sink pool, keep that off the loop
+            await asyncio.to_thread(sinks.dispatch, evnt_body, evnt_attr)
+        finally:
+            in_flight.release()
+
+    try:
+        t_msgs = 0
+        p_cnt = 0
+        s_evnts = 0
+        inventory_evnts = 0
+        t_sales = 0
+
+        # Start timing the event generation
+        event_gen_start_time = time.time()
+        metrics_cp = _metrics.checkpoint()
+
+        if not event_cnt:
+            event_cnt = GlobalArgs.TOT_MSGS_TO_PRODUCE
+
+        # Rows are drawn a chunk at a time and materialized as they are sent
+        evnts, resp["event_source"] = _event_source(event_cnt)
+        for evnt_body, evnt_attr in evnts:
+            t_msgs += 1
+            t_sales += evnt_body["price"] * evnt_body["qty"]
+
+            if evnt_body.get("bad_msg"):
+                p_cnt += 1
+
+            if evnt_attr["event_type"] == "sale_event":
+                s_evnts += 1
+            elif evnt_attr["event_type"] == "inventory_event":
+                inventory_evnts += 1
+
+            await pacer.wait_async()
+            _event_log.info("%s", LazyJson(evnt_body))
+
+            await in_flight.acquire()
+            task = asyncio.create_task(_send(evnt_body, evnt_attr))
+            pending.add(task)
+            task.add_done_callback(_on_done)
+
+        # Wait for the sends still on the wire, failures are counted by _on_done
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Send whatever is still lingering in the Service Bus batches
+        for sender in senders.values():
+            await asyncio.to_thread(sender.flush)
 
         event_gen_end_time = time.time()  # Stop timing the event generation
         event_gen_duration = round(event_gen_end_time - event_gen_start_time, 3)
+        _metrics.add("events_produced", t_msgs - len(failed))
 
         resp["event_gen_duration"] = event_gen_duration
-        resp["tot_msgs"] = t_msgs
+        resp["tot_msgs"] = t_msgs - len(failed)
+        resp["failed_msgs"] = len(failed)
         resp["bad_msgs"] = p_cnt
         resp["sale_evnts"] = s_evnts
         resp["inventory_evnts"] = inventory_evnts
         resp["tot_sales"] = round(t_sales, 4)
-        resp["status"] = True
+        resp["status"] = not failed
+        if failed:
+            resp["err_msg"] = (
+                f"{len(failed)} of {t_msgs} sends failed, first: "
+                f"{type(failed[0]).__name__}: {str(failed[0])}"
+            )
         resp["sample_event"] = evnt_body
+        resp["cred_stats"] = get_cred_stats()
+        resp["rate"] = pacer.get_stats()
+        resp["metrics"] = _metrics.snapshot(since=metrics_cp)
+        resp["sink_results"] = sinks.get_stats()
+        # Totals of the shared senders, since the process started
+        resp["svc_bus_batches"] = {k: s.get_stats() for k, s in senders.items()}
 
     except Exception as e:
         logging.error(f"ERROR: {type(e).__name__}: {str(e)}")
         resp["err_msg"] = f"ERROR: {type(e).__name__}: {str(e)}"
+        for task in pending:
+            task.cancel()
 
     return resp
 
 
 if __name__ == "__main__":
-    evnt_producer()
+    parser = argparse.ArgumentParser(
+        description="Produce store events, or write a replayable event corpus"
+    )
+    parser.add_argument(
+        "--write-corpus", metavar="PATH", help="Write a .npy corpus and exit"
+    )
+    parser.add_argument("--events", type=int, default=GlobalArgs.TOT_MSGS_TO_PRODUCE)
+    parser.add_argument("--seed", type=int, default=GlobalArgs.EVENT_SEED)
+    parser.add_argument("--shard", type=int, default=GlobalArgs.EVENT_SHARD)
+    args = parser.parse_args()
+
+    if args.write_corpus:
+        if args.seed is None:
+            parser.error("--write-corpus needs --seed or EVENT_SEED")
+        print(
+            json.dumps(
+                write_corpus(args.write_corpus, args.events, args.seed, args.shard)
+            )
+        )
+    else:
+        evnt_producer(args.events)
@@ -5,7 +5,10 @@ import time
 import os
 import random
 import uuid
-import socket
+
+from host_identity import get_host_identity
+from producer_shards import get_pacer, run_shards
+from log_pipeline import LazyJson, configure_logging, flush_logging, get_event_logger
 
 # ANSI color codes
 GREEN_COLOR = "\033[32m"
@@ -21,6 +24,12 @@ class GlobalArgs:
     TRIGGER_RANDOM_FAILURES = os.getenv("TRIGGER_RANDOM_FAILURES", True)
     WAIT_SECS_BETWEEN_MSGS = int(os.getenv("WAIT_SECS_BETWEEN_MSGS", 2))
     TOT_MSGS_TO_PRODUCE = int(os.getenv("TOT_MSGS_TO_PRODUCE", 10))
+    # Producer processes, 1 keeps the single loop, 0 means one per core
+    PRODUCER_WORKERS = int(os.getenv("PRODUCER_WORKERS", 1))
+    # Worker N is seeded with PRODUCER_SEED + N, random when unset
+    PRODUCER_SEED = os.getenv("PRODUCER_SEED")
+    # queued: the file and console handlers run on a background thread
+    LOG_MODE = os.getenv("LOG_MODE", "queued")
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL, log_filename="/var/log/miztiik.json"):
     logging.basicConfig(level=lv)
@@ -34,12 +43,21 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL, log_filename="/var/log/miztiik.json"):
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
     logger.addHandler(fh)
+    configure_logging(GlobalArgs.LOG_MODE)
     return logger
 
 # Example usage with logging
 logging.info(f'{GREEN_COLOR}This is green text{RESET_COLOR}')
 
 logger = set_logging()
+_event_log = get_event_logger()
+
+def _get_pacer(share: float = 1.0):
+    # TARGET_EVENTS_PER_SEC wins, else keep the old WAIT_SECS_BETWEEN_MSGS cadence
+    default_eps = 0
+    if GlobalArgs.WAIT_SECS_BETWEEN_MSGS > 0:
+        default_eps = 1 / GlobalArgs.WAIT_SECS_BETWEEN_MSGS
+    return get_pacer(default_eps, share)
 
 def _rand_coin_flip():
     r = False
@@ -48,9 +66,11 @@ def _rand_coin_flip():
     return r
 
 def _gen_uuid():
-    return str(uuid.uuid4())
+    # Drawn from `random`, so a seeded shard gets its own id sequence
+    return str(uuid.UUID(int=random.getrandbits(128), version=4))
 
 def generate_event():
+    _host = get_host_identity()
 
     # Following Patterns are implemented
     # If event_type is inventory_event, then is_return is True for 50% of the events
@@ -78,8 +98,8 @@ def generate_event():
         "id": _u,
         "event_type": _evnt_type,
         "store_id": random.randint(1, 10),
-        "store_fqdn": str(socket.getfqdn()),
-        "store_ip": str(socket.gethostbyname(socket.gethostname())),
+        "store_fqdn": _host.fqdn,
+        "store_ip": _host.ip,
         "cust_id": random.randint(100, 999),
         "category": random.choice(_categories),
         "sku": random.randint(18981, 189281),
@@ -108,12 +128,13 @@ def generate_event():
 
     return evnt_body, _attr
 
-def evnt_producer():
+def evnt_producer(event_cnt: int = None, rate_share: float = 1.0):
     resp = {
         "status": False,
         "tot_msgs": 0
     }
 
+    pacer = _get_pacer(rate_share)
     try:
         t_msgs = 0
         p_cnt = 0
@@ -124,7 +145,11 @@ def evnt_producer():
         # Start timing the event generation
         event_gen_start_time = time.time()  
 
-        while t_msgs < GlobalArgs.TOT_MSGS_TO_PRODUCE:
+        if not event_cnt:
+            event_cnt = GlobalArgs.TOT_MSGS_TO_PRODUCE
+
+        while t_msgs < event_cnt:
+            pacer.wait()
             evnt_body, evnt_attr = generate_event()
             t_msgs += 1
             t_sales += evnt_body["price"] * evnt_body["qty"]
@@ -137,8 +162,7 @@ def evnt_producer():
             elif evnt_attr["event_type"] == "inventory_event":
                 inventory_evnts += 1
 
-            time.sleep(GlobalArgs.WAIT_SECS_BETWEEN_MSGS)
-            logging.info(f"generated_event: {t_msgs}/{GlobalArgs.TOT_MSGS_TO_PRODUCE} - {json.dumps(evnt_body)}")
+            _event_log.info("generated_event: %s/%s - %s", t_msgs, event_cnt, LazyJson(evnt_body))
 
         event_gen_end_time = time.time()  # Stop timing the event generation
         event_gen_duration = event_gen_end_time - event_gen_start_time  # Calculate the duration
@@ -149,15 +173,39 @@ def evnt_producer():
         resp["sale_evnts"] = s_evnts
         resp["inventory_evnts"] = inventory_evnts
         resp["tot_sales"] = t_sales
+        resp["rate"] = pacer.get_stats()
         resp["status"] = True
 
     except Exception as e:
-        logging.ERROR(f"ERROR: {str(e)}")
+        logging.error(f"ERROR: {str(e)}")
         resp["err_msg"] = str(e)
 
     return resp
 
 
+def _shard_worker(shard: dict):
+    # Runs in a fresh worker process; seeding `random` makes the shard's ids
+    # and events its own, and any sink clients are created here, not inherited
+    random.seed(shard["seed"])
+    r = evnt_producer(event_cnt=shard["event_cnt"], rate_share=shard["rate_share"])
+    # Pool workers exit without running atexit, write out the queued records
+    flush_logging()
+    return r
+
+
+def sharded_evnt_producer(workers: int = None, event_cnt: int = None):
+    """
+    Split `event_cnt` events across `workers` processes, see `run_shards`,
+    each paced at its share of the target rate.
+    """
+    return run_shards(
+        _shard_worker,
+        workers or GlobalArgs.PRODUCER_WORKERS,
+        event_cnt or GlobalArgs.TOT_MSGS_TO_PRODUCE,
+        GlobalArgs.PRODUCER_SEED,
+    )
+
+
 def main(msg_cnt: int = 10):
     _d={
         "miztiik_event_processed": False,
@@ -170,10 +218,13 @@ def main(msg_cnt: int = 10):
                 logging.info(f"Received Count: {msg_cnt}")
                 GlobalArgs.TOT_MSGS_TO_PRODUCE = int(msg_cnt)
         except ValueError:
-            logging.ERROR(f"got from params: {msg_cnt}")
+            logging.error(f"got from params: {msg_cnt}")
             pass
         # Call the event generator
-        resp = evnt_producer()
+        if GlobalArgs.PRODUCER_WORKERS == 1:
+            resp = evnt_producer()
+        else:
+            resp = sharded_evnt_producer()
         _d["resp"] = resp
         if resp.get("status"):
             _d["miztiik_event_processed"] = True
@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import collections
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-26"
+    # Off unless set: no hooks are installed and the profile routes answer 404
+    ENABLE_PROFILING = os.getenv("ENABLE_PROFILING", "false").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+    PROFILE_MAX_SECS = float(os.getenv("PROFILE_MAX_SECS", 60))
+    PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", 25))
+
+
+class ProfilerBusy(RuntimeError):
+    """Another profile is running; only one at a time, to bound the overhead."""
+
+
+# cProfile and the sampler both hook the interpreter, one profile at a time
+_profile_lock = threading.Lock()
+
+
+def profiling_enabled() -> bool:
+    return GlobalArgs.ENABLE_PROFILING
+
+
+############################################
+#           SAMPLING PROFILER              #
+############################################
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread reads every thread's stack
+    each `interval_ms`, for at most `max_secs`. Nothing is hooked into the
+    profiled code, so its cost is the sampler thread's own, about 1% at the
+    default 5ms. The result is folded ("collapsed") stacks, one
+    `thread;frame;frame count` line per distinct stack, which flamegraph.pl,
+    speedscope and inferno take as they are.
+    """
+
+    def __init__(self, interval_ms: float = None, max_secs: float = None):
+        self.interval_secs = (interval_ms or GlobalArgs.PROFILE_INTERVAL_MS) / 1000
+        self.max_secs = min(
+            max_secs or GlobalArgs.PROFILE_MAX_SECS, GlobalArgs.PROFILE_MAX_SECS
+        )
+        self.calls = 0
+        self.samples = 0
+        self.duration_secs = 0
+        self._stacks = collections.Counter()
+        self._names = {}
+        # Last (frame, instruction) each thread was at, and the threads that moved
+        self._last_pos = {}
+        self._moved = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        if not _profile_lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        self._thread = threading.Thread(
+            target=self._run, name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        _profile_lock.release()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        start_time = time.monotonic()
+        deadline = start_time + self.max_secs
+        while not self._stop.wait(self.interval_secs):
+            if time.monotonic() > deadline:
+                break
+            threads = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                _thread = threads.get(thread_id, thread_id)
+                _pos = (id(frame), frame.f_lasti)
+                if self._last_pos.setdefault(thread_id, _pos) != _pos:
+                    self._moved.add(_thread)
+                self._last_pos[thread_id] = _pos
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                self._stacks[(_thread, tuple(stack))] += 1
+            self.samples += 1
+        self.duration_secs = round(time.monotonic() - start_time, 3)
+
+    def _frame_name(self, code) -> str:
+        name = self._names.get(code)
+        if name is None:
+            # co_qualname, with the class name, is 3.11+
+            _fn = getattr(code, "co_qualname", code.co_name)
+            name = f"{os.path.basename(code.co_filename)}:{_fn}"
+            self._names[code] = name
+        return name
+
+    def collapsed(self) -> str:
+        lines = [
+            ";".join([str(thread), *map(self._frame_name, stack)]) + f" {count}"
+            for (thread, stack), count in self._stacks.most_common()
+        ]
+        return "\n".join(lines) + "\n"
+
+    def top(self, top_n: int) -> list:
+        """
+        The `top_n` functions by the samples they were running in (`self`)
+        and on the stack for (`total`). Threads that never moved, such as
+        idle workers or a caller blocked on a result, are left out.
+        """
+        own = collections.Counter()
+        total = collections.Counter()
+        for (thread, stack), count in self._stacks.items():
+            if thread not in self._moved:
+                continue
+            own[stack[-1]] += count
+            for code in set(stack):
+                total[code] += count
+        rows = sorted(total, key=lambda code: (own[code], total[code]), reverse=True)
+        return [
+            {"func": self._frame_name(code), "self": own[code], "total": total[code]}
+            for code in rows[:top_n]
+        ]
+
+    def get_stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "samples": self.samples,
+            "stacks": len(self._stacks),
+            "interval_ms": self.interval_secs * 1000,
+            "duration_secs": self.duration_secs,
+        }
+
+
+def sample_window(fn, secs: float, interval_ms: float = None) -> SamplingProfiler:
+    """
+    Call `fn` back to back for `secs` (at least once) under a sampler, so a
+    short call still gathers enough samples. The window is capped at
+    PROFILE_MAX_SECS; raises `ProfilerBusy` if a profile is running.
+    """
+    prof = SamplingProfiler(interval_ms=interval_ms, max_secs=secs)
+    deadline = time.monotonic() + prof.max_secs
+    with prof:
+        while True:
+            fn()
+            prof.calls += 1
+            if time.monotonic() >= deadline:
+                break
+    return prof
+
+
+############################################
+#           PER REQUEST PROFILE            #
+############################################
+
+
+class RequestProfile:
+    """
+    cProfile around one call, plus the stacks of every thread sampled
+    meanwhile. cProfile only sees the thread it is enabled on: the calling
+    thread and, for a coroutine passed through `profiled`, the thread of the
+    loop it runs on. Under an event loop, whatever else runs on the loop
+    meanwhile is counted too. Work handed to pool threads only shows up in
+    the sampled stacks.
+
+    `stats` is filled in on exit with the `top_n` functions by cumulative
+    time, and the sampled ones under `sampled`. When a profile is already
+    running the call goes ahead unprofiled.
+    """
+
+    def __init__(self, top_n: int = None, interval_ms: float = None):
+        self.top_n = top_n or GlobalArgs.PROFILE_TOP_N
+        self.stats = {}
+        self._sampler = SamplingProfiler(interval_ms=interval_ms)
+        self._profs = []
+
+    def __enter__(self):
+        try:
+            self._sampler.start()
+        except ProfilerBusy as e:
+            self.stats = {"skipped": str(e)}
+            self._sampler = None
+            return self
+        self._profs.append(cProfile.Profile())
+        self._profs[0].enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._sampler is None:
+            return
+        self._profs[0].disable()
+        self._sampler.stop()
+        self.stats = self._summarize()
+
+    async def profiled(self, coro):
+        """Await `coro` with cProfile on, on the loop's thread."""
+        if self._sampler is None:
+            return await coro
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # 3.12+: cProfile is process wide and the caller's already sees this
+            return await coro
+        self._profs.append(prof)
+        try:
+            return await coro
+        finally:
+            prof.disable()
+
+    def _summarize(self) -> dict:
+        _s = pstats.Stats(*self._profs)
+        rows = sorted(_s.stats.items(), key=lambda kv: kv[1][3], reverse=True)
+        return {
+            "total_secs": round(_s.total_tt, 6),
+            "top": [
+                {
+                    "func": f"{os.path.basename(file)}:{line}({name})",
+                    "ncalls": nc,
+                    "tottime": round(tt, 6),
+                    "cumtime": round(ct, 6),
+                }
+                for (file, line, name), (_, nc, tt, ct, _) in rows[: self.top_n]
+            ],
+            "sampled": {
+                "samples": self._sampler.samples,
+                "interval_ms": self._sampler.interval_secs * 1000,
+                "duration_secs": self._sampler.duration_secs,
+                "threads": sorted(map(str, self._sampler._moved)),
+                "top": self._sampler.top(self.top_n),
+            },
+        }
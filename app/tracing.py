@@ -0,0 +1,106 @@
+import os
+import atexit
+import logging
+import threading
+
+from opentelemetry import metrics
+from opentelemetry import trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2024-06-18"
+    SVC_NAME = os.getenv(
+        "OTEL_SERVICE_NAME", os.getenv("WEBSITE_SITE_NAME", "store-backend-ops")
+    )
+    # Fraction of traces kept; spans follow their parent's decision
+    TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 0.2))
+    APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv(
+        "APPLICATIONINSIGHTS_CONNECTION_STRING"
+    )
+    METRICS_EXPORT_INTERVAL_MS = int(os.getenv("METRICS_EXPORT_INTERVAL_MS", 60000))
+
+
+_tracer_provider = None
+_meter_provider = None
+_provider_lock = threading.Lock()
+
+
+def _resource() -> Resource:
+    return Resource.create({"service.name": GlobalArgs.SVC_NAME})
+
+
+def _new_tracer_provider() -> TracerProvider:
+    provider = TracerProvider(
+        resource=_resource(),
+        sampler=ParentBased(TraceIdRatioBased(GlobalArgs.TRACE_SAMPLE_RATIO)),
+    )
+    if GlobalArgs.APPLICATIONINSIGHTS_CONNECTION_STRING:
+        from azure.monitor.opentelemetry.exporter import AzureMonitorTraceExporter
+
+        # This is the exporter that sends data to Application Insights
+        provider.add_span_processor(
+            BatchSpanProcessor(
+                AzureMonitorTraceExporter(
+                    connection_string=GlobalArgs.APPLICATIONINSIGHTS_CONNECTION_STRING
+                )
+            )
+        )
+    else:
+        logging.info("APPLICATIONINSIGHTS_CONNECTION_STRING not set, spans stay local")
+    return provider
+
+
+def get_tracer_provider() -> TracerProvider:
+    """
+    Process wide provider, with its sampler, exporter and export thread set
+    up on first use. Shut down, flushing pending spans, at exit.
+    """
+    global _tracer_provider
+    if _tracer_provider is None:
+        with _provider_lock:
+            if _tracer_provider is None:
+                provider = _new_tracer_provider()
+                trace.set_tracer_provider(provider)
+                atexit.register(provider.shutdown)
+                _tracer_provider = provider
+    return _tracer_provider
+
+
+def get_tracer(name: str) -> trace.Tracer:
+    return get_tracer_provider().get_tracer(name)
+
+
+def _new_meter_provider() -> MeterProvider:
+    readers = []
+    if GlobalArgs.APPLICATIONINSIGHTS_CONNECTION_STRING:
+        from azure.monitor.opentelemetry.exporter import AzureMonitorMetricExporter
+
+        readers.append(
+            PeriodicExportingMetricReader(
+                AzureMonitorMetricExporter(
+                    connection_string=GlobalArgs.APPLICATIONINSIGHTS_CONNECTION_STRING
+                ),
+                export_interval_millis=GlobalArgs.METRICS_EXPORT_INTERVAL_MS,
+            )
+        )
+    return MeterProvider(resource=_resource(), metric_readers=readers)
+
+
+def get_meter_provider() -> MeterProvider:
+    """Process wide provider for the stage metrics, see stage_metrics.py."""
+    global _meter_provider
+    if _meter_provider is None:
+        with _provider_lock:
+            if _meter_provider is None:
+                provider = _new_meter_provider()
+                metrics.set_meter_provider(provider)
+                atexit.register(provider.shutdown)
+                _meter_provider = provider
+    return _meter_provider
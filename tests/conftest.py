@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The function app modules import each other as top level modules
+APP_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "app",
+    "function_code",
+    "store-backend-ops-v2",
+)
+sys.path.insert(0, APP_DIR)
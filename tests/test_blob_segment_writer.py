@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import az_utils
+
+
+class FakeAppendBlob:
+    def __init__(self, fail_times=0):
+        self.blob_name = "seg.ndjson"
+        self.blocks = []
+        self.fail_times = fail_times
+        self.attempted_at = []
+        self.gate = None
+
+    async def append_block(self, data):
+        self.attempted_at.append(time.monotonic())
+        if self.gate:
+            await asyncio.to_thread(self.gate.wait, 5)
+        if self.fail_times:
+            self.fail_times -= 1
+            raise IOError("append failed")
+        self.blocks.append(data)
+
+
+def _writer(blob, linger_ms=60_000):
+    w = az_utils.BlobSegmentWriter(
+        blob_svc_account_url="https://example", linger_ms=linger_ms
+    )
+    w._open_segment = lambda prefix: {
+        "blob_client": blob,
+        "bytes": 0,
+        "blocks": 0,
+        "opened_at": float("inf"),
+    }
+    return w
+
+
+def _lines(blob):
+    return b"".join(blob.blocks).splitlines()
+
+
+BACKOFF_SECS = 0.2
+
+
+@pytest.fixture(autouse=True)
+def backoff(monkeypatch):
+    monkeypatch.setattr(az_utils.GlobalArgs, "BATCH_RETRY_BACKOFF_SECS", BACKOFF_SECS)
+
+
+def test_failed_append_is_retried_after_its_backoff():
+    blob = FakeAppendBlob(fail_times=1)
+    w = _writer(blob)
+    w.write({"id": 1})
+    with pytest.raises(IOError):
+        w.flush()
+    # Not due yet
+    w.flush()
+    assert blob.blocks == []
+    assert w.get_stats()["retries_pending"] == 1
+    time.sleep(BACKOFF_SECS)
+    w.write({"id": 2})
+    w.flush()
+    assert _lines(blob) == [b'{"id":1}', b'{"id":2}']
+    assert w.get_stats()["batches_dropped"] == 0
+
+
+def test_linger_thread_waits_out_the_backoff():
+    blob = FakeAppendBlob(fail_times=1)
+    w = _writer(blob, linger_ms=20)
+    w.write({"id": 1})
+    deadline = time.monotonic() + 5
+    while not blob.blocks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _lines(blob) == [b'{"id":1}']
+    assert blob.attempted_at[1] - blob.attempted_at[0] >= BACKOFF_SECS
+    w.close()
+
+
+def test_flush_write_raises_before_the_caller_settles():
+    blob = FakeAppendBlob(fail_times=1)
+    w = _writer(blob, linger_ms=0)
+    with pytest.raises(IOError):
+        w.write({"id": 1}, flush=True)
+    w.write({"id": 2}, flush=True)
+    assert _lines(blob) == [b'{"id":2}']
+    # The failed append gets its last try on close, backoff or not
+    w.close()
+    assert _lines(blob) == [b'{"id":2}', b'{"id":1}']
+
+
+def test_write_is_not_held_up_by_a_slow_append():
+    blob = FakeAppendBlob()
+    blob.gate = threading.Event()
+    w = _writer(blob)
+    w.write({"id": 1})
+    flusher = threading.Thread(target=w.flush)
+    flusher.start()
+    while not blob.attempted_at:
+        time.sleep(0.01)
+    # The append of id 1 is under way and stuck
+    started = time.monotonic()
+    w.write({"id": 2})
+    assert time.monotonic() - started < 1
+    blob.gate.set()
+    flusher.join()
+    w.flush()
+    assert _lines(blob) == [b'{"id":1}', b'{"id":2}']
+
+
+def test_flush_waits_for_a_send_under_way():
+    blob = FakeAppendBlob(fail_times=1)
+    blob.gate = threading.Event()
+    w = _writer(blob)
+    errors = []
+
+    def _write():
+        try:
+            w.write({"id": 1}, flush=True)
+        except IOError as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=_write)
+    writer.start()
+    while not blob.attempted_at:
+        time.sleep(0.01)
+    # The append of id 1 is under way; it fails once let through
+    threading.Timer(0.1, blob.gate.set).start()
+    with pytest.raises(IOError):
+        w.flush()
+    writer.join()
+    assert len(errors) == 1
+
+
+def test_batch_dropped_after_max_send_attempts(monkeypatch):
+    monkeypatch.setattr(az_utils.GlobalArgs, "BATCH_RETRY_BACKOFF_SECS", 0)
+    blob = FakeAppendBlob(fail_times=2)
+    w = _writer(blob)
+    w._max_send_attempts = 2
+    w.write({"id": 1})
+    for _ in range(2):
+        with pytest.raises(IOError):
+            w.flush()
+    w.flush()
+    assert blob.blocks == []
+    assert w.get_stats()["batches_dropped"] == 1
@@ -0,0 +1,48 @@
+import pytest
+
+import az_utils
+
+
+class FakeBatch(list):
+    size_in_bytes = 1
+    max_size_in_bytes = 100
+
+    def add_message(self, msg):
+        self.append(msg)
+
+
+class FakeAioSender:
+    def __init__(self):
+        self.sent = []
+
+    async def create_message_batch(self):
+        return FakeBatch()
+
+    async def send_messages(self, msgs):
+        self.sent.append(msgs)
+
+
+@pytest.fixture
+def senders(monkeypatch):
+    _senders = []
+
+    def _new_sender(*_):
+        _senders.append(FakeAioSender())
+        return _senders[-1], []
+
+    monkeypatch.setattr(az_utils.GlobalArgs, "SVC_BUS_FQDN", "ns.example")
+    monkeypatch.setattr(az_utils.GlobalArgs, "SVC_BUS_Q_NAME", "store-events")
+    monkeypatch.setattr(az_utils, "_aio_clients", az_utils.AsyncClientRegistry())
+    monkeypatch.setattr(az_utils, "_new_svc_bus_q_sender_aio", _new_sender)
+    return _senders
+
+
+def test_batch_sender_shares_the_aio_client_of_single_sends(senders):
+    batcher = az_utils.SvcBusBatchSender("queue", linger_ms=0)
+    batcher.send({"id": 1}, {"event_type": "sale_event"})
+    az_utils.write_to_svc_bus_q({"id": 2}, {"event_type": "sale_event"})
+    # One client, and one connection, for the queue
+    assert len(senders) == 1
+    # The batch, then the single message
+    assert len(senders[0].sent) == 2
+    batcher.close()
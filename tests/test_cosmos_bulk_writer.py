@@ -0,0 +1,51 @@
+import pytest
+
+import az_utils
+
+
+class FakeContainer:
+    def __init__(self, charge=10.0):
+        self.charge = charge
+        self.docs = {}
+
+    async def upsert_item(self, body, response_hook=None):
+        self.docs[body["id"]] = body
+        if response_hook:
+            response_hook({"x-ms-request-charge": str(self.charge)}, body)
+
+
+@pytest.fixture
+def container(monkeypatch):
+    _c = FakeContainer()
+    monkeypatch.setattr(az_utils, "_clients", az_utils.ClientRegistry())
+    monkeypatch.setattr(az_utils, "_aio_clients", az_utils.AsyncClientRegistry())
+    monkeypatch.setattr(az_utils, "_new_cosmos_container_aio", lambda *_: (_c, []))
+    return _c
+
+
+def _docs(n, start=0):
+    return [{"id": f"doc-{i}"} for i in range(start, start + n)]
+
+
+def test_writer_is_kept_across_batches(container, monkeypatch):
+    monkeypatch.setattr(az_utils.GlobalArgs, "COSMOS_BULK_MAX_CONCURRENCY", 16)
+    monkeypatch.setattr(az_utils.GlobalArgs, "COSMOS_BULK_TARGET_RU_PER_SEC", 0)
+    first = az_utils.write_to_cosmosdb_bulk(_docs(50))
+    second = az_utils.write_to_cosmosdb_bulk(_docs(50, start=50))
+    assert az_utils.get_cosmos_bulk_writer() is az_utils.get_cosmos_bulk_writer()
+    # The second batch starts where the first one left off, not at max // 4
+    assert first["final_concurrency"] > 4
+    assert second["final_concurrency"] > first["final_concurrency"]
+    # Counts are per batch
+    assert second["docs_written"] == 50
+    assert second["tot_ru"] == 500
+    assert len(container.docs) == 100
+
+
+def test_over_target_backs_off_once_per_window(container):
+    writer = az_utils.CosmosBulkWriter(max_concurrency=16, target_ru_per_sec=1)
+    resp = writer.upsert_all(_docs(40))
+    # Every upsert is over target; halving on each would reach 1 at once
+    assert resp["docs_written"] == 40
+    assert resp["final_concurrency"] == 2
+    writer.close()
@@ -0,0 +1,62 @@
+import time
+import concurrent.futures
+
+import pytest
+
+from az_utils import run_sync
+from profiling import RequestProfile
+
+
+def _hot_loop(secs):
+    deadline = time.monotonic() + secs
+    n = 0
+    while time.monotonic() < deadline:
+        n += 1
+    return n
+
+
+async def _hot_coro(secs):
+    return _hot_loop(secs)
+
+
+def _cprofile_funcs(prof):
+    return [row["func"].split("(")[-1].rstrip(")") for row in prof.stats["top"]]
+
+
+def test_request_profile_cprofiles_the_calling_thread():
+    with RequestProfile() as prof:
+        _hot_loop(0.1)
+    assert "_hot_loop" in _cprofile_funcs(prof)
+
+
+def test_request_profile_cprofiles_a_coroutine_on_the_loop_thread():
+    # As the container's /event-producer runs the producer
+    with RequestProfile() as prof:
+        run_sync(prof.profiled(_hot_coro(0.1)))
+    assert "_hot_loop" in _cprofile_funcs(prof)
+
+
+def _on_aio_loop():
+    return run_sync(_hot_coro(0.3))
+
+
+def _on_pool_thread():
+    # As the sinks run on the dispatcher pool
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(_hot_loop, 0.3).result()
+
+
+@pytest.mark.parametrize("call", [_on_aio_loop, _on_pool_thread])
+def test_request_profile_samples_work_off_the_calling_thread(call):
+    with RequestProfile(interval_ms=2) as prof:
+        call()
+    sampled = prof.stats["sampled"]
+    assert sampled["top"][0]["func"] == "test_profiling.py:_hot_loop"
+    assert sampled["top"][0]["self"] > 0.5 * sampled["samples"]
+
+
+def test_request_profile_skips_when_busy():
+    with RequestProfile(interval_ms=2):
+        with RequestProfile() as inner:
+            run_sync(inner.profiled(_hot_coro(0)))
+    assert "skipped" in inner.stats
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+import az_utils
+from az_utils import SinkDispatcher, SinkDispatchError, SinkSpec
+
+
+def _ok(data, msg_attr):
+    pass
+
+
+def test_invalid_sink_config_falls_back_to_defaults(monkeypatch):
+    monkeypatch.setattr(az_utils.GlobalArgs, "SINK_CONFIG", "{not json")
+    d = SinkDispatcher({"blob": SinkSpec(_ok, timeout=3)})
+    assert d.dispatch({})["blob"]["status"] == "ok"
+    assert d._sinks["blob"].timeout == 3
+
+
+def test_sink_config_is_read_on_first_dispatch(monkeypatch):
+    d = SinkDispatcher({"blob": SinkSpec(_ok), "cosmos": SinkSpec(_ok)})
+    monkeypatch.setattr(
+        az_utils.GlobalArgs,
+        "SINK_CONFIG",
+        '{"cosmos": {"timeout": 5, "required": false}, "blob": {"timeout": "x"}}',
+    )
+    d.dispatch({})
+    assert d._sinks["cosmos"].timeout == 5
+    assert d._sinks["cosmos"].required is False
+    # A bad value only resets that sink
+    assert d._sinks["blob"].timeout == az_utils.GlobalArgs.SINK_TIMEOUT_SECS
+
+
+def test_hung_sink_is_capped_instead_of_taking_the_pool():
+    release = threading.Event()
+    d = SinkDispatcher(
+        {"slow": SinkSpec(lambda *_: release.wait(10), timeout=0.05)},
+        config={"slow": {"max_in_flight": 2}},
+    )
+    try:
+        for _ in range(2):
+            with pytest.raises(SinkDispatchError) as e:
+                d.dispatch({})
+            assert e.value.results["slow"]["status"] == "timeout"
+        with pytest.raises(SinkDispatchError) as e:
+            d.dispatch({})
+        assert e.value.results["slow"]["status"] == "overloaded"
+    finally:
+        release.set()
+    assert d.get_stats()["slow"]["overloaded"] == 1
@@ -0,0 +1,109 @@
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from store_events_compactor import GlobalArgs, LocalFsStore, compact_partition
+
+DT = "2024_06_01"
+
+
+def _event(i, event_type="sale_event"):
+    return {
+        "id": f"evt-{i}",
+        "event_type": event_type,
+        "store_id": i % 7,
+        "category": ["Books", "Shoes", "Toys"][i % 3],
+        "sku": 1000 + i,
+        "price": 9.99,
+        "qty": 1,
+        "currency": "USD",
+        "ts": "2024-06-01T10:00:00.000001",
+    }
+
+
+def _raw_store(tmp_path, n=25):
+    store = LocalFsStore(str(tmp_path))
+    prefix = f"{GlobalArgs.RAW_PREFIX}/event_type=sale_event/dt={DT}"
+    lines = [json.dumps(_event(i)).encode() for i in range(n)]
+    # One NDJSON segment and a few one-event blobs
+    store.write(f"{prefix}/seg.ndjson", b"\n".join(lines[:20]) + b"\n")
+    for i, line in enumerate(lines[20:]):
+        store.write(f"{prefix}/{i}.json", line)
+    return store
+
+
+def _out_prefix():
+    return f"{GlobalArgs.CURATED_PREFIX}/event_type=sale_event/dt={DT}"
+
+
+def test_streams_into_bounded_row_groups_and_parts(tmp_path):
+    store = _raw_store(tmp_path)
+    _r = compact_partition(store, DT, rows_per_file=10, row_group_rows=4)
+    manifest = _r["partitions"][_out_prefix()]
+    assert manifest["rows"] == 25
+    assert manifest["files"] == [
+        f"{_out_prefix()}/part-{n:05d}.parquet" for n in range(3)
+    ]
+    pf = pq.ParquetFile(store._path(manifest["files"][0]))
+    assert pf.metadata.num_rows == 10
+    assert pf.metadata.num_row_groups > 1
+    assert all(
+        pf.metadata.row_group(g).num_rows <= 4
+        for g in range(pf.metadata.num_row_groups)
+    )
+
+
+def test_dictionary_encoded_columns(tmp_path):
+    store = _raw_store(tmp_path)
+    _r = compact_partition(store, DT, row_group_rows=7)
+    table = pq.read_table(store._path(_r["partitions"][_out_prefix()]["files"][0]))
+    assert pa.types.is_dictionary(table.schema.field("category").type)
+    assert pa.types.is_dictionary(table.schema.field("event_type").type)
+    # Row groups carry their own dictionaries, values still come back whole
+    rows = table.select(["id", "category"]).to_pylist()
+    assert len(rows) == 25
+    assert all(
+        r["category"] == ["Books", "Shoes", "Toys"][int(r["id"][4:]) % 3] for r in rows
+    )
+
+
+def test_rerun_is_idempotent(tmp_path):
+    store = _raw_store(tmp_path)
+    first = compact_partition(store, DT, rows_per_file=10, row_group_rows=4)
+    forced = compact_partition(
+        store, DT, force=True, rows_per_file=10, row_group_rows=4
+    )
+    _f, _g = first["partitions"][_out_prefix()], forced["partitions"][_out_prefix()]
+    assert _g["files"] == _f["files"]
+    assert _g["rows"] == _f["rows"]
+    assert sorted(store.list(f"{_out_prefix()}/")) == sorted(
+        _f["files"] + [f"{_out_prefix()}/{GlobalArgs.SUCCESS_MARKER}"]
+    )
+
+
+def test_skips_already_compacted_partitions(tmp_path):
+    store = _raw_store(tmp_path)
+    first = compact_partition(store, DT)
+    part = store._path(first["partitions"][_out_prefix()]["files"][0])
+    mtime = os.stat(part).st_mtime_ns
+    # Late arrivals are not picked up until the partition is forced
+    store.write(
+        f"{GlobalArgs.RAW_PREFIX}/event_type=sale_event/dt={DT}/late.json",
+        json.dumps(_event(99)).encode(),
+    )
+    again = compact_partition(store, DT)
+    assert again["partitions"] == first["partitions"]
+    assert os.stat(part).st_mtime_ns == mtime
+
+
+def test_empty_partition_still_gets_a_file(tmp_path):
+    store = LocalFsStore(str(tmp_path))
+    store.write(
+        f"{GlobalArgs.RAW_PREFIX}/event_type=sale_event/dt={DT}/empty.ndjson", b""
+    )
+    _r = compact_partition(store, DT)
+    manifest = _r["partitions"][_out_prefix()]
+    assert manifest["rows"] == 0
+    assert pq.read_table(store._path(manifest["files"][0])).num_rows == 0
@@ -0,0 +1,113 @@
+import asyncio
+import itertools
+
+import pytest
+
+import store_events_producer
+
+
+@pytest.fixture(autouse=True)
+def _no_pacing(monkeypatch):
+    monkeypatch.setattr(store_events_producer.GlobalArgs, "WAIT_SECS_BETWEEN_MSGS", 0)
+
+
+class FakeBatchSender:
+    """Stands in for a shared SvcBusBatchSender; every other send fails if `flaky`."""
+
+    flaky = False
+
+    def __init__(self, entity_type):
+        self.entity_type = entity_type
+        self.calls = itertools.count()
+        self.batch = []
+        self.sent = []
+        self.closed = False
+
+    def send(self, data, msg_attr):
+        if self.flaky and next(self.calls) % 2:
+            raise ConnectionError("send failed")
+        self.batch.append(data)
+
+    def flush(self):
+        if self.batch:
+            self.sent.append(self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+    def get_stats(self):
+        return {"batches_sent": len(self.sent)}
+
+
+@pytest.fixture
+def senders(monkeypatch):
+    _s = {}
+
+    def _get(entity_type):
+        return _s.setdefault(entity_type, FakeBatchSender(entity_type))
+
+    monkeypatch.setattr(store_events_producer, "get_svc_bus_batch_sender", _get)
+    return _s
+
+
+def test_failed_async_sends_are_counted(senders, monkeypatch):
+    monkeypatch.setattr(FakeBatchSender, "flaky", True)
+    resp = asyncio.run(store_events_producer.evnt_producer_async(6))
+    assert resp["status"] is False
+    assert resp["tot_msgs"] == 3
+    assert resp["failed_msgs"] == 3
+    assert "svc_bus_topic" in resp["err_msg"]
+    assert resp["sink_results"]["svc_bus_topic"]["error"] == 3
+    assert "ConnectionError" in resp["sink_results"]["svc_bus_topic"]["last_err"]
+
+
+def test_async_sends_go_out_in_batches(senders):
+    resp = asyncio.run(store_events_producer.evnt_producer_async(4))
+    assert resp["status"] is True
+    assert resp["tot_msgs"] == 4
+    assert resp["failed_msgs"] == 0
+    assert resp["sink_results"]["svc_bus_topic"]["ok"] == 4
+    # One round trip for all four events
+    assert [len(b) for b in senders["topic"].sent] == [4]
+    assert resp["svc_bus_batches"]["topic"] == {"batches_sent": 1}
+
+
+def test_requests_share_the_batch_senders(senders):
+    for _ in range(2):
+        resp = asyncio.run(store_events_producer.evnt_producer_async(3))
+        assert resp["status"] is True
+    # Each request flushes the shared sender, none closes it
+    assert [len(b) for b in senders["topic"].sent] == [3, 3]
+    assert not senders["topic"].closed
+
+
+def _seeded(n, seed=7):
+    events = []
+    for batch in store_events_producer.iter_seeded_batches(seed, 0, n):
+        for body, _ in batch.iter_events():
+            body.pop("ts", None)
+            events.append(body)
+    return events
+
+
+@pytest.mark.parametrize("chunk", [store_events_producer._SEED_CHUNK, 4])
+def test_seeded_stream_is_prefix_stable(monkeypatch, chunk):
+    monkeypatch.setattr(store_events_producer, "_SEED_CHUNK", chunk)
+    short, long = _seeded(5), _seeded(12)
+    assert len(short) == 5 and len(long) == 12
+    assert short == long[:5]
+
+
+def test_short_seeded_run_draws_about_its_own_size(monkeypatch):
+    drawn = []
+    _generate_events = store_events_producer.generate_events
+
+    def _spy(n, **kwargs):
+        drawn.append(n)
+        return _generate_events(n, **kwargs)
+
+    monkeypatch.setattr(store_events_producer, "generate_events", _spy)
+    assert len(_seeded(3)) == 3
+    assert sum(drawn) < 2 * 3
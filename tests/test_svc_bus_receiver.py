@@ -0,0 +1,199 @@
+import copy
+import datetime
+import time
+
+import pytest
+from azure.cosmos.exceptions import CosmosResourceExistsError
+
+import az_utils
+import event_codec
+
+
+class FakeMsg:
+    content_type = None
+    partition_key = None
+    reply_to = None
+    reply_to_session_id = None
+    session_id = None
+    to = None
+    enqueued_time_utc = None
+    time_to_live = datetime.timedelta(days=14)
+    application_properties = {b"event_type": b"sale_event"}
+
+    def __init__(self, message_id, delivery_count=1, body=b"{}"):
+        self.message_id = message_id
+        self.delivery_count = delivery_count
+        self.body = [body]
+
+
+class FakeReceiver:
+    """
+    Redelivers an abandoned message with its delivery count bumped, until
+    the broker would dead-letter it.
+    """
+
+    def __init__(self, msgs, max_delivery_count=10):
+        self.pending = list(msgs)
+        self.settled = []
+        self.max_delivery_count = max_delivery_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def receive_messages(self, max_message_count, max_wait_time):
+        batch = self.pending[:max_message_count]
+        del self.pending[:max_message_count]
+        return batch
+
+    def complete_message(self, msg):
+        self.settled.append(("completed", msg.message_id))
+
+    def abandon_message(self, msg):
+        self.settled.append(("abandoned", msg.message_id))
+        self.abandoned_at = time.monotonic()
+        if msg.delivery_count >= self.max_delivery_count:
+            self.settled.append(("max_delivery_count", msg.message_id))
+            return
+        _redelivered = copy.copy(msg)
+        _redelivered.delivery_count += 1
+        self.pending.append(_redelivered)
+
+
+class FakeClient:
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def get_queue_receiver(self, q_name):
+        return self.receiver
+
+
+class FakeRenewer:
+    def __init__(self, **kwargs):
+        self.registered = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def register(self, receiver, msg):
+        self.registered.append(msg.message_id)
+
+
+class FlakySinks:
+    def __init__(self, failures):
+        self.failures = failures
+
+    def dispatch(self, recv_event):
+        if self.failures:
+            self.failures -= 1
+            self.failed_at = time.monotonic()
+            raise ConnectionError("sink unavailable")
+
+
+class FakeAioContainer:
+    def __init__(self):
+        self.docs = {}
+
+    async def create_item(self, body):
+        if body["id"] in self.docs:
+            raise CosmosResourceExistsError(status_code=409, message="conflict")
+        self.docs[body["id"]] = body
+
+    async def upsert_item(self, body):
+        self.docs[body["id"]] = body
+
+
+BACKOFF_SECS = 0.05
+
+
+def _serve(monkeypatch, receiver):
+    renewers = []
+
+    def _renewer(**kwargs):
+        renewers.append(FakeRenewer(**kwargs))
+        return renewers[-1]
+
+    monkeypatch.setattr(az_utils.GlobalArgs, "SVC_BUS_RECEIVER_MODE", "serial")
+    monkeypatch.setattr(az_utils.GlobalArgs, "SVC_BUS_RETRY_BACKOFF_SECS", BACKOFF_SECS)
+    monkeypatch.setattr(az_utils, "ServiceBusClient", FakeClient(receiver))
+    monkeypatch.setattr(az_utils, "AutoLockRenewer", _renewer)
+    monkeypatch.setattr(az_utils, "_get_az_creds", lambda: None)
+    return renewers
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    _r = FakeReceiver([FakeMsg("msg-0")])
+    _r.renewers = _serve(monkeypatch, _r)
+    monkeypatch.setattr(
+        az_utils,
+        "_svc_bus_msg_to_event",
+        lambda msg: {"id": msg.message_id, "latency_stamps": {}},
+    )
+    _r.sinks = FlakySinks(failures=1)
+    monkeypatch.setattr(az_utils, "_consumer_sinks", _r.sinks)
+    return _r
+
+
+def test_serial_receiver_holds_transient_failures_for_their_backoff(
+    receiver, monkeypatch
+):
+    sleeps = []
+    monkeypatch.setattr(az_utils.time, "sleep", sleeps.append)
+    resp = az_utils.read_from_svc_bus_q(max_msgs=1)
+    assert receiver.settled == [("abandoned", "msg-0"), ("completed", "msg-0")]
+    assert resp["msg_classes"] == {"valid": 1, "poison": 0, "transient": 1}
+    # Abandoned once its backoff was up, its lock renewed meanwhile
+    assert receiver.abandoned_at - receiver.sinks.failed_at >= BACKOFF_SECS
+    assert receiver.renewers[0].registered == ["msg-0"]
+    # The receive loop never slept with the failed message's lock held
+    assert sleeps == []
+
+
+def test_held_retries_are_abandoned_when_the_run_ends(receiver, monkeypatch):
+    monkeypatch.setattr(az_utils.GlobalArgs, "SVC_BUS_RETRY_BACKOFF_SECS", 3600)
+    monkeypatch.setattr(az_utils.GlobalArgs, "MAX_BACKOFF_SECS", 3600)
+    monkeypatch.setattr(az_utils.time, "sleep", lambda secs: None)
+    receiver.pending.append(FakeMsg("msg-1"))
+    resp = az_utils.read_from_svc_bus_q(max_msgs=1)
+    assert receiver.settled == [("completed", "msg-1"), ("abandoned", "msg-0")]
+    assert resp["msg_classes"]["transient"] == 1
+
+
+def test_redelivery_after_blob_failure_completes(monkeypatch):
+    _body = event_codec.dumps(
+        {"id": "evnt-0", "store_id": 7, "ts": "2026-10-17T10:00:00+00:00"}
+    )
+    _r = FakeReceiver([FakeMsg("msg-0", body=_body)])
+    _serve(monkeypatch, _r)
+    monkeypatch.setattr(az_utils.time, "sleep", lambda secs: None)
+    # Cosmos takes the first delivery, the blob write of it fails
+    blob_failures = [ConnectionError("blob unavailable")]
+
+    def _write_to_blob(data, payload=None, flush=False):
+        if blob_failures:
+            raise blob_failures.pop()
+
+    _c = FakeAioContainer()
+    monkeypatch.setattr(az_utils, "write_to_blob", _write_to_blob)
+    monkeypatch.setattr(az_utils, "_aio_clients", az_utils.AsyncClientRegistry())
+    monkeypatch.setattr(az_utils, "_new_cosmos_container_aio", lambda *_: (_c, []))
+
+    resp = az_utils.read_from_svc_bus_q(max_msgs=1)
+    assert _r.settled == [("abandoned", "msg-0"), ("completed", "msg-0")]
+    assert resp["msg_classes"] == {"valid": 1, "poison": 0, "transient": 1}
+    assert set(_c.docs) == {"msg-0"}
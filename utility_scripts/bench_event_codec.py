@@ -0,0 +1,108 @@
+"""
+Microbenchmark for the JSON codec backends on generated store events.
+
+Times encoding, decoding with the `StoreEvent` check, and NDJSON encoding of
+a batch for every backend that is installed, against plain `json.dumps` /
+`json.loads` as the producer and consumers used them before.
+
+    python utility_scripts/bench_event_codec.py --events 20000
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(__file__), "..", "app", "function_code", "store-backend-ops-v2"
+    ),
+)
+
+import event_codec  # noqa: E402
+from store_events_producer import iter_seeded_batches  # noqa: E402
+
+
+def _per_event_us(fn, items, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(items)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e6
+
+
+def _suites(dumps, loads):
+    def encode(evnts):
+        for e in evnts:
+            dumps(e)
+
+    def decode(payloads):
+        for p in payloads:
+            event_codec.validate_event(loads(p))
+
+    def ndjson(evnts):
+        b"".join(dumps(e) + b"\n" for e in evnts)
+
+    return encode, decode, ndjson
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=20_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    evnts = [
+        e
+        for batch in iter_seeded_batches(args.seed, n=args.events)
+        for e in batch.to_dicts()
+    ]
+    # Poison pills would stop the decode loop, the check itself is still timed
+    evnts = [e for e in evnts if not e.get("bad_msg")]
+    payloads = [json.dumps(e).encode("UTF-8") for e in evnts]
+
+    backends = {
+        "json (before)": (lambda o: json.dumps(o).encode("UTF-8"), json.loads),
+    }
+    for name, backend in event_codec._BACKENDS.items():
+        try:
+            dumps, loads, _ = backend()
+        except ImportError:
+            print(f"{name} is not installed, skipping")
+            continue
+        backends[name] = (dumps, loads)
+
+    results = {}
+    for name, (dumps, loads) in backends.items():
+        encode, decode, ndjson = _suites(dumps, loads)
+        results[name] = {
+            "encode_us": round(_per_event_us(encode, evnts, args.rounds), 3),
+            "decode_validate_us": round(
+                _per_event_us(decode, payloads, args.rounds), 3
+            ),
+            "ndjson_us": round(_per_event_us(ndjson, evnts, args.rounds), 3),
+        }
+    base = results["json (before)"]
+    for r in results.values():
+        r["speedup"] = round(
+            sum(base.values()) / sum(v for k, v in r.items() if k.endswith("_us")), 2
+        )
+    print(
+        json.dumps(
+            {
+                "events": len(evnts),
+                "avg_event_bytes": round(sum(map(len, payloads)) / len(payloads)),
+                "auto_backend": event_codec.BACKEND,
+                "results": results,
+            },
+            indent=4,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
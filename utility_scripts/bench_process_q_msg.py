@@ -0,0 +1,161 @@
+"""
+Microbenchmark for the Service Bus consumer's per message CPU cost.
+
+Compares the old `process_q_msg` pipeline (body decoded twice, parsed twice,
+pretty printed for INFO logs, re-serialized for blob) with the single parse
+`ParsedQMsg` pipeline. Sinks are replaced by their CPU-side work only, so no
+Azure resources are needed.
+
+    python utility_scripts/bench_process_q_msg.py --msgs 20000
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(__file__), "..", "app", "function_code", "store-backend-ops-v2"
+    ),
+)
+
+import az_utils  # noqa: E402
+
+
+class FakeSvcBusMsg:
+    """Just the attributes `process_q_msg` reads from func.ServiceBusMessage."""
+
+    def __init__(self, body: bytes, n: int):
+        self._body = body
+        self.message_id = f"msg-{n}"
+        self.content_type = "application/json"
+        self.delivery_count = 1
+        self.enqueued_time_utc = None
+        self.expiration_time = None
+        self.label = None
+        self.partition_key = None
+        self.reply_to = None
+        self.reply_to_session_id = None
+        self.scheduled_enqueue_time = None
+        self.session_id = None
+        self.time_to_live = datetime.timedelta(days=14)
+        self.to = None
+        self.user_properties = {"event_type": "sale_event", "priority_shipping": "1"}
+
+    def get_body(self) -> bytes:
+        return self._body
+
+
+class CpuOnlySinks:
+    """Stands in for `_consumer_sinks`: blob serializes, cosmos takes the dict."""
+
+    def dispatch(self, data, raw=None):
+        blob_bytes = len(raw or json.dumps(data).encode("UTF-8"))
+        return {
+            "blob": {"status": "ok", "bytes": blob_bytes},
+            "cosmos": {"status": "ok"},
+        }
+
+
+def legacy_process_q_msg(msg):
+    # The pipeline as it was before the single parse change
+    _a_resp = {"status": False, "miztiik_event_processed": False}
+    msg_body = msg.get_body().decode("utf-8")
+    parsed_msg = json.loads(msg_body)
+    start_time = datetime.datetime.fromisoformat(parsed_msg["ts"])
+    processing_time = int((datetime.datetime.now() - start_time).total_seconds())
+    enriched_msg = json.dumps(
+        {
+            "message_id": msg.message_id,
+            "body": msg.get_body().decode("utf-8"),
+            "content_type": msg.content_type,
+            "delivery_count": msg.delivery_count,
+            "label": msg.label,
+            "time_to_live": msg.time_to_live,
+            "user_properties": msg.user_properties,
+            "event_type": msg.user_properties.get("event_type"),
+            "processing_time": processing_time,
+        },
+        indent=4,
+        sort_keys=True,
+        default=str,
+    )
+    logging.info(f"{parsed_msg}")
+    logging.info(f"recv_msg:\n {enriched_msg}")
+    logging.info(f"{json.dumps(msg_body, indent=4)}")
+    _a_resp["sink_results"] = az_utils._consumer_sinks.dispatch(json.loads(msg_body))
+    _a_resp["status"] = True
+    _a_resp["processing_time"] = processing_time
+    logging.info(f"{json.dumps(_a_resp, indent=4, sort_keys=True, default=str)}")
+    logging.info(json.dumps(_a_resp, indent=4, sort_keys=True, default=str))
+
+
+def _bench(fn, msgs) -> float:
+    start = time.process_time()
+    for m in msgs:
+        fn(m)
+    return (time.process_time() - start) / len(msgs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--msgs", type=int, default=20_000)
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+
+    # Log records are formatted into memory, like a host capturing stdout
+    logging.basicConfig(level=args.log_level, stream=io.StringIO(), force=True)
+    az_utils._consumer_sinks = CpuOnlySinks()
+    az_utils.GlobalArgs.TRIGGER_RANDOM_FAILURES = False
+
+    body = {
+        "id": "7e0f6d4c-5b1a-4c59-9a57-2f0a3c1e8b11",
+        "event_type": "sale_event",
+        "store_id": 6,
+        "store_fqdn": "localhost",
+        "store_ip": "127.0.0.1",
+        "cust_id": 542,
+        "category": "Laptops",
+        "sku": 104256,
+        "price": 42.17,
+        "qty": 3,
+        "currency": "USD",
+        "discount": 12,
+        "gift_wrap": False,
+        "variant": "red",
+        "priority_shipping": True,
+        "is_promoted": False,
+        "payment_method": "upi",
+        "ts": datetime.datetime.now().isoformat(),
+        "contact_me": "github.com/miztiik",
+        "is_return": False,
+    }
+    raw = json.dumps(body).encode("UTF-8")
+    msgs = [FakeSvcBusMsg(raw, n) for n in range(args.msgs)]
+
+    _bench(legacy_process_q_msg, msgs[:1000])  # warm up
+    legacy_us = _bench(legacy_process_q_msg, msgs)
+    single_us = _bench(az_utils.process_q_msg, msgs)
+    print(
+        json.dumps(
+            {
+                "msgs": args.msgs,
+                "log_level": args.log_level,
+                "legacy_us_per_msg": round(legacy_us, 2),
+                "single_parse_us_per_msg": round(single_us, 2),
+                "saved_us_per_msg": round(legacy_us - single_us, 2),
+                "saved_pct": round(100 * (legacy_us - single_us) / legacy_us, 1),
+            },
+            indent=4,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()